@@ -0,0 +1,303 @@
+"""Remote worker agents — claude sessions on other machines.
+
+A worker agent (worker_agent.py) connects to ``/ws/agent``, says hello with
+its name and slot count, and the scheduler adds one remote ``Worker`` per
+slot. Tasks are sent down the socket; the agent runs them in its own
+worktree pool and streams every stdout line back, then the final result.
+Lines go through the same log policy, log writer and broadcast as local
+runs, so clients can't tell the difference.
+
+Any message counts as a heartbeat. An agent silent for AGENT_TIMEOUT, or
+whose socket drops, is dropped: its running tasks go back to the queue
+(cancelled ones are recorded as cancelled) and its slots disappear.
+
+Messages are JSON objects with a ``type``:
+    agent -> manager: hello {name, slots, host, token}, heartbeat,
+                      event {task_id, line},
+                      result {task_id, status, result_text, cost_usd, diff_base?, diff?, diff_truncated?}
+    manager -> agent: welcome {heartbeat}, rejected {reason},
+                      task {task_id, prompt, mode, diff}, cancel {task_id}
+"""
+
+from typing import Optional, Dict, List
+
+import asyncio
+import hmac
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+import log_ingest
+import log_policy
+import metrics
+import task_cache
+import task_queue
+import tracing
+from db import execute, execute_fetch_one
+from runner import StreamTrace, classify_type, parse_line
+
+logger = logging.getLogger(__name__)
+
+# Shared secret agents must present; empty accepts any agent
+AGENT_TOKEN = os.environ.get("CCM_AGENT_TOKEN", "")
+# How often agents are asked to send a heartbeat, and how long one may be silent
+HEARTBEAT = float(os.environ.get("CCM_AGENT_HEARTBEAT", "5"))
+AGENT_TIMEOUT = float(os.environ.get("CCM_AGENT_TIMEOUT", "20"))
+# Slots an agent may claim; larger hellos are clamped to this
+AGENT_MAX_SLOTS = int(os.environ.get("CCM_AGENT_MAX_SLOTS", "32"))
+
+FINAL_STATUSES = ("completed", "failed", "cancelled")
+
+REQUEUE_SQL = "UPDATE tasks SET status='queued', started_at=NULL WHERE id=? AND status='running' RETURNING priority"
+
+AGENTS = metrics.Gauge("ccm_agents", "Connected worker agents").set_function(lambda: len(agents))
+AGENT_LOST = metrics.Counter("ccm_agent_lost_total", "Agent connections dropped (timeout, disconnect, replaced)")
+TASKS_REQUEUED = metrics.Counter("ccm_agent_tasks_requeued_total", "Tasks put back in the queue because their agent was lost")
+
+# Connected agents by name
+agents: Dict[str, "RemoteAgent"] = {}
+
+
+class _RemoteRun:
+    """Manager-side state of one task running on an agent."""
+
+    def __init__(self, task_id: int, broadcast=None):
+        self.task_id = task_id
+        self.broadcast = broadcast
+        self.task_log = log_policy.TaskLog(task_id)
+        trace = tracing.get(task_id)
+        self.trace = trace
+        self.stream = StreamTrace(trace, time.time()) if trace is not tracing.NULL_TRACE else None
+        self.done: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+
+    async def line(self, line: str):
+        etype, text, data = parse_line(line)
+        event_type = classify_type(etype)
+        if self.stream:
+            self.stream.line(etype, text, data)
+        log_id = None
+        for row in self.task_log.feed(event_type, etype, text, data):
+            log_id = await log_ingest.append(self.task_id, *row)
+        if self.broadcast:
+            await self.broadcast(self.task_id, event_type, text, log_id=log_id)
+
+    async def _close_log(self, note: Optional[dict] = None):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        rows = self.task_log.finish()
+        if note:
+            rows += self.task_log.feed("system", "system", json.dumps(note), note)
+        for row in rows:
+            await log_ingest.append(self.task_id, *row)
+        await log_ingest.flush()
+
+    async def finish(self, status: str, result_text: str, cost_usd: float, note: Optional[dict] = None):
+        if self.done.done():
+            return
+        finalize_at = time.time()
+        await self._close_log(note)
+        await execute(
+            "UPDATE tasks SET status=?, finished_at=?, result_text=?, cost_usd=? WHERE id=?",
+            (status, datetime.utcnow().isoformat(), result_text, cost_usd, self.task_id),
+        )
+        self.trace.span("finalize", finalize_at, status=status)
+        if not self.done.done():
+            self.done.set_result(status)
+
+    async def requeue(self, reason: str):
+        """Put the task back in the queue; the scheduler sees None as the status."""
+        if self.done.done():
+            return
+        await self._close_log({"type": "system", "subtype": "requeued", "reason": reason})
+        row = await execute_fetch_one(REQUEUE_SQL, (self.task_id,))
+        if row:
+            task_queue.push(self.task_id, row["priority"])
+            TASKS_REQUEUED.inc()
+        self.trace.instant("requeued", reason=reason)
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class RemoteProcess:
+    """Stands in for a runner process handle, so RalphLoop.cancel works unchanged."""
+
+    def __init__(self, agent: "RemoteAgent", run: _RemoteRun):
+        self.agent = agent
+        self.run = run
+
+    async def terminate(self, reason: str):
+        self.run.cancelled = reason == "cancelled"
+        try:
+            await self.agent.send({"type": "cancel", "task_id": self.run.task_id, "reason": reason})
+        except Exception:
+            logger.warning(f"Agent {self.agent.name}: could not send cancel for task {self.run.task_id}")
+
+
+class RemoteAgent:
+    def __init__(self, name: str, slots: int, ws: WebSocket, host: str = ""):
+        self.name = name
+        self.slots = slots
+        self.host = host
+        self.ws = ws
+        self.connected_at = time.time()
+        self.last_seen = self.connected_at
+        self.closed = False
+        self.runs: Dict[int, _RemoteRun] = {}
+        self._send_lock = asyncio.Lock()
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "host": self.host,
+            "slots": self.slots,
+            "running": sorted(self.runs),
+            "connected_s": round(time.time() - self.connected_at, 1),
+            "last_seen_s": round(time.time() - self.last_seen, 1),
+        }
+
+    async def send(self, msg: dict):
+        async with self._send_lock:
+            await self.ws.send_text(json.dumps(msg, ensure_ascii=False))
+
+    async def run_task(self, task_id: int, prompt: str, mode: str = "execute", keep_diff: bool = False,
+                       broadcast=None, on_start=None) -> Optional[str]:
+        """Run a task on this agent and wait for its final status.
+
+        Returns None if the agent was lost meanwhile; the task is queued
+        again by then.
+        """
+        await execute(
+            "UPDATE tasks SET status='running', started_at=? WHERE id=?",
+            (datetime.utcnow().isoformat(), task_id),
+        )
+        run = self.runs[task_id] = _RemoteRun(task_id, broadcast)
+        try:
+            if self.closed:
+                await run.requeue(f"agent {self.name} disconnected")
+            else:
+                try:
+                    await self.send({"type": "task", "task_id": task_id, "prompt": prompt, "mode": mode,
+                                     "diff": keep_diff})
+                except Exception as e:
+                    await run.requeue(f"agent {self.name} unreachable: {e}")
+                if on_start:
+                    on_start(RemoteProcess(self, run))
+            return await run.done
+        finally:
+            self.runs.pop(task_id, None)
+
+    async def handle(self, msg: dict):
+        mtype = msg.get("type")
+        if mtype == "heartbeat":
+            return
+        run = self.runs.get(msg.get("task_id"))
+        if run is None:
+            return  # late message for a task that was finished or requeued
+        if mtype == "event":
+            await run.line(msg.get("line") or "")
+        elif mtype == "result":
+            status = msg.get("status")
+            if status not in FINAL_STATUSES:
+                status = "failed"
+            if status == "completed" and msg.get("diff_base"):
+                await task_cache.save_diff(run.task_id, msg["diff_base"], msg.get("diff") or "",
+                                           bool(msg.get("diff_truncated")))
+            await run.finish(status, msg.get("result_text") or "", float(msg.get("cost_usd") or 0))
+
+    async def lose(self, reason: str):
+        """Drop the connection and hand its tasks back to the queue."""
+        if self.closed:
+            return
+        self.closed = True
+        AGENT_LOST.inc()
+        logger.warning(f"Agent {self.name} lost ({reason}); requeueing {len(self.runs)} tasks")
+        for run in list(self.runs.values()):
+            try:
+                if run.cancelled:
+                    await run.finish("cancelled", "Cancelled", 0.0,
+                                     {"type": "system", "subtype": "stopped", "reason": "cancelled"})
+                else:
+                    await run.requeue(f"agent {self.name} lost: {reason}")
+            except Exception:
+                logger.exception(f"Agent {self.name}: recovering task {run.task_id} failed")
+                if not run.done.done():
+                    run.done.set_result(None)
+        try:
+            await self.ws.close()
+        except Exception:
+            pass
+
+
+def list_agents() -> List[dict]:
+    return [a.to_dict() for a in agents.values()]
+
+
+async def _receive(ws: WebSocket) -> dict:
+    msg = json.loads(await asyncio.wait_for(ws.receive_text(), AGENT_TIMEOUT))
+    if not isinstance(msg, dict):
+        raise ValueError("message is not an object")
+    return msg
+
+
+async def serve(ws: WebSocket, scheduler):
+    """One agent connection, from hello until it is lost."""
+    await ws.accept()
+    try:
+        hello = await _receive(ws)
+    except (asyncio.TimeoutError, WebSocketDisconnect, ValueError):
+        await ws.close(code=1002)
+        return
+
+    name = str(hello.get("name") or "")
+    slots = hello.get("slots", 1)
+    reason = ""
+    if hello.get("type") != "hello" or not name:
+        reason = "expected hello with a name"
+    elif not isinstance(slots, int) or isinstance(slots, bool) or slots < 1:
+        reason = "slots must be a positive integer"
+    elif AGENT_TOKEN and not hmac.compare_digest(str(hello.get("token") or ""), AGENT_TOKEN):
+        reason = "bad token"
+    elif scheduler is None:
+        reason = "scheduler not running"
+    if reason:
+        logger.warning(f"Agent connection rejected: {reason}")
+        await ws.send_text(json.dumps({"type": "rejected", "reason": reason}))
+        await ws.close(code=1008)
+        return
+
+    old = agents.get(name)
+    if old:
+        await old.lose("replaced by a new connection")
+        scheduler.remove_agent(old)
+    if slots > AGENT_MAX_SLOTS:
+        logger.warning(f"Agent {name} asked for {slots} slots, capped at {AGENT_MAX_SLOTS}")
+        slots = AGENT_MAX_SLOTS
+    agent = agents[name] = RemoteAgent(name, slots, ws, str(hello.get("host") or ""))
+    await agent.send({"type": "welcome", "heartbeat": HEARTBEAT})
+    scheduler.add_agent(agent)
+    logger.info(f"Agent {name} connected from {agent.host or '?'} with {agent.slots} slots")
+
+    reason = "disconnected"
+    try:
+        while True:
+            msg = await _receive(ws)
+            agent.last_seen = time.time()
+            await agent.handle(msg)
+    except asyncio.TimeoutError:
+        reason = f"no heartbeat for {AGENT_TIMEOUT:.0f}s"
+    except WebSocketDisconnect:
+        pass
+    except Exception:
+        logger.exception(f"Agent {name}: bad message")
+        reason = "protocol error"
+    finally:
+        if agents.get(name) is agent:
+            del agents[name]
+        await agent.lose(reason)
+        scheduler.remove_agent(agent)
@@ -1,6 +1,6 @@
 """FastAPI main application — routes, WebSocket, startup/shutdown."""
 
-from typing import Optional, List, Dict
+from typing import Optional
 
 import asyncio
 import json
@@ -9,78 +9,75 @@ import os
 from contextlib import asynccontextmanager
 from datetime import datetime
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from pydantic import BaseModel
 
-from db import init_db, fetch_all, fetch_one, execute, execute_returning
+import agents
+import log_ingest
+import loop_lag
+import metrics
+from log_policy import RetentionJob, decode_rows
+import task_cache
+import task_queue
+import tracing
+from db import init_db, open_pool, close_pool, fetch_all, fetch_one, execute, db_size_bytes, transaction
 from ralph_loop import RalphLoop
-from worktree import init_pool, get_repo_root_sync, list_worktrees, remove_worktree
-from plan_mode import create_plan_group, get_plan_detail, approve_plan, on_plan_task_complete, check_plan_completion, discuss, generate_plan_from_discussion, get_discussion_messages
-from progress import get_progress_entries, record_progress, get_relevant_experience
+from runner import install_child_watcher
+from autoscaler import PoolAutoscaler
+from worktree import init_pool, get_repo_root_sync, list_worktrees, remove_worktree, get_pool_stats, wait_recycling
+from plan_mode import create_plan_group, get_plan_detail, parse_plan_steps, approve_plan, on_plan_task_complete, check_plan_completion
+try:
+    from plan_mode import discuss, generate_plan_from_discussion, get_discussion_messages
+except ImportError:
+    # Plan discussion is not in plan_mode; its routes answer 501 and plans go straight to planning
+    discuss = generate_plan_from_discussion = get_discussion_messages = None
+from progress import get_progress_entries, record_progress, get_relevant_experience, start_exporter, stop_exporter
+from ws_manager import ConnectionManager, encode_event
+from changes import ChangeFeed, TASK_SUMMARY_COLUMNS, attach_plan_info, current_version, read_since, task_counts
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 logger = logging.getLogger(__name__)
 
-# --- WebSocket manager ---
-
-class ConnectionManager:
-    def __init__(self):
-        self.task_connections: Dict[int, List[WebSocket]] = {}
-        self.event_connections: List[WebSocket] = []
-
-    async def connect_task(self, ws: WebSocket, task_id: int):
-        await ws.accept()
-        self.task_connections.setdefault(task_id, []).append(ws)
-
-    async def connect_events(self, ws: WebSocket):
-        await ws.accept()
-        self.event_connections.append(ws)
-
-    def disconnect_task(self, ws: WebSocket, task_id: int):
-        conns = self.task_connections.get(task_id, [])
-        if ws in conns:
-            conns.remove(ws)
-
-    def disconnect_events(self, ws: WebSocket):
-        if ws in self.event_connections:
-            self.event_connections.remove(ws)
-
-    async def broadcast(self, task_id: int, event_type: str, payload: dict):
-        msg = json.dumps({"task_id": task_id, "event_type": event_type, "payload": payload}, ensure_ascii=False)
-
-        # Send to task-specific subscribers
-        for ws in list(self.task_connections.get(task_id, [])):
-            try:
-                await ws.send_text(msg)
-            except Exception:
-                self.task_connections[task_id].remove(ws)
-
-        # Send to global event subscribers
-        for ws in list(self.event_connections):
-            try:
-                await ws.send_text(msg)
-            except Exception:
-                self.event_connections.remove(ws)
+# Task list page size (default / upper bound for ?limit=)
+TASK_PAGE_SIZE = int(os.environ.get("CCM_TASK_PAGE_SIZE", "100"))
+TASK_PAGE_MAX = 500
+# Log rows returned with task detail / per page of /api/tasks/{id}/logs
+LOG_PAGE_SIZE = int(os.environ.get("CCM_LOG_PAGE_SIZE", "200"))
+LOG_PAGE_MAX = 2000
 
+# --- WebSocket manager ---
 
 manager = ConnectionManager()
 scheduler: Optional[RalphLoop] = None
+autoscaler: Optional[PoolAutoscaler] = None
+change_feed: Optional[ChangeFeed] = None
+log_retention = RetentionJob()
 
 
 # --- Lifespan ---
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global scheduler
+    global scheduler, autoscaler, change_feed
+    install_child_watcher()
+    loop_lag.monitor.start()
     await init_db()
-
-    # Try to init worktree pool if we're in a git repo
-    repo_root = get_repo_root_sync(os.getcwd())
+    await open_pool()
+    await log_ingest.start()
+    change_feed = ChangeFeed(manager.broadcast)
+    await change_feed.start()
+    start_exporter()
+    log_retention.start()
+
+    # Try to init worktree pool if we're in a git repo (or CCM_REPO_DIR is one)
+    repo_root = get_repo_root_sync(os.environ.get("CCM_REPO_DIR") or os.getcwd())
+    pool_size = int(os.environ.get("CCM_POOL_SIZE", "4"))
+    pool_min = int(os.environ.get("CCM_POOL_MIN", str(pool_size)))
+    pool_max = int(os.environ.get("CCM_POOL_MAX", str(pool_min)))
     if repo_root:
-        pool_size = int(os.environ.get("CCM_POOL_SIZE", "4"))
-        await init_pool(repo_root, pool_size)
+        await init_pool(repo_root, pool_min)
         logger.info(f"Worktree pool initialized in {repo_root}")
     else:
         logger.warning("Not in a git repo — worktree pool disabled")
@@ -91,9 +88,23 @@ async def lifespan(app: FastAPI):
     )
     scheduler.start()
 
+    # Elastic pool: worker slots follow the worktree count between min and max
+    if repo_root and pool_max > pool_min:
+        autoscaler = PoolAutoscaler(scheduler, pool_min, pool_max)
+        autoscaler.start()
+
     yield
 
+    if autoscaler:
+        await autoscaler.stop()
     await scheduler.stop()
+    await wait_recycling()
+    await stop_exporter()
+    await log_retention.stop()
+    await change_feed.stop()
+    await log_ingest.stop()
+    await close_pool()
+    await loop_lag.monitor.stop()
 
 
 app = FastAPI(title="Claude Code Manager", lifespan=lifespan)
@@ -105,6 +116,7 @@ class TaskCreate(BaseModel):
     priority: int = 0
     mode: str = "execute"
     cwd: Optional[str] = None
+    force: bool = False  # run even if an identical task is in flight or cached
 
 class PlanCreate(BaseModel):
     goal: str
@@ -119,49 +131,58 @@ class ProgressCreate(BaseModel):
 
 @app.post("/api/tasks")
 async def create_task(body: TaskCreate):
+    # Identical prompt on the same commit: reuse the running or recent task
+    key = await task_cache.cache_key(body.prompt, body.mode, body.cwd)
+    if key and not body.force:
+        hit = await task_cache.lookup(key)
+        if hit:
+            return await task_cache.hit_response(hit)
+
     # Inject experience context
     experience = await get_relevant_experience(body.prompt)
     prompt = body.prompt
     if experience:
         prompt = f"{experience}\n\n---\n\n{prompt}"
 
-    task_id = await execute_returning(
-        "INSERT INTO tasks (prompt, priority, mode, cwd) VALUES (?, ?, ?, ?)",
-        (prompt, body.priority, body.mode, body.cwd),
-    )
+    # Checked again under the write lock, so two concurrent duplicates
+    # can't both get in
+    async with transaction() as db:
+        hit = await task_cache.lookup(key, db) if key and not body.force else None
+        if not hit:
+            cursor = await db.execute(
+                "INSERT INTO tasks (prompt, priority, mode, cwd, cache_key) VALUES (?, ?, ?, ?, ?)",
+                (prompt, body.priority, body.mode, body.cwd, key),
+            )
+            task_id = cursor.lastrowid
+            await cursor.close()
+    if hit:
+        return await task_cache.hit_response(hit)
+    task_queue.push(task_id, body.priority)
     if scheduler:
         scheduler.notify()
     return {"id": task_id, "status": "queued"}
 
 
 @app.get("/api/tasks")
-async def list_tasks(status: Optional[str] = None):
+async def list_tasks(response: Response, status: Optional[str] = None, before_id: Optional[int] = None, limit: int = TASK_PAGE_SIZE):
+    # Keyset pagination: newest first, pass X-Next-Before-Id back as before_id for the next page
+    limit = max(1, min(limit, TASK_PAGE_MAX))
+    where, params = [], []
     if status:
-        tasks = await fetch_all(
-            "SELECT id, prompt, status, mode, priority, worktree_id, plan_group_id, created_at, started_at, finished_at, cost_usd FROM tasks WHERE status=? ORDER BY id DESC",
-            (status,),
-        )
-    else:
-        tasks = await fetch_all(
-            "SELECT id, prompt, status, mode, priority, worktree_id, plan_group_id, created_at, started_at, finished_at, cost_usd FROM tasks ORDER BY id DESC"
-        )
-    # Truncate prompt for list view
-    for t in tasks:
-        t["prompt_short"] = t["prompt"][:100]
+        where.append("status=?")
+        params.append(status)
+    if before_id is not None:
+        where.append("id<?")
+        params.append(before_id)
+    clause = f"WHERE {' AND '.join(where)} " if where else ""
+    tasks = await fetch_all(
+        f"SELECT {TASK_SUMMARY_COLUMNS} FROM tasks {clause}ORDER BY id DESC LIMIT ?",
+        (*params, limit),
+    )
+    if len(tasks) == limit:
+        response.headers["X-Next-Before-Id"] = str(tasks[-1]["id"])
     # Attach plan_status and plan_goal for tasks belonging to a plan group
-    group_ids = list({t["plan_group_id"] for t in tasks if t["plan_group_id"]})
-    if group_ids:
-        placeholders = ",".join("?" * len(group_ids))
-        groups = await fetch_all(
-            f"SELECT id, goal, status FROM plan_groups WHERE id IN ({placeholders})",
-            group_ids,
-        )
-        group_map = {g["id"]: g for g in groups}
-        for t in tasks:
-            if t["plan_group_id"] and t["plan_group_id"] in group_map:
-                g = group_map[t["plan_group_id"]]
-                t["plan_status"] = g["status"]
-                t["plan_goal"] = g["goal"]
+    await attach_plan_info(tasks)
     return tasks
 
 
@@ -170,11 +191,57 @@ async def get_task(task_id: int):
     task = await fetch_one("SELECT * FROM tasks WHERE id=?", (task_id,))
     if not task:
         raise HTTPException(404, "Task not found")
+    # Only the newest page of logs; older ones via /api/tasks/{id}/logs?before_id=
+    logs = await fetch_all(
+        "SELECT id, event_type, payload, encoding, ts FROM task_logs WHERE task_id=? ORDER BY id DESC LIMIT ?",
+        (task_id, LOG_PAGE_SIZE + 1),
+    )
+    truncated = len(logs) > LOG_PAGE_SIZE
+    logs = decode_rows(logs[:LOG_PAGE_SIZE][::-1])
+    return {**dict(task), "logs": logs, "logs_truncated": truncated}
+
+
+@app.get("/api/tasks/{task_id}/logs")
+async def get_task_logs(response: Response, task_id: int, after_id: Optional[int] = None,
+                        before_id: Optional[int] = None, limit: int = LOG_PAGE_SIZE):
+    """Log rows in id order. after_id pages forward, before_id pages back;
+    a full page sets X-Next-After-Id / X-Next-Before-Id."""
+    limit = max(1, min(limit, LOG_PAGE_MAX))
+    if before_id is not None:
+        logs = await fetch_all(
+            "SELECT id, event_type, payload, encoding, ts FROM task_logs WHERE task_id=? AND id<? ORDER BY id DESC LIMIT ?",
+            (task_id, before_id, limit),
+        )
+        logs.reverse()
+        if len(logs) == limit:
+            response.headers["X-Next-Before-Id"] = str(logs[0]["id"])
+        return decode_rows(logs)
     logs = await fetch_all(
-        "SELECT id, event_type, payload, ts FROM task_logs WHERE task_id=? ORDER BY id",
-        (task_id,),
+        "SELECT id, event_type, payload, encoding, ts FROM task_logs WHERE task_id=? AND id>? ORDER BY id LIMIT ?",
+        (task_id, after_id or 0, limit),
     )
-    return {**dict(task), "logs": logs}
+    if len(logs) == limit:
+        response.headers["X-Next-After-Id"] = str(logs[-1]["id"])
+    return decode_rows(logs)
+
+
+@app.get("/api/tasks/{task_id}/diff")
+async def get_task_diff(task_id: int):
+    """Patch of what a completed task changed, against the commit it started from."""
+    row = await fetch_one("SELECT task_id, base, diff, truncated FROM task_diffs WHERE task_id=?", (task_id,))
+    if not row:
+        raise HTTPException(404, "No diff for this task")
+    return {**row, "truncated": bool(row["truncated"])}
+
+
+@app.get("/api/tasks/{task_id}/trace")
+async def get_task_trace(task_id: int):
+    """Span trace as Chrome trace-event JSON (chrome://tracing, Perfetto).
+    Live while a worker holds the task, stored once it is done."""
+    trace = await tracing.load(task_id)
+    if not trace:
+        raise HTTPException(404, "No trace for this task")
+    return tracing.to_chrome(trace)
 
 
 @app.delete("/api/tasks/{task_id}")
@@ -183,7 +250,17 @@ async def cancel_task(task_id: int):
     if not task:
         raise HTTPException(404, "Task not found")
     if task["status"] in ("queued", "running"):
-        await execute("UPDATE tasks SET status='cancelled' WHERE id=?", (task_id,))
+        task_queue.discard(task_id)
+        # Running here: kill the process tree; the runner records the status
+        if task["status"] == "running" and scheduler and await scheduler.cancel(task_id):
+            return {"status": "cancelled"}
+        await execute(
+            "UPDATE tasks SET status='cancelled', finished_at=datetime('now') WHERE id=? AND status IN ('queued', 'running')",
+            (task_id,),
+        )
+        if task["plan_group_id"]:
+            # Steps waiting on this one can go ahead
+            await check_plan_completion(task["plan_group_id"], scheduler.notify if scheduler else None, task_id)
         return {"status": "cancelled"}
     return {"status": task["status"], "message": "Can only cancel queued or running tasks"}
 
@@ -213,7 +290,8 @@ async def delete_worktree(wt_id: int):
 
 @app.post("/api/plan")
 async def create_plan(body: PlanCreate):
-    result = await create_plan_group(body.goal)
+    notify_fn = scheduler.notify if scheduler else None
+    result = await create_plan_group(body.goal, notify_scheduler=notify_fn)
     return result
 
 
@@ -234,6 +312,8 @@ async def discuss_plan(group_id: int, body: DiscussMessage):
     group = await fetch_one("SELECT * FROM plan_groups WHERE id=?", (group_id,))
     if not group:
         raise HTTPException(404, "Plan group not found")
+    if not discuss:
+        raise HTTPException(501, "Plan discussion is not available")
     if group["status"] != "discussing":
         raise HTTPException(400, "Plan is not in discussing state")
     result = await discuss(group_id, body.message)
@@ -245,6 +325,8 @@ async def generate_plan(group_id: int):
     group = await fetch_one("SELECT * FROM plan_groups WHERE id=?", (group_id,))
     if not group:
         raise HTTPException(404, "Plan group not found")
+    if not generate_plan_from_discussion:
+        raise HTTPException(501, "Plan discussion is not available")
     if group["status"] != "discussing":
         raise HTTPException(400, "Plan is not in discussing state")
     task_id = await generate_plan_from_discussion(group_id)
@@ -258,7 +340,7 @@ async def get_discussion(group_id: int):
     group = await fetch_one("SELECT * FROM plan_groups WHERE id=?", (group_id,))
     if not group:
         raise HTTPException(404, "Plan group not found")
-    messages = await get_discussion_messages(group_id)
+    messages = await get_discussion_messages(group_id) if get_discussion_messages else []
     return messages
 
 
@@ -291,8 +373,7 @@ async def get_plan_full(group_id: int):
     group = await fetch_one("SELECT * FROM plan_groups WHERE id=?", (group_id,))
     if not group:
         raise HTTPException(404, "Plan group not found")
-    discussions = await get_discussion_messages(group_id)
-    detail = await get_plan_detail(group_id)
+    discussions = await get_discussion_messages(group_id) if get_discussion_messages else []
     execute_tasks = await fetch_all(
         "SELECT id, prompt, status, mode, created_at, started_at, finished_at, cost_usd FROM tasks WHERE plan_group_id=? AND mode='execute' ORDER BY id",
         (group_id,),
@@ -300,7 +381,7 @@ async def get_plan_full(group_id: int):
     return {
         "group": dict(group),
         "discussions": discussions,
-        "plan_steps": detail.get("plan_steps", []) if detail else [],
+        "plan_steps": parse_plan_steps(group.get("plan_text")),
         "tasks": execute_tasks,
     }
 
@@ -329,19 +410,48 @@ async def add_progress(body: ProgressCreate):
 
 @app.get("/api/status")
 async def get_status():
-    tasks = await fetch_all("SELECT status, COUNT(*) as count FROM tasks GROUP BY status")
-    status_map = {t["status"]: t["count"] for t in tasks}
+    status_map = await task_counts()
     worktrees = await list_worktrees()
     wt_busy = sum(1 for w in worktrees if w["status"] == "busy")
+    wt_recycling = sum(1 for w in worktrees if w["status"] == "recycling")
     return {
         "tasks": status_map,
         "worktrees_total": len(worktrees),
         "worktrees_busy": wt_busy,
+        "worktrees_recycling": wt_recycling,
+        "worktree_pool": get_pool_stats(),
         "max_concurrent": scheduler.max_concurrent if scheduler else 0,
+        "queue_depth": len(task_queue.queue),
+        "autoscaler": autoscaler.status() if autoscaler else None,
         "workers": scheduler.get_workers() if scheduler else [],
+        "agents": agents.list_agents(),
+        "log_ingest": log_ingest.stats(),
+        "db_bytes": db_size_bytes(),
+        "loop_lag": loop_lag.monitor.stats(),
     }
 
 
+metrics.Gauge("ccm_db_bytes", "Database size on disk, incl. WAL").set_function(db_size_bytes)
+metrics.Gauge("ccm_ws_clients", "Connected WebSocket clients").set_function(
+    lambda: len(manager.event_connections) + sum(len(c) for c in manager.task_connections.values())
+)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text format."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/api/changes")
+async def get_changes(since: Optional[int] = None):
+    """Deltas since a version. Without ``since`` only the current version is
+    returned — fetch it before loading full state, then follow /ws/events."""
+    if since is None:
+        return {"version": await current_version(), "reset": False, "changes": []}
+    return await read_since(since)
+
+
 @app.get("/api/workers")
 async def get_workers():
     if not scheduler:
@@ -352,16 +462,46 @@ async def get_workers():
 # --- WebSocket endpoints ---
 
 @app.websocket("/ws/logs/{task_id}")
-async def ws_task_logs(ws: WebSocket, task_id: int):
-    await manager.connect_task(ws, task_id)
+async def ws_task_logs(ws: WebSocket, task_id: int, last_id: Optional[int] = None):
+    # Without last_id only new events are streamed (history comes from HTTP).
+    # With it, rows after last_id are replayed first; live events broadcast
+    # meanwhile are held by the client and de-duplicated by log_id.
+    client = await manager.connect_task(ws, task_id, paused=last_id is not None)
     try:
-        # History is loaded via HTTP GET /api/tasks/{id} — WebSocket only streams new events
+        if last_id is not None:
+            client.resume(await replay_logs(ws, task_id, last_id))
         while True:
             await ws.receive_text()
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect_task(ws, task_id)
 
 
+async def replay_logs(ws: WebSocket, task_id: int, last_id: int) -> int:
+    """Send stored log rows after last_id in the live message format; returns
+    the last id sent."""
+    # Rows appended before we subscribed may still be queued in the log writer
+    await log_ingest.flush()
+    while True:
+        rows = await fetch_all(
+            "SELECT id, event_type, payload, encoding FROM task_logs WHERE task_id=? AND id>? ORDER BY id LIMIT ?",
+            (task_id, last_id, LOG_PAGE_MAX),
+        )
+        for r in decode_rows(rows):
+            # payload is already a JSON document — spliced in, not re-encoded
+            await ws.send_text(encode_event(task_id, r["event_type"], r["payload"], r["id"]))
+        if len(rows) < LOG_PAGE_MAX:
+            return last_id if not rows else rows[-1]["id"]
+        last_id = rows[-1]["id"]
+
+
+@app.websocket("/ws/agent")
+async def ws_agent(ws: WebSocket):
+    # Remote worker agents (worker_agent.py); the session lasts until the agent is lost
+    await agents.serve(ws, scheduler)
+
+
 @app.websocket("/ws/events")
 async def ws_events(ws: WebSocket):
     await manager.connect_events(ws)
@@ -376,8 +516,8 @@ async def ws_events(ws: WebSocket):
 
 original_broadcast = manager.broadcast
 
-async def enhanced_broadcast(task_id: int, event_type: str, payload: dict):
-    await original_broadcast(task_id, event_type, payload)
+async def enhanced_broadcast(task_id: int, event_type: str, payload, log_id: Optional[int] = None):
+    await original_broadcast(task_id, event_type, payload, log_id=log_id)
 
     # Note: plan mode completion is handled in ralph_loop._run_and_release
     # AFTER result_text is saved to DB. Do NOT handle it here — result_text
@@ -0,0 +1,97 @@
+"""Elastic worktree pool — grows and shrinks worktrees + worker slots with queue depth."""
+
+from typing import Optional
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import task_queue
+from worktree import add_worktrees, retire_idle, count_worktrees
+
+logger = logging.getLogger(__name__)
+
+SCALE_INTERVAL = float(os.environ.get("CCM_SCALE_INTERVAL", "5"))
+# Scale up when this many tasks are queued beyond the idle slots...
+SCALE_UP_DEPTH = int(os.environ.get("CCM_SCALE_UP_DEPTH", "2"))
+# ...or when the oldest queued task has waited this long (seconds)
+SCALE_UP_WAIT = float(os.environ.get("CCM_SCALE_UP_WAIT", "30"))
+SCALE_STEP = int(os.environ.get("CCM_SCALE_STEP", "4"))
+# Idle worktrees above the minimum are removed after this many seconds
+IDLE_TTL = float(os.environ.get("CCM_IDLE_TTL", "600"))
+
+
+class PoolAutoscaler:
+    """Periodically compares queue pressure with pool size and resizes both
+    the worktree pool and the scheduler's worker slots between min and max."""
+
+    def __init__(self, scheduler, min_size: int, max_size: int):
+        self.scheduler = scheduler
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = 0
+        self.decisions = deque(maxlen=20)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Autoscaler started (min={self.min_size}, max={self.max_size})")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> dict:
+        return {
+            "min": self.min_size,
+            "max": self.max_size,
+            "size": self.size,
+            "queue_depth": len(task_queue.queue),
+            "oldest_wait_s": round(task_queue.queue.oldest_wait(), 1),
+            "idle_workers": self.scheduler.idle_count(),
+            "decisions": list(self.decisions),
+        }
+
+    async def _run(self):
+        self.size = await count_worktrees()
+        self.scheduler.resize(self.size)
+        while True:
+            try:
+                await self.evaluate()
+            except Exception:
+                logger.exception("Autoscaler evaluation failed")
+            await asyncio.sleep(SCALE_INTERVAL)
+
+    async def evaluate(self):
+        depth = len(task_queue.queue)
+        wait = task_queue.queue.oldest_wait()
+        backlog = depth - self.scheduler.idle_count()
+
+        if self.size < self.min_size:
+            await self._grow(self.min_size - self.size, "below minimum")
+        elif backlog > 0 and self.size < self.max_size and (backlog >= SCALE_UP_DEPTH or wait >= SCALE_UP_WAIT):
+            reason = f"queue depth {depth}, oldest wait {wait:.0f}s"
+            await self._grow(min(backlog, SCALE_STEP, self.max_size - self.size), reason)
+        elif depth == 0 and self.size > self.min_size:
+            removed = await retire_idle(self.size - self.min_size, IDLE_TTL)
+            if removed:
+                self._apply(self.size - len(removed), f"idle > {IDLE_TTL:.0f}s: {', '.join(removed)}")
+
+    async def _grow(self, count: int, reason: str):
+        created = await add_worktrees(count)
+        if created:
+            self._apply(self.size + len(created), reason)
+
+    def _apply(self, new_size: int, reason: str):
+        old = self.size
+        self.size = new_size
+        self.scheduler.resize(new_size)
+        action = "scale_up" if new_size > old else "scale_down"
+        self.decisions.append({"ts": time.time(), "action": action, "from": old, "to": new_size, "reason": reason})
+        logger.info(f"Autoscaler {action}: {old} -> {new_size} ({reason})")
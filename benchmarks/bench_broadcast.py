@@ -0,0 +1,99 @@
+"""
+Load test: log ingest throughput with slow WebSocket clients attached.
+
+Usage:
+    python benchmarks/bench_broadcast.py [clients] [events] [send_delay_ms]
+
+A producer broadcasts stream-json-sized events as fast as it can while
+N fake clients each take send_delay_ms per send (a phone on a bad link).
+"before" is the old inline loop that awaits every send in turn; "after"
+is ws_manager.ConnectionManager with per-client queues.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ws_manager import ConnectionManager  # noqa: E402
+
+logging.getLogger("ws_manager").setLevel(logging.ERROR)  # one line per dropped client
+
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+EVENTS = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+DELAY = (float(sys.argv[3]) if len(sys.argv) > 3 else 50) / 1000
+
+PAYLOAD = {"type": "assistant", "message": {"content": [{"type": "text", "text": "x" * 400}]}}
+
+
+class SlowSocket:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, msg: str):
+        await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+class LegacyManager:
+    """The pre-queue broadcast: serialize, then await each send in turn."""
+
+    def __init__(self):
+        self.event_connections = []
+
+    async def connect_events(self, ws):
+        await ws.accept()
+        self.event_connections.append(ws)
+
+    async def broadcast(self, task_id, event_type, payload):
+        msg = json.dumps({"task_id": task_id, "event_type": event_type, "payload": payload}, ensure_ascii=False)
+        for ws in list(self.event_connections):
+            try:
+                await ws.send_text(msg)
+            except Exception:
+                self.event_connections.remove(ws)
+
+
+async def run(label: str, manager, clients: int, events: int) -> float:
+    for _ in range(clients):
+        await manager.connect_events(SlowSocket(DELAY))
+    start = time.perf_counter()
+    for i in range(events):
+        await manager.broadcast(1, "assistant", PAYLOAD)
+        if i % 50 == 0:
+            await asyncio.sleep(0)  # let writers run, as the real event loop would
+    elapsed = time.perf_counter() - start
+    rate = events / elapsed
+    print(f"  {label:<28} {rate:10.1f} events/sec")
+    return rate
+
+
+async def main():
+    print(f"\n{CLIENTS} clients x {DELAY * 1000:.0f} ms per send\n")
+    await run("queued, no clients", ConnectionManager(), 0, EVENTS)
+    m = ConnectionManager()
+    await run(f"queued, {CLIENTS} slow clients", m, CLIENTS, EVENTS)
+    connected = len(m.event_connections)
+    print(f"    clients still connected: {connected}/{CLIENTS} (slow ones are dropped once {EVENTS} > queue size)")
+    for c in m.event_connections:
+        c.close()
+    # The legacy loop is far too slow for the full run — sample it
+    sample = max(1, min(EVENTS, 20))
+    await run(f"legacy, {CLIENTS} slow clients", LegacyManager(), CLIENTS, sample)
+    await asyncio.sleep(0.1)
+    print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
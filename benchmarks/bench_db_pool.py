@@ -0,0 +1,70 @@
+"""
+Benchmark: open-per-query DB helpers vs the persistent connection pool.
+
+Usage:
+    python benchmarks/bench_db_pool.py [ops] [concurrency]
+
+Runs the same mixed workload (inserts, point reads, list reads) against a
+throwaway database twice — once with the pool closed (every helper call
+opens its own connection, the old behaviour) and once with it open — and
+prints ops/sec for each.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+OPS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+
+async def workload(n: int):
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            await db.execute(
+                "INSERT INTO task_logs (task_id, event_type, payload) VALUES (?, ?, ?)",
+                (1, "assistant", '{"type":"assistant"}'),
+            )
+        elif kind == 1:
+            await db.fetch_one("SELECT * FROM tasks WHERE id=?", (1,))
+        elif kind == 2:
+            await db.fetch_all("SELECT id, status FROM tasks ORDER BY id DESC LIMIT 20")
+        else:
+            await db.execute("UPDATE tasks SET cost_usd=cost_usd+0.001 WHERE id=?", (1,))
+
+
+async def run(label: str, pooled: bool) -> float:
+    if pooled:
+        await db.open_pool()
+    per_worker = OPS // CONCURRENCY
+    start = time.perf_counter()
+    await asyncio.gather(*(workload(per_worker) for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+    if pooled:
+        await db.close_pool()
+    rate = per_worker * CONCURRENCY / elapsed
+    print(f"  {label:<16} {rate:10.0f} ops/sec  ({elapsed:.2f}s)")
+    return rate
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        await db.execute("INSERT INTO tasks (prompt) VALUES ('bench')")
+
+        print(f"\n{OPS} ops, {CONCURRENCY} concurrent callers\n")
+        legacy = await run("open-per-query", pooled=False)
+        pooled = await run("pooled", pooled=True)
+        print(f"\n  speedup: {pooled / legacy:.1f}x\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
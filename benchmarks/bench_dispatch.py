@@ -0,0 +1,91 @@
+"""
+Benchmark: dispatch cost with 10k queued tasks — DB polling vs in-memory queue.
+
+Usage:
+    python benchmarks/bench_dispatch.py [queued] [dispatches]
+
+"before" replays the old _loop statements per dispatch (SELECT next queued
+task with no supporting index, then UPDATE status). "after" uses the
+TaskQueue heap plus the single conditional UPDATE ... RETURNING claim.
+Reports queue-to-start latency per dispatch and the DB statements issued.
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import task_queue  # noqa: E402
+
+QUEUED = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+DISPATCHES = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+stats = {"reads": 0, "writes": 0}
+
+
+async def seed_tasks():
+    await db.execute("DELETE FROM tasks")
+    rows = [(f"task {i}", i % 5) for i in range(QUEUED)]
+    await db.execute_many("INSERT INTO tasks (prompt, priority) VALUES (?, ?)", rows)
+
+
+async def dispatch_before():
+    stats["reads"] += 1
+    row = await db.fetch_one(
+        "SELECT * FROM tasks WHERE status='queued' ORDER BY priority DESC, id ASC LIMIT 1"
+    )
+    stats["writes"] += 1
+    await db.execute("UPDATE tasks SET status='running' WHERE id=?", (row["id"],))
+
+
+async def dispatch_after():
+    task_id = task_queue.queue.pop()
+    stats["writes"] += 1
+    await db.execute_fetch_one(
+        "UPDATE tasks SET status='running' WHERE id=? AND status='queued' RETURNING id, prompt, cwd",
+        (task_id,),
+    )
+
+
+async def run(label: str, dispatch) -> None:
+    stats["reads"] = stats["writes"] = 0
+    samples = []
+    for _ in range(DISPATCHES):
+        start = time.perf_counter()
+        await dispatch()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1]
+    print(f"  {label:<7} mean {statistics.mean(samples):7.3f} ms  p99 {p99:7.3f} ms  "
+          f"reads/dispatch {stats['reads'] / DISPATCHES:.1f}  writes/dispatch {stats['writes'] / DISPATCHES:.1f}")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        await db.open_pool()
+        print(f"\n{QUEUED} queued tasks, {DISPATCHES} dispatches\n")
+
+        await db.execute("DROP INDEX IF EXISTS idx_tasks_queue")
+        await seed_tasks()
+        await run("before", dispatch_before)
+
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks(status, priority DESC, id)")
+        await seed_tasks()
+        start = time.perf_counter()
+        await task_queue.queue.seed()
+        print(f"  (startup seed / consistency sweep: {(time.perf_counter() - start) * 1000:.1f} ms)")
+        await run("after", dispatch_after)
+
+        await db.close_pool()
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
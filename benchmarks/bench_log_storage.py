@@ -0,0 +1,110 @@
+"""
+Benchmark: task_logs bytes per task — store everything vs log_policy.
+
+Usage:
+    python benchmarks/bench_log_storage.py [tasks]
+
+Each synthetic task streams what a typical claude run does: an init event,
+assistant turns sent as content_block_start / ~40 text deltas / stop with
+message_start/delta/stop around them, tool calls with multi-KB file reads
+in their results, and a final result event.
+
+"before" stores every event as its own json.dumps row (the old runner);
+"after" feeds the same events through log_policy.TaskLog. "after retention"
+then ages every task out with purge_expired(). Reports rows and stored
+payload bytes per task.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import log_policy  # noqa: E402
+from runner import classify_event  # noqa: E402
+
+TASKS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+TURNS = 20
+
+rng = random.Random(7)
+WORDS = ("the function returns early when the cache is cold so we add a guard and "
+         "update the test to cover the retry path before merging").split()
+SOURCE = "\n".join(f"    def handler_{i}(self, request):\n        return self.dispatch(request, {i})" for i in range(60))
+
+
+def transcript(task_id: int):
+    yield {"type": "system", "subtype": "init", "session_id": f"s{task_id}", "tools": ["Bash", "Read", "Edit"] * 10}
+    for turn in range(TURNS):
+        yield {"type": "message_start", "message": {"id": f"m{turn}", "role": "assistant", "usage": {"input_tokens": 1200}}}
+        yield {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+        for _ in range(40):
+            yield {"type": "content_block_delta", "index": 0,
+                   "delta": {"type": "text_delta", "text": " ".join(rng.sample(WORDS, 3)) + " "}}
+        yield {"type": "content_block_stop", "index": 0}
+        yield {"type": "message_delta", "delta": {"stop_reason": "tool_use"}, "usage": {"output_tokens": 180}}
+        yield {"type": "message_stop"}
+        yield {"type": "tool_use", "name": "Read", "input": {"file_path": f"src/module_{turn}.py"}}
+        yield {"type": "tool_result", "content": SOURCE}
+    yield {"type": "result", "result": "Done: added the guard and a regression test.", "cost_usd": 0.42,
+           "usage": {"input_tokens": 24000, "output_tokens": 3600}}
+
+
+async def store_before(task_id: int):
+    rows = []
+    for data in transcript(task_id):
+        rows.append((task_id, classify_event(data), json.dumps(data, ensure_ascii=False), None))
+    await db.execute_many("INSERT INTO task_logs (task_id, event_type, payload, encoding) VALUES (?, ?, ?, ?)", rows)
+
+
+async def store_after(task_id: int):
+    log = log_policy.TaskLog(task_id)
+    rows = []
+    for data in transcript(task_id):
+        for event_type, payload, encoding in log.feed(classify_event(data), data["type"], json.dumps(data), data):
+            rows.append((task_id, event_type, payload, encoding))
+    for event_type, payload, encoding in log.finish():
+        rows.append((task_id, event_type, payload, encoding))
+    await db.execute_many("INSERT INTO task_logs (task_id, event_type, payload, encoding) VALUES (?, ?, ?, ?)", rows)
+
+
+async def report(label: str):
+    row = await db.fetch_one("SELECT COUNT(*) AS n, COALESCE(SUM(length(payload)), 0) AS bytes FROM task_logs")
+    print(f"  {label:<16} rows/task {row['n'] / TASKS:6.1f}  payload bytes/task {row['bytes'] / TASKS:9.0f}")
+
+
+async def run(label: str, store, age: bool = False):
+    await db.execute("DELETE FROM task_logs")
+    await db.execute("DELETE FROM tasks")
+    ids = []
+    for i in range(TASKS):
+        ids.append(await db.execute_returning(
+            "INSERT INTO tasks (prompt, status, finished_at) VALUES (?, 'completed', datetime('now', '-30 days'))",
+            (f"task {i}",),
+        ))
+    for task_id in ids:
+        await store(task_id)
+    await report(label)
+    if age:
+        removed = await log_policy.purge_expired(days=14)
+        await report("after retention")
+        print(f"  (retention removed {removed} rows, kept result/error rows)")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        codec = "zstd" if log_policy.zstandard else "zlib"
+        print(f"\n{TASKS} tasks x {TURNS} turns, compression {codec} >= {log_policy.COMPRESS_MIN} B\n")
+        await run("before", store_before)
+        await run("after", store_after, age=True)
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+Benchmark: cost of metrics recording on the hot paths.
+
+Usage:
+    python benchmarks/bench_metrics.py [ops]
+
+Times the raw recording calls (counter inc, labeled histogram observe,
+what db helpers do per query), then pooled fetch_one calls with
+instrumentation on and with db._observe stubbed out, in alternating rounds.
+The end-to-end difference is usually inside run-to-run noise, so the
+per-query cost is also shown as a share of one fetch_one. Last, how long
+one /metrics render takes.
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import metrics  # noqa: E402
+
+OPS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+REPEAT = 5
+
+
+def per_op(fn, n: int = 200000) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn(n)
+        best = min(best, time.perf_counter() - start)
+    return best / n * 1e9
+
+
+def recording():
+    counter = metrics.Counter("bench_counter_total", "bench")
+    hist = metrics.Histogram("bench_seconds", "bench", ["op"])
+    query = "SELECT id, status FROM tasks WHERE id=?"
+
+    def inc(n):
+        for _ in range(n):
+            counter.inc()
+
+    def observe(n):
+        for _ in range(n):
+            hist.labels("select").observe(0.0004)
+
+    def db_observe(n):
+        start = time.perf_counter()
+        for _ in range(n):
+            db._observe(query, start)
+
+    print(f"  counter.inc()                    {per_op(inc):7.0f} ns")
+    print(f"  histogram.labels().observe()     {per_op(observe):7.0f} ns")
+    cost = per_op(db_observe)
+    print(f"  db._observe() per query          {cost:7.0f} ns")
+    return cost
+
+
+async def fetch_round() -> float:
+    start = time.perf_counter()
+    for i in range(OPS):
+        await db.fetch_one("SELECT id, status FROM tasks WHERE id=?", (i % 100 + 1,))
+    return OPS / (time.perf_counter() - start)
+
+
+async def fetch_rates():
+    """Alternate instrumented and stubbed rounds so drift hits both equally."""
+    observe = db._observe
+    rates = {"uninstrumented": [], "instrumented": []}
+    for _ in range(REPEAT):
+        db._observe = lambda query, start: None
+        rates["uninstrumented"].append(await fetch_round())
+        db._observe = observe
+        rates["instrumented"].append(await fetch_round())
+    for label, samples in rates.items():
+        rate = statistics.median(samples)
+        print(f"  fetch_one {label:<14} {rate:9.0f} ops/s  ({1e6 / rate:6.1f} us/op)")
+    return statistics.median(rates["uninstrumented"]), statistics.median(rates["instrumented"])
+
+
+async def main():
+    print(f"\nrecording cost (best of {REPEAT})\n")
+    observe_ns = recording()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        await db.open_pool()
+        await db.execute_many("INSERT INTO tasks (prompt) VALUES (?)", [(f"task {i}",) for i in range(100)])
+
+        print(f"\npooled fetch_one x {OPS}\n")
+        off, on = await fetch_rates()
+        print(f"\n  measured difference {(1 / on - 1 / off) * 1e9:+.0f} ns/op ({off / on - 1:+.1%})")
+        print(f"  db._observe share of a fetch_one: {observe_ns / (1e9 / off):.2%}")
+
+        start = time.perf_counter()
+        text = metrics.render()
+        print(f"\n/metrics render: {(time.perf_counter() - start) * 1000:.2f} ms, {len(text)} bytes\n")
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
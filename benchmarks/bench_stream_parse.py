@@ -0,0 +1,114 @@
+"""
+Benchmark: runner per-line cost — decode/re-encode vs prefix-scan fast path.
+
+Usage:
+    python benchmarks/bench_stream_parse.py [transcript.jsonl]
+
+Without an argument a claude-style stream-json transcript (system init,
+assistant messages with text/tool_use blocks, user tool_result messages
+carrying file contents, final result) of a few MB is generated. Pass a
+recorded ``claude -p --output-format stream-json --verbose`` transcript to
+measure a real one.
+
+"before" is the old per-line work: json.loads, classify_event, json.dumps
+for storage, then json.dumps of the broadcast envelope. "after" is
+runner.parse_line + classify_type + ws_manager.encode_event: only result /
+error / content-block events are decoded, everything else is stored and
+forwarded as the original text. Storage policy and DB writes are excluded
+from both.
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from runner import classify_event, classify_type, parse_line  # noqa: E402
+from ws_manager import encode_event  # noqa: E402
+
+REPEAT = 5
+TURNS = 300
+
+rng = random.Random(3)
+
+
+def synthesize(path: str):
+    session = "0c4e6a52-6d4b-4a0f-9a0e-5f3b1c2d7e88"
+    source = "\n".join(f"def handler_{i}(request):\n    return dispatch(request, {i})  # 处理请求" for i in range(200))
+    with open(path, "w", encoding="utf-8") as f:
+        def emit(obj):
+            f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+        emit({"type": "system", "subtype": "init", "cwd": "/repo", "session_id": session,
+              "tools": ["Task", "Bash", "Glob", "Grep", "Read", "Edit", "Write"], "model": "claude"})
+        for turn in range(TURNS):
+            text = " ".join(rng.choice(["checking", "the", "handler", "cache", "retry", "test"]) for _ in range(60))
+            emit({"type": "assistant", "message": {
+                "id": f"msg_{turn}", "type": "message", "role": "assistant", "model": "claude",
+                "content": [{"type": "text", "text": text},
+                            {"type": "tool_use", "id": f"toolu_{turn}", "name": "Read",
+                             "input": {"file_path": f"/repo/src/module_{turn}.py"}}],
+                "usage": {"input_tokens": 1500 + turn, "output_tokens": 120}}, "session_id": session})
+            emit({"type": "user", "message": {"role": "user", "content": [
+                {"tool_use_id": f"toolu_{turn}", "type": "tool_result", "content": source[: rng.randint(4000, 12000)]}]},
+                "session_id": session})
+        emit({"type": "result", "subtype": "success", "is_error": False, "duration_ms": 812345,
+              "num_turns": TURNS, "result": "Done.", "session_id": session, "total_cost_usd": 1.23,
+              "usage": {"input_tokens": 450000, "output_tokens": 36000}})
+
+
+def before(lines):
+    for line in lines:
+        data = json.loads(line)
+        event_type = classify_event(data)
+        stored = json.dumps(data, ensure_ascii=False)
+        msg = json.dumps({"task_id": 1, "event_type": event_type, "payload": data, "log_id": 1}, ensure_ascii=False)
+    return stored, msg
+
+
+def after(lines):
+    for line in lines:
+        etype, text, data = parse_line(line)
+        event_type = classify_type(etype)
+        stored = text
+        msg = encode_event(1, event_type, text, 1)
+    return stored, msg
+
+
+def bench(label: str, fn, lines, size: int):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn(lines)
+        best = min(best, time.perf_counter() - start)
+    print(f"  {label:<7} {best * 1000:8.1f} ms  {best / len(lines) * 1e6:7.1f} us/line  {size / best / 1e6:7.1f} MB/s")
+
+
+def main():
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+        lines = [l.strip() for l in open(path, encoding="utf-8") if l.strip()]
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "transcript.jsonl")
+            synthesize(path)
+            lines = [l.strip() for l in open(path, encoding="utf-8") if l.strip()]
+    size = sum(len(l.encode("utf-8")) for l in lines)
+    fast = sum(1 for l in lines if parse_line(l)[2] is None)
+    print(f"\n{len(lines)} lines, {size / 1e6:.1f} MB, {fast / len(lines):.0%} on the prefix fast path\n")
+
+    # Both paths must produce the same messages for clients
+    for line in lines[:50]:
+        etype, text, data = parse_line(line)
+        assert json.loads(encode_event(1, classify_type(etype), text, 1))["payload"] == json.loads(line)
+
+    bench("before", before, lines, size)
+    bench("after", after, lines, size)
+    print()
+
+
+if __name__ == "__main__":
+    main()
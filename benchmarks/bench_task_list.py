@@ -0,0 +1,111 @@
+"""
+Benchmark: GET /api/tasks over a large tasks table — full list vs keyset page.
+
+Usage:
+    python benchmarks/bench_task_list.py [rows]
+
+Fills a throwaway DB with synthetic tasks whose prompts carry an injected
+experience block (~2 KB each, like real ones), then times the handler's
+queries plus JSON encoding. "before" is the old unbounded SELECT with
+Python-side truncation; "after" is one keyset page with substr() projection,
+first page, a deep page and a status-filtered page.
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+PAGE = 100
+REPEAT = 5
+
+COLUMNS = "status, mode, priority, worktree_id, plan_group_id, created_at, started_at, finished_at, cost_usd"
+EXPERIENCE = "## Relevant past experience\n" + "- fixed flaky test by pinning the clock\n" * 50
+STATUSES = ["completed"] * 8 + ["failed", "cancelled"]
+
+
+async def seed():
+    groups = [(f"goal {g}", "completed") for g in range(ROWS // 5 + 1)]
+    await db.execute_many("INSERT INTO plan_groups (goal, status) VALUES (?, ?)", groups)
+    rows = []
+    for i in range(ROWS):
+        status = STATUSES[i % len(STATUSES)]
+        group = i // 5 + 1 if i % 7 == 0 else None
+        rows.append((f"{EXPERIENCE}\n\n---\n\nTask {i}: refactor module {i % 300}", status, group))
+    # A handful of live tasks at the tail, like a real queue
+    rows += [(f"queued task {i}", "queued", None) for i in range(20)]
+    await db.execute_many("INSERT INTO tasks (prompt, status, plan_group_id) VALUES (?, ?, ?)", rows)
+
+
+async def list_before(status=None):
+    if status:
+        tasks = await db.fetch_all(f"SELECT id, prompt, {COLUMNS} FROM tasks WHERE status=? ORDER BY id DESC", (status,))
+    else:
+        tasks = await db.fetch_all(f"SELECT id, prompt, {COLUMNS} FROM tasks ORDER BY id DESC")
+    for t in tasks:
+        t["prompt_short"] = t["prompt"][:100]
+    return tasks
+
+
+async def list_after(status=None, before_id=None):
+    where, params = [], []
+    if status:
+        where.append("status=?")
+        params.append(status)
+    if before_id is not None:
+        where.append("id<?")
+        params.append(before_id)
+    clause = f"WHERE {' AND '.join(where)} " if where else ""
+    return await db.fetch_all(
+        f"SELECT id, substr(prompt, 1, 100) AS prompt_short, {COLUMNS} FROM tasks {clause}ORDER BY id DESC LIMIT ?",
+        (*params, PAGE),
+    )
+
+
+async def run(label: str, fn, *args) -> None:
+    samples = []
+    size = 0
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        body = json.dumps(await fn(*args))
+        samples.append((time.perf_counter() - start) * 1000)
+        size = len(body)
+    print(f"  {label:<26} median {statistics.median(samples):9.2f} ms  payload {size / 1024:10.1f} KB")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        await db.init_db()
+        await db.open_pool()
+        await seed()
+        print(f"\n{ROWS} tasks, page size {PAGE}\n")
+
+        await run("before: all", list_before)
+        await run("before: status=queued", list_before, "queued")
+
+        await run("after: first page", list_after)
+        await run("after: page at id 50%", list_after, None, ROWS // 2)
+        await run("after: status=queued", list_after, "queued")
+        await run("after: status=failed deep", list_after, "failed", ROWS // 2)
+
+        plan = await db.fetch_all(
+            "EXPLAIN QUERY PLAN SELECT id FROM tasks WHERE status=? AND id<? ORDER BY id DESC LIMIT ?",
+            ("failed", ROWS // 2, PAGE),
+        )
+        print(f"\n  plan: {'; '.join(r['detail'] for r in plan)}")
+
+        await db.close_pool()
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Offline evaluation: experience retrieval latency and hit quality.
+
+Usage:
+    python benchmarks/eval_experience.py [entries] [queries]
+
+Builds a throwaway DB with synthetic progress entries spread over a few
+hundred topics (each topic has its own vocabulary; every entry also carries
+shared filler words), then issues task-like prompts about a known topic.
+A returned note is a hit when it belongs to the prompt's topic.
+
+Compares the old behaviour (last 3 entries), the FTS5 BM25 + recency lookup,
+and the keyword fallback used when FTS5 is unavailable.
+"""
+
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import progress  # noqa: E402
+
+ENTRIES = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+TOPICS = 300
+TOP_K = 3
+
+FILLER = ("fixed updated refactored module function test config handler service client "
+          "request response error path build deploy script cleanup review").split()
+
+rng = random.Random(42)
+
+
+def topic_words(topic: int) -> list:
+    # Five distinctive words per topic, e.g. "kafka17", "retry17"...
+    stems = ["alpha", "kafka", "oauth", "cache", "parser", "socket", "migrate", "thumbnail", "ledger", "cron"]
+    return [f"{stems[(topic + i) % len(stems)]}{topic}" for i in range(5)]
+
+
+async def seed():
+    rows = []
+    for i in range(ENTRIES):
+        topic = rng.randrange(TOPICS)
+        words = topic_words(topic)
+        summary = f"Task #{i}: {' '.join(rng.sample(FILLER, 4))} {' '.join(rng.sample(words, 2))}"
+        lessons = f"{' '.join(rng.sample(FILLER, 6))} {rng.choice(words)}"
+        age = rng.uniform(0, 365)
+        rows.append((i, summary, lessons, f"t{topic}", f"-{age:.3f} days"))
+    await db.execute_many(
+        "INSERT INTO progress_entries (task_id, summary, lessons, tags, created_at) "
+        "VALUES (NULL, ?, ?, ?, datetime('now', ?))",
+        [(s, l, t, a) for _, s, l, t, a in rows],
+    )
+
+
+def make_query(topic: int) -> str:
+    words = topic_words(topic)
+    return f"Please {rng.choice(FILLER)} the {rng.choice(words)} {rng.choice(FILLER)} so that {rng.choice(words)} works"
+
+
+async def latest_three(_prompt: str) -> list:
+    return await db.fetch_all("SELECT summary, lessons, tags FROM progress_entries ORDER BY id DESC LIMIT ?", (TOP_K,))
+
+
+async def ranked(prompt: str) -> list:
+    return (await progress.search_experience(prompt))[:TOP_K]
+
+
+async def evaluate(label: str, lookup, queries) -> None:
+    samples, precision, hit_any = [], [], 0
+    for topic, prompt in queries:
+        start = time.perf_counter()
+        rows = await lookup(prompt)
+        samples.append((time.perf_counter() - start) * 1000)
+        good = sum(1 for r in rows if r["tags"] == f"t{topic}")
+        precision.append(good / TOP_K)
+        hit_any += 1 if good else 0
+    samples.sort()
+    p99 = samples[max(int(len(samples) * 0.99) - 1, 0)]
+    print(f"  {label:<18} p50 {statistics.median(samples):7.2f} ms  p99 {p99:7.2f} ms  "
+          f"precision@{TOP_K} {statistics.mean(precision):.2f}  hit-rate {hit_any / len(queries):.2f}")
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "eval.db")
+        await db.init_db()
+        await db.open_pool()
+        start = time.perf_counter()
+        await seed()
+        print(f"\n{ENTRIES} entries over {TOPICS} topics, {QUERIES} queries "
+              f"(seed incl. FTS triggers: {time.perf_counter() - start:.1f}s, fts5={db.HAS_FTS5})\n")
+
+        queries = [(t, make_query(t)) for t in (rng.randrange(TOPICS) for _ in range(QUERIES))]
+        await evaluate("latest 3 (old)", latest_three, queries)
+        if db.HAS_FTS5:
+            await evaluate("fts5 bm25+recency", ranked, queries)
+        db.HAS_FTS5, has_fts = False, db.HAS_FTS5
+        await evaluate("keyword fallback", ranked, queries)
+        db.HAS_FTS5 = has_fts
+
+        sample = await progress.get_relevant_experience(queries[0][1])
+        print(f"\n  injected for {queries[0][1]!r}: ~{len(sample) // 4} tokens")
+
+        await db.close_pool()
+        print()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,323 @@
+"""
+Load test: the whole server (API, scheduler, runner, log ingest) under
+thousands of tasks, with tools/fake_claude.py standing in for claude.
+
+Usage:
+    python benchmarks/load_test.py [--tasks 2000] [--plans 20] [--workers 8]
+                                   [--rate 200] [--turns 5] [--size 2000] [--fail 0.02]
+                                   [--out load.json]
+    python benchmarks/load_test.py --url http://127.0.0.1:9050 ...   # existing server
+
+By default a server is started on a free port with a throwaway DB, git repo
+and PROGRESS.md, and CCM_CLAUDE_CMD pointing at the fake CLI (the --rate /
+--turns / --size / --fail / --duration options become its CCM_FAKE_*
+settings). With --url the server is used as it is configured.
+
+Submits the tasks (and plans, approved as soon as they are ready for
+review), waits until everything has finished, then reports throughput,
+queue-to-start latency percentiles, plan wall-clock time, log ingest rate,
+DB growth and event-loop lag (sampled from /api/status every second). The
+report is printed and written as JSON to --out, so runs can be compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CLAUDE = os.path.join(ROOT, "tools", "fake_claude.py")
+TERMINAL = ("completed", "failed", "cancelled")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    p.add_argument("--url", help="use a running server instead of starting one")
+    p.add_argument("--tasks", type=int, default=2000)
+    p.add_argument("--plans", type=int, default=20)
+    p.add_argument("--workers", type=int, default=8, help="CCM_MAX_CONCURRENT / CCM_POOL_SIZE of the spawned server")
+    p.add_argument("--rate", type=float, default=200, help="fake claude events per second")
+    p.add_argument("--turns", type=int, default=5, help="fake claude assistant turns per task")
+    p.add_argument("--size", type=int, default=2000, help="fake claude tool_result bytes")
+    p.add_argument("--fail", type=float, default=0.0, help="fraction of fake runs that fail")
+    p.add_argument("--duration", type=float, help="fake claude seconds per run (overrides --rate)")
+    p.add_argument("--timeout", type=float, default=3600, help="give up waiting after this many seconds")
+    p.add_argument("--out", default="load_test.json")
+    return p.parse_args()
+
+
+def pct(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 2)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """Minimal JSON client on urllib, so the driver needs nothing beyond the stdlib."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def request(self, method: str, path: str, body=None, params=None, timeout: float = 30):
+        if params:
+            path += "?" + "&".join(f"{k}={v}" for k, v in params.items())
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(req, timeout=timeout) as r:
+            return json.loads(r.read() or b"null"), r.headers
+
+    def get(self, path: str, **kw):
+        return self.request("GET", path, **kw)[0]
+
+    def post(self, path: str, body=None):
+        return self.request("POST", path, body)[0]
+
+
+def parse_ts(value):
+    """started_at is an ISO timestamp (UTC); other columns are SQLite datetime()."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace(" ", "T"))
+
+
+class Server:
+    """A throwaway server: temp dir with its own DB, git repo and PROGRESS.md."""
+
+    def __init__(self, args):
+        self.tmp = tempfile.mkdtemp(prefix="ccm-load-")
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        repo = os.path.join(self.tmp, "repo")
+        os.makedirs(repo)
+        for cmd in (["init", "-q"], ["commit", "-q", "--allow-empty", "-m", "init"]):
+            subprocess.run(["git", "-c", "user.name=ccm", "-c", "user.email=ccm@localhost"] + cmd,
+                           cwd=repo, check=True)
+        env = dict(os.environ)
+        env.update({
+            "CCM_DB_PATH": os.path.join(self.tmp, "ccm.db"),
+            "CCM_REPO_DIR": repo,
+            "CCM_PROGRESS_FILE": os.path.join(self.tmp, "PROGRESS.md"),
+            "CCM_CLAUDE_CMD": subprocess.list2cmdline([sys.executable, FAKE_CLAUDE]) if sys.platform == "win32"
+            else shlex.join([sys.executable, FAKE_CLAUDE]),
+            "CCM_MAX_CONCURRENT": str(args.workers),
+            "CCM_POOL_SIZE": str(args.workers),
+            "CCM_FAKE_RATE": str(args.rate),
+            "CCM_FAKE_TURNS": str(args.turns),
+            "CCM_FAKE_SIZE": str(args.size),
+            "CCM_FAKE_FAIL": str(args.fail),
+        })
+        if args.duration is not None:
+            env["CCM_FAKE_DURATION"] = str(args.duration)
+        self.log = open(os.path.join(self.tmp, "server.log"), "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+            start_new_session=sys.platform != "win32",
+        )
+
+    def wait_ready(self, timeout: float = 60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc.poll() is not None:
+                raise SystemExit(f"server exited with {self.proc.returncode}, see {self.log.name}")
+            try:
+                Client(self.url).get("/api/status", timeout=2)
+                return
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            time.sleep(0.2)
+        raise SystemExit(f"server not ready after {timeout}s, see {self.log.name}")
+
+    def stop(self):
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.log.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+class Sampler(threading.Thread):
+    """Polls /api/status once a second for DB size, ingest counters and loop lag."""
+
+    def __init__(self, client: Client):
+        super().__init__(daemon=True)
+        self.client = client
+        self.samples = []
+        self.rtt_ms = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                s = self.client.get("/api/status", timeout=10)
+                self.rtt_ms.append((time.perf_counter() - start) * 1000)
+                self.samples.append({"t": time.time(), **{k: s.get(k) for k in (
+                    "tasks", "queue_depth", "db_bytes", "log_ingest", "loop_lag")}})
+            except (urllib.error.URLError, ConnectionError):
+                pass
+            self.stopped.wait(1.0)
+
+
+def submit(client: Client, args):
+    """Queue the tasks and plans. Returns ({task_id: submitted_at}, [plan ids])."""
+    submitted = {}
+    plans = []
+    for i in range(args.plans):
+        data = client.post("/api/plan", {"goal": f"Load test plan {i}: build module {i} with tests"})
+        plans.append(data if isinstance(data, int) else data.get("group_id"))
+    for i in range(args.tasks):
+        at = datetime.utcnow()
+        data = client.post("/api/tasks", {"prompt": f"Load test task {i}: fix the handler in module {i % 97}"})
+        submitted[data["id"]] = at
+    return submitted, plans
+
+
+def wait_done(client: Client, plans, timeout):
+    """Approve plans as they reach review; return when no task is left to run."""
+    pending_plans = set(plans)
+    approved_at = {}
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for gid in list(pending_plans):
+            plan = client.get(f"/api/plan/{gid}")
+            if plan["status"] == "reviewing":
+                approved_at[gid] = datetime.utcnow()
+                client.post(f"/api/plan/{gid}/approve")
+                pending_plans.discard(gid)
+        counts = client.get("/api/status")["tasks"]
+        active = sum(counts.get(s, 0) for s in ("queued", "running", "pending"))
+        if not active and not pending_plans:
+            return approved_at
+        time.sleep(0.5)
+    raise SystemExit(f"timed out after {timeout}s with work still queued")
+
+
+def fetch_tasks(client: Client):
+    tasks, before = [], None
+    while True:
+        params = {"limit": 500}
+        if before is not None:
+            params["before_id"] = before
+        page, headers = client.request("GET", "/api/tasks", params=params)
+        tasks += page
+        before = headers.get("X-Next-Before-Id")
+        if not before:
+            return tasks
+
+
+def report(args, client: Client, submitted, approved_at, sampler, wall):
+    tasks = {t["id"]: t for t in fetch_tasks(client)}
+    mine = [tasks[i] for i in submitted if i in tasks]
+    latency = [
+        (parse_ts(t["started_at"]) - submitted[t["id"]]).total_seconds() * 1000
+        for t in mine if t["started_at"]
+    ]
+    statuses = {}
+    for t in mine:
+        statuses[t["status"]] = statuses.get(t["status"], 0) + 1
+
+    plan_wall = []
+    for gid, at in approved_at.items():
+        steps = [t for t in tasks.values() if t["plan_group_id"] == gid and t["mode"] == "execute"]
+        ends = [parse_ts(t["finished_at"]) for t in steps if t["finished_at"]]
+        if ends:
+            plan_wall.append((max(ends) - at).total_seconds())
+
+    first, last = sampler.samples[0], sampler.samples[-1]
+    span = max(last["t"] - first["t"], 1e-9)
+    rows = last["log_ingest"]["rows_written"] - first["log_ingest"]["rows_written"]
+    finished = sum(1 for t in tasks.values() if t["status"] in TERMINAL)
+    lag_p99 = [s["loop_lag"]["p99_ms"] for s in sampler.samples if s.get("loop_lag")]
+
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "wall_seconds": round(wall, 2),
+        "tasks_finished": finished,
+        "throughput_tasks_per_s": round(finished / wall, 2),
+        "task_status": statuses,
+        "queue_to_start_ms": {
+            "p50": pct(latency, 0.50), "p90": pct(latency, 0.90), "p99": pct(latency, 0.99),
+            "max": round(max(latency), 2) if latency else None,
+        },
+        "plan_wall_seconds": {
+            "count": len(plan_wall), "p50": pct(plan_wall, 0.50),
+            "max": round(max(plan_wall), 2) if plan_wall else None,
+        },
+        "log_ingest": {
+            "rows": rows, "rows_per_s": round(rows / span, 1),
+            "batches": last["log_ingest"]["batches"] - first["log_ingest"]["batches"],
+        },
+        "db_bytes": {
+            "start": first["db_bytes"], "end": last["db_bytes"],
+            "growth_per_task": round((last["db_bytes"] - first["db_bytes"]) / max(finished, 1)),
+        },
+        "loop_lag_ms": {
+            "max": last["loop_lag"]["max_ms"],
+            "p99_of_samples": pct(lag_p99, 0.99),
+            "mean_p50": round(statistics.mean(s["loop_lag"]["p50_ms"] for s in sampler.samples), 2),
+        },
+        "status_rtt_ms": {"p50": pct(sampler.rtt_ms, 0.50), "p99": pct(sampler.rtt_ms, 0.99)},
+    }
+
+
+def main():
+    args = parse_args()
+    server = None if args.url else Server(args)
+    url = args.url or server.url
+    try:
+        if server:
+            server.wait_ready()
+        client = Client(url)
+        sampler = Sampler(Client(url))
+        sampler.start()
+        time.sleep(1.1)  # baseline sample
+
+        start = time.time()
+        submitted, plans = submit(client, args)
+        print(f"submitted {len(submitted)} tasks and {len(plans)} plans in {time.time() - start:.1f}s")
+        approved_at = wait_done(client, plans, args.timeout)
+        wall = time.time() - start
+        time.sleep(1.1)  # final sample
+        sampler.stopped.set()
+        sampler.join()
+
+        result = report(args, client, submitted, approved_at, sampler, wall)
+    finally:
+        if server:
+            server.stop()
+
+    print(json.dumps(result, indent=2))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nwritten to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""Change feed — versioned task/plan/worktree deltas for dashboard clients.
+
+Triggers append a row to ``changes`` for every mutation; the version is that
+row's id. A pump wakes on DB writes, reads the new versions, coalesces them
+per entity and broadcasts one ``changes`` event on /ws/events carrying the
+current row of each entity that changed. Clients patch their state and only
+refetch when they miss versions (``/api/changes?since=`` catches them up).
+"""
+
+from typing import Optional, List, Dict
+
+import asyncio
+import logging
+import os
+
+from db import fetch_all, fetch_one, execute, add_write_hook, remove_write_hook
+
+logger = logging.getLogger(__name__)
+
+# Wait this long after a write before reading, so bursts go out as one event
+COALESCE_INTERVAL = float(os.environ.get("CCM_CHANGES_COALESCE_MS", "100")) / 1000
+# Versions kept for catch-up; older clients get a reset and refetch
+CHANGES_KEEP = int(os.environ.get("CCM_CHANGES_KEEP", "10000"))
+MAX_BATCH = 1000
+# Only writes to these can add versions (see the triggers in db.py)
+WATCHED_TABLES = frozenset({"tasks", "plan_groups", "worktrees"})
+
+# Same projection as the task list so a delta can replace a list entry
+TASK_SUMMARY_COLUMNS = (
+    "id, substr(prompt, 1, 100) AS prompt_short, status, mode, priority, worktree_id, "
+    "plan_group_id, created_at, started_at, finished_at, cost_usd"
+)
+PLAN_SUMMARY_COLUMNS = (
+    "id, goal, status, created_at, finished_at, "
+    "steps_total, steps_pending, steps_queued, steps_running, steps_done"
+)
+
+
+async def attach_plan_info(tasks: List[dict]):
+    """Add plan_status / plan_goal to tasks that belong to a plan group."""
+    group_ids = list({t["plan_group_id"] for t in tasks if t["plan_group_id"]})
+    if not group_ids:
+        return
+    placeholders = ",".join("?" * len(group_ids))
+    groups = await fetch_all(
+        f"SELECT id, goal, status FROM plan_groups WHERE id IN ({placeholders})",
+        group_ids,
+    )
+    group_map = {g["id"]: g for g in groups}
+    for t in tasks:
+        if t["plan_group_id"] and t["plan_group_id"] in group_map:
+            g = group_map[t["plan_group_id"]]
+            t["plan_status"] = g["status"]
+            t["plan_goal"] = g["goal"]
+
+
+async def current_version() -> int:
+    row = await fetch_one("SELECT COALESCE(MAX(version), 0) AS v FROM changes")
+    return row["v"]
+
+
+async def task_counts() -> Dict[str, int]:
+    rows = await fetch_all("SELECT status, n FROM task_counts WHERE n > 0")
+    return {r["status"]: r["n"] for r in rows}
+
+
+async def _load(table: str, columns: str, ids: List[int]) -> Dict[int, dict]:
+    if not ids:
+        return {}
+    placeholders = ",".join("?" * len(ids))
+    rows = await fetch_all(f"SELECT {columns} FROM {table} WHERE id IN ({placeholders})", ids)
+    return {r["id"]: r for r in rows}
+
+
+async def read_since(since: int, limit: int = MAX_BATCH) -> dict:
+    """Deltas after ``since``: the newest state of each changed entity.
+
+    ``reset`` is true when versions after ``since`` were already pruned — the
+    client must refetch everything. ``version`` is the cursor for the next call.
+    """
+    oldest = await fetch_one("SELECT MIN(version) AS v FROM changes")
+    if oldest and oldest["v"] is not None and since < oldest["v"] - 1:
+        return {"version": await current_version(), "reset": True, "changes": []}
+
+    rows = await fetch_all(
+        "SELECT version, entity, entity_id, op FROM changes WHERE version > ? ORDER BY version LIMIT ?",
+        (since, limit),
+    )
+    if not rows:
+        return {"version": since, "reset": False, "changes": []}
+
+    # Coalesce: one delta per entity, tagged with its latest version
+    latest: Dict[tuple, dict] = {}
+    for r in rows:
+        latest[(r["entity"], r["entity_id"])] = r
+    by_entity: Dict[str, List[int]] = {"task": [], "plan": [], "worktree": []}
+    for entity, entity_id in latest:
+        by_entity.setdefault(entity, []).append(entity_id)
+
+    tasks = await _load("tasks", TASK_SUMMARY_COLUMNS, by_entity["task"])
+    await attach_plan_info(list(tasks.values()))
+    plans = await _load("plan_groups", PLAN_SUMMARY_COLUMNS, by_entity["plan"])
+    worktrees = await _load("worktrees", "*", by_entity["worktree"])
+    # Removed worktrees are kept as rows but are gone as far as clients care
+    worktrees = {k: v for k, v in worktrees.items() if v["status"] != "removed"}
+    data = {"task": tasks, "plan": plans, "worktree": worktrees}
+
+    changes = []
+    for (entity, entity_id), r in sorted(latest.items(), key=lambda kv: kv[1]["version"]):
+        changes.append({
+            "entity": entity,
+            "id": entity_id,
+            "version": r["version"],
+            "data": data.get(entity, {}).get(entity_id),  # None = deleted
+        })
+    result = {"version": rows[-1]["version"], "reset": False, "changes": changes}
+    if by_entity["task"]:
+        result["counts"] = await task_counts()
+    return result
+
+
+class ChangeFeed:
+    """Pushes deltas to /ws/events as soon as a write produces new versions."""
+
+    def __init__(self, broadcast):
+        self.broadcast = broadcast
+        self.version = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._passes = 0
+
+    def notify(self, table: Optional[str] = None):
+        # Log batches, traces and retention deletes can't produce a delta
+        if table is None or table in WATCHED_TABLES:
+            self._wake.set()
+
+    async def start(self):
+        self.version = await current_version()
+        add_write_hook(self.notify)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Change feed started at version {self.version}")
+
+    async def stop(self):
+        remove_write_hook(self.notify)
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(COALESCE_INTERVAL)
+            self._wake.clear()
+            try:
+                await self._pump()
+            except Exception:
+                logger.exception("Change feed pump failed")
+
+    async def _pump(self):
+        while True:
+            batch = await read_since(self.version)
+            if not batch["changes"]:
+                break
+            batch["from"] = self.version
+            self.version = batch["version"]
+            await self.broadcast(0, "changes", {"type": "changes", **batch})
+
+        self._passes += 1
+        if self._passes % 100 == 0:
+            await execute("DELETE FROM changes WHERE version <= ?", (self.version - CHANGES_KEEP,))
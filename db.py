@@ -1,11 +1,26 @@
 """SQLite schema + query utilities."""
 
-from typing import Optional, List
+from typing import Optional, List, Callable
 
 import aiosqlite
+import logging
 import os
+import re
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+
+import metrics
+from db_pool import ConnectionPool, open_connection
+
+logger = logging.getLogger(__name__)
 
 DB_PATH = os.environ.get("CCM_DB_PATH", "claude_manager.db")
+DB_READERS = int(os.environ.get("CCM_DB_READERS", "4"))
+
+# Process-wide pool, opened in the FastAPI lifespan. When it is not open
+# (scripts, one-off tools) the helpers fall back to a connection per call.
+_pool: Optional[ConnectionPool] = None
 
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS tasks (
@@ -22,6 +37,7 @@ CREATE TABLE IF NOT EXISTS tasks (
     finished_at TEXT,
     result_text TEXT,
     cost_usd REAL DEFAULT 0,
+    cache_key TEXT,  -- task_cache: prompt + repo commit + mode; NULL = not cacheable
     FOREIGN KEY (worktree_id) REFERENCES worktrees(id),
     FOREIGN KEY (plan_group_id) REFERENCES plan_groups(id)
 );
@@ -30,8 +46,9 @@ CREATE TABLE IF NOT EXISTS task_logs (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     task_id INTEGER NOT NULL,
     event_type TEXT NOT NULL,  -- assistant/tool_use/tool_result/result/error/system
-    payload TEXT NOT NULL,     -- raw JSON line
+    payload TEXT NOT NULL,     -- JSON text, or compressed bytes when encoding is set
     ts TEXT NOT NULL DEFAULT (datetime('now')),
+    encoding TEXT,             -- NULL/zlib/zstd, see log_policy
     FOREIGN KEY (task_id) REFERENCES tasks(id)
 );
 
@@ -40,8 +57,9 @@ CREATE TABLE IF NOT EXISTS worktrees (
     name TEXT NOT NULL UNIQUE,
     path TEXT NOT NULL,
     branch TEXT NOT NULL,
-    status TEXT NOT NULL DEFAULT 'idle',  -- idle/busy/removed
-    created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    status TEXT NOT NULL DEFAULT 'idle',  -- idle/busy/recycling/broken/removed
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    idle_since TEXT
 );
 
 CREATE TABLE IF NOT EXISTS plan_groups (
@@ -50,7 +68,23 @@ CREATE TABLE IF NOT EXISTS plan_groups (
     plan_text TEXT,
     status TEXT NOT NULL DEFAULT 'planning',  -- planning/reviewing/approved/executing/completed
     created_at TEXT NOT NULL DEFAULT (datetime('now')),
-    finished_at TEXT
+    finished_at TEXT,
+    branch TEXT,  -- ccm/plan-<id>, steps merge into it
+    -- Execute-step counts by state, kept by triggers on tasks
+    steps_total INTEGER NOT NULL DEFAULT 0,
+    steps_pending INTEGER NOT NULL DEFAULT 0,
+    steps_queued INTEGER NOT NULL DEFAULT 0,
+    steps_running INTEGER NOT NULL DEFAULT 0,
+    steps_done INTEGER NOT NULL DEFAULT 0  -- completed/failed/cancelled
+);
+
+-- Plan step DAG: task_id may only be queued once every depends_on task is finished
+CREATE TABLE IF NOT EXISTS task_deps (
+    task_id INTEGER NOT NULL,
+    depends_on INTEGER NOT NULL,
+    PRIMARY KEY (task_id, depends_on),
+    FOREIGN KEY (task_id) REFERENCES tasks(id),
+    FOREIGN KEY (depends_on) REFERENCES tasks(id)
 );
 
 CREATE TABLE IF NOT EXISTS progress_entries (
@@ -62,55 +96,438 @@ CREATE TABLE IF NOT EXISTS progress_entries (
     created_at TEXT NOT NULL DEFAULT (datetime('now')),
     FOREIGN KEY (task_id) REFERENCES tasks(id)
 );
+
+-- Working-tree changes of a completed task, diffed against the commit it started from
+CREATE TABLE IF NOT EXISTS task_diffs (
+    task_id INTEGER PRIMARY KEY,
+    base TEXT NOT NULL,
+    diff TEXT NOT NULL,
+    truncated INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (task_id) REFERENCES tasks(id)
+);
+
+-- Per-task span trace (tracing.py): spans is a JSON list of [name, start_us, dur_us|null, args?]
+-- with start relative to t0 (unix seconds)
+CREATE TABLE IF NOT EXISTS task_traces (
+    task_id INTEGER PRIMARY KEY,
+    t0 REAL NOT NULL,
+    spans TEXT NOT NULL DEFAULT '[]',
+    FOREIGN KEY (task_id) REFERENCES tasks(id)
+);
+
+-- Change feed: one row per task/plan/worktree mutation, written by triggers
+CREATE TABLE IF NOT EXISTS changes (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    entity TEXT NOT NULL,     -- task/plan/worktree
+    entity_id INTEGER NOT NULL,
+    op TEXT NOT NULL          -- insert/update/delete
+);
+
+-- Task count per status, kept by triggers so /api/status needs no GROUP BY
+CREATE TABLE IF NOT EXISTS task_counts (
+    status TEXT PRIMARY KEY,
+    n INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Columns added after the tables above first shipped: (table, column, declaration).
+# Applied with ALTER TABLE on databases created by older versions.
+MIGRATIONS = [
+    ("worktrees", "idle_since", "TEXT"),
+    ("task_logs", "encoding", "TEXT"),  # NULL = plain JSON text, else zlib/zstd (log_policy)
+    ("plan_groups", "branch", "TEXT"),
+    ("plan_groups", "steps_total", "INTEGER NOT NULL DEFAULT 0"),
+    ("plan_groups", "steps_pending", "INTEGER NOT NULL DEFAULT 0"),
+    ("plan_groups", "steps_queued", "INTEGER NOT NULL DEFAULT 0"),
+    ("plan_groups", "steps_running", "INTEGER NOT NULL DEFAULT 0"),
+    ("plan_groups", "steps_done", "INTEGER NOT NULL DEFAULT 0"),
+    ("tasks", "cache_key", "TEXT"),
+]
+
+# Run after MIGRATIONS so indexes may reference migrated columns
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks(status, priority DESC, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_status_id ON tasks(status, id);
+CREATE INDEX IF NOT EXISTS idx_tasks_plan_group ON tasks(plan_group_id);
+CREATE INDEX IF NOT EXISTS idx_task_logs_task ON task_logs(task_id, id);
+CREATE INDEX IF NOT EXISTS idx_task_deps_depends_on ON task_deps(depends_on);
+CREATE INDEX IF NOT EXISTS idx_tasks_cache_key ON tasks(cache_key, id) WHERE cache_key IS NOT NULL;
+"""
+
+TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trg_tasks_insert AFTER INSERT ON tasks BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('task', NEW.id, 'insert');
+    INSERT INTO task_counts (status, n) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET n = n + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_tasks_update AFTER UPDATE ON tasks BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('task', NEW.id, 'update');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_tasks_status AFTER UPDATE OF status ON tasks
+WHEN OLD.status IS NOT NEW.status BEGIN
+    UPDATE task_counts SET n = n - 1 WHERE status = OLD.status;
+    INSERT INTO task_counts (status, n) VALUES (NEW.status, 1)
+        ON CONFLICT(status) DO UPDATE SET n = n + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_tasks_delete AFTER DELETE ON tasks BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('task', OLD.id, 'delete');
+    UPDATE task_counts SET n = n - 1 WHERE status = OLD.status;
+END;
+
+-- Plan step counters: +1 for the new state, -1 for the old one
+CREATE TRIGGER IF NOT EXISTS trg_plan_steps_insert AFTER INSERT ON tasks
+WHEN NEW.plan_group_id IS NOT NULL AND NEW.mode = 'execute' BEGIN
+    UPDATE plan_groups SET
+        steps_total = steps_total + 1,
+        steps_pending = steps_pending + (NEW.status = 'pending'),
+        steps_queued = steps_queued + (NEW.status = 'queued'),
+        steps_running = steps_running + (NEW.status = 'running'),
+        steps_done = steps_done + (NEW.status IN ('completed', 'failed', 'cancelled'))
+    WHERE id = NEW.plan_group_id;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_plan_steps_status AFTER UPDATE OF status ON tasks
+WHEN NEW.plan_group_id IS NOT NULL AND NEW.mode = 'execute' AND OLD.status IS NOT NEW.status BEGIN
+    UPDATE plan_groups SET
+        steps_pending = steps_pending + (NEW.status = 'pending') - (OLD.status = 'pending'),
+        steps_queued = steps_queued + (NEW.status = 'queued') - (OLD.status = 'queued'),
+        steps_running = steps_running + (NEW.status = 'running') - (OLD.status = 'running'),
+        steps_done = steps_done + (NEW.status IN ('completed', 'failed', 'cancelled'))
+                                - (OLD.status IN ('completed', 'failed', 'cancelled'))
+    WHERE id = NEW.plan_group_id;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_plan_steps_delete AFTER DELETE ON tasks
+WHEN OLD.plan_group_id IS NOT NULL AND OLD.mode = 'execute' BEGIN
+    UPDATE plan_groups SET
+        steps_total = steps_total - 1,
+        steps_pending = steps_pending - (OLD.status = 'pending'),
+        steps_queued = steps_queued - (OLD.status = 'queued'),
+        steps_running = steps_running - (OLD.status = 'running'),
+        steps_done = steps_done - (OLD.status IN ('completed', 'failed', 'cancelled'))
+    WHERE id = OLD.plan_group_id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_plan_groups_insert AFTER INSERT ON plan_groups BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('plan', NEW.id, 'insert');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_plan_groups_update AFTER UPDATE ON plan_groups BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('plan', NEW.id, 'update');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_plan_groups_delete AFTER DELETE ON plan_groups BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('plan', OLD.id, 'delete');
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_worktrees_insert AFTER INSERT ON worktrees BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('worktree', NEW.id, 'insert');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_worktrees_update AFTER UPDATE ON worktrees BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('worktree', NEW.id, 'update');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_worktrees_delete AFTER DELETE ON worktrees BEGIN
+    INSERT INTO changes (entity, entity_id, op) VALUES ('worktree', OLD.id, 'delete');
+END;
+"""
+
+# Plans approved before task_deps existed ran their steps in id order and
+# have no edges; give those with steps still pending that chain
+PLAN_DEPS_BACKFILL_SQL = """
+INSERT OR IGNORE INTO task_deps (task_id, depends_on)
+SELECT id, prev FROM (
+    SELECT id, plan_group_id, LAG(id) OVER (PARTITION BY plan_group_id ORDER BY id) AS prev
+    FROM tasks WHERE mode='execute' AND plan_group_id IS NOT NULL
+) s
+WHERE prev IS NOT NULL
+  AND plan_group_id IN (SELECT plan_group_id FROM tasks WHERE mode='execute' AND status='pending')
+  AND NOT EXISTS (
+    SELECT 1 FROM task_deps d JOIN tasks t ON t.id = d.task_id WHERE t.plan_group_id = s.plan_group_id
+  )
+"""
+
+# Recount plan step counters; only rows that are off are touched
+PLAN_STEPS_REBUILD_SQL = """
+UPDATE plan_groups SET
+    steps_total = c.total, steps_pending = c.pending, steps_queued = c.queued,
+    steps_running = c.running, steps_done = c.done
+FROM (
+    SELECT g.id AS gid,
+        COUNT(t.id) AS total,
+        COALESCE(SUM(t.status = 'pending'), 0) AS pending,
+        COALESCE(SUM(t.status = 'queued'), 0) AS queued,
+        COALESCE(SUM(t.status = 'running'), 0) AS running,
+        COALESCE(SUM(t.status IN ('completed', 'failed', 'cancelled')), 0) AS done
+    FROM plan_groups g LEFT JOIN tasks t ON t.plan_group_id = g.id AND t.mode = 'execute'
+    GROUP BY g.id
+) AS c
+WHERE plan_groups.id = c.gid
+  AND (steps_total, steps_pending, steps_queued, steps_running, steps_done)
+      IS NOT (c.total, c.pending, c.queued, c.running, c.done)
+"""
+
+# Full-text index over experience notes. Optional: SQLite builds without
+# FTS5 skip it and progress.py falls back to keyword matching.
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS progress_fts USING fts5(
+    summary, lessons, tags,
+    content='progress_entries', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS progress_fts_vocab USING fts5vocab(progress_fts, 'row');
+CREATE TRIGGER IF NOT EXISTS trg_progress_fts_insert AFTER INSERT ON progress_entries BEGIN
+    INSERT INTO progress_fts (rowid, summary, lessons, tags)
+        VALUES (NEW.id, NEW.summary, COALESCE(NEW.lessons, ''), COALESCE(NEW.tags, ''));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_progress_fts_delete AFTER DELETE ON progress_entries BEGIN
+    INSERT INTO progress_fts (progress_fts, rowid, summary, lessons, tags)
+        VALUES ('delete', OLD.id, OLD.summary, COALESCE(OLD.lessons, ''), COALESCE(OLD.tags, ''));
+END;
+CREATE TRIGGER IF NOT EXISTS trg_progress_fts_update AFTER UPDATE ON progress_entries BEGIN
+    INSERT INTO progress_fts (progress_fts, rowid, summary, lessons, tags)
+        VALUES ('delete', OLD.id, OLD.summary, COALESCE(OLD.lessons, ''), COALESCE(OLD.tags, ''));
+    INSERT INTO progress_fts (rowid, summary, lessons, tags)
+        VALUES (NEW.id, NEW.summary, COALESCE(NEW.lessons, ''), COALESCE(NEW.tags, ''));
+END;
 """
 
+# Set by init_db(): whether progress_fts exists in this database
+HAS_FTS5 = False
+
+# Called after every committed write with the table written, or None when
+# unknown (transaction blocks); see add_write_hook()
+_write_hooks: List[Callable[[Optional[str]], None]] = []
+
+_WRITE_TARGET = re.compile(
+    r"\b(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM)\s+(\w+)", re.I,
+)
+_written_tables: dict = {}
+
+# Includes waiting for a pooled connection — that wait is part of the cost
+DB_SECONDS = metrics.Histogram(
+    "ccm_db_query_seconds", "Time per DB helper call, by statement class", ["statement"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+STATEMENT_CLASSES = frozenset({"select", "insert", "update", "delete", "with", "pragma", "transaction"})
+# Queries are mostly module constants, so their histogram child is cached by text
+_STATEMENT_CACHE_MAX = 512
+_statement_children: dict = {}
+
+
+def _observe(query: str, start: float):
+    child = _statement_children.get(query)
+    if child is None:
+        head = query.lstrip()[:12].split(None, 1)
+        statement = head[0].lower() if head else "other"
+        child = DB_SECONDS.labels(statement if statement in STATEMENT_CLASSES else "other")
+        if len(_statement_children) < _STATEMENT_CACHE_MAX:
+            _statement_children[query] = child
+    child.observe(time.perf_counter() - start)
+
+
+def _written_table(query: str) -> Optional[str]:
+    """Table a single write statement modifies (None if it can't be told)."""
+    if query in _written_tables:
+        return _written_tables[query]
+    m = _WRITE_TARGET.search(query)
+    table = m.group(1).lower() if m else None
+    if len(_written_tables) < _STATEMENT_CACHE_MAX:
+        _written_tables[query] = table
+    return table
+
+
+def db_size_bytes() -> int:
+    """Bytes on disk for the database, including its WAL and shared-memory files."""
+    total = 0
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            total += os.path.getsize(DB_PATH + suffix)
+        except OSError:
+            pass
+    return total
+
 
 async def get_db() -> aiosqlite.Connection:
-    db = await aiosqlite.connect(DB_PATH)
-    db.row_factory = aiosqlite.Row
-    await db.execute("PRAGMA journal_mode=WAL")
-    await db.execute("PRAGMA foreign_keys=ON")
-    return db
+    return await open_connection(DB_PATH)
 
 
 async def init_db():
+    global HAS_FTS5
     db = await get_db()
     try:
         await db.executescript(SCHEMA)
+        for table, column, decl in MIGRATIONS:
+            cursor = await db.execute(f"PRAGMA table_info({table})")
+            columns = {r["name"] for r in await cursor.fetchall()}
+            if column not in columns:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+        await db.executescript(INDEXES)
+        await db.executescript(TRIGGERS)
+        # Rebuild counters from scratch so databases written before the
+        # triggers existed (or edited by hand) start out correct
+        await db.execute("DELETE FROM task_counts")
+        await db.execute("INSERT INTO task_counts (status, n) SELECT status, COUNT(*) FROM tasks GROUP BY status")
+        await db.execute(PLAN_STEPS_REBUILD_SQL)
+        await db.execute(PLAN_DEPS_BACKFILL_SQL)
+        HAS_FTS5 = await _init_fts(db)
         await db.commit()
     finally:
         await db.close()
 
 
-async def fetch_one(query: str, params=()) -> Optional[dict]:
-    db = await get_db()
+async def _init_fts(db: aiosqlite.Connection) -> bool:
+    cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name='progress_fts'")
+    existed = await cursor.fetchone() is not None
     try:
+        await db.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 unavailable ({e}); experience lookup uses keyword matching")
+        return False
+    if not existed:
+        # Index entries written before the FTS table existed
+        await db.execute("INSERT INTO progress_fts (progress_fts) VALUES ('rebuild')")
+    return True
+
+
+async def open_pool(readers: int = DB_READERS):
+    """Open the shared connection pool. Call once at startup."""
+    global _pool
+    if _pool and _pool.is_open:
+        return
+    _pool = ConnectionPool(DB_PATH, readers)
+    await _pool.open()
+
+
+async def close_pool():
+    global _pool
+    if _pool:
+        await _pool.close()
+        _pool = None
+
+
+@asynccontextmanager
+async def _reader(query: str = ""):
+    start = time.perf_counter()
+    try:
+        if _pool:
+            async with _pool.reader() as db:
+                yield db
+            return
+        db = await get_db()
+        try:
+            yield db
+        finally:
+            await db.close()
+    finally:
+        _observe(query, start)
+
+
+@asynccontextmanager
+async def _writer(query: str = ""):
+    start = time.perf_counter()
+    try:
+        if _pool:
+            async with _pool.writer() as db:
+                yield db
+        else:
+            db = await get_db()
+            try:
+                yield db
+            finally:
+                await db.close()
+    finally:
+        _observe(query, start)
+    if _write_hooks:
+        table = None if query == "transaction" else _written_table(query)
+        for hook in _write_hooks:
+            hook(table)
+
+
+def add_write_hook(hook: Callable[[Optional[str]], None]):
+    """Register a callback run after each successful write (e.g. to wake the
+    change feed). It gets the table written, or None when that is unknown.
+    Hooks must be cheap and must not block."""
+    _write_hooks.append(hook)
+
+
+def remove_write_hook(hook: Callable[[Optional[str]], None]):
+    if hook in _write_hooks:
+        _write_hooks.remove(hook)
+
+
+async def fetch_one(query: str, params=()) -> Optional[dict]:
+    async with _reader(query) as db:
         cursor = await db.execute(query, params)
         row = await cursor.fetchone()
+        await cursor.close()
         return dict(row) if row else None
-    finally:
-        await db.close()
 
 
 async def fetch_all(query: str, params=()) -> List[dict]:
-    db = await get_db()
-    try:
+    async with _reader(query) as db:
         cursor = await db.execute(query, params)
         rows = await cursor.fetchall()
+        await cursor.close()
         return [dict(r) for r in rows]
-    finally:
-        await db.close()
 
 
 async def execute(query: str, params=()) -> int:
-    db = await get_db()
-    try:
+    async with _writer(query) as db:
         cursor = await db.execute(query, params)
         await db.commit()
         return cursor.lastrowid
-    finally:
-        await db.close()
+
+
+async def execute_rowcount(query: str, params=()) -> int:
+    """Run a write statement and return the number of rows it changed."""
+    async with _writer(query) as db:
+        cursor = await db.execute(query, params)
+        await db.commit()
+        return cursor.rowcount
 
 
 async def execute_returning(query: str, params=()) -> int:
     return await execute(query, params)
+
+
+async def execute_many(query: str, rows: List[tuple]):
+    """Run one statement for many parameter rows in a single transaction."""
+    if not rows:
+        return
+    async with _writer(query) as db:
+        await db.executemany(query, rows)
+        await db.commit()
+
+
+async def execute_fetch_one(query: str, params=()) -> Optional[dict]:
+    """Run a write statement with a RETURNING clause and return the first row."""
+    async with _writer(query) as db:
+        cursor = await db.execute(query, params)
+        rows = await cursor.fetchall()  # drain so the statement completes
+        await cursor.close()
+        await db.commit()
+        return dict(rows[0]) if rows else None
+
+
+async def execute_fetch_all(query: str, params=()) -> List[dict]:
+    """Run a write statement with a RETURNING clause and return every row."""
+    async with _writer(query) as db:
+        cursor = await db.execute(query, params)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        await db.commit()
+        return [dict(r) for r in rows]
+
+
+@asynccontextmanager
+async def transaction():
+    """Write transaction taken with BEGIN IMMEDIATE.
+
+    The write lock is held from the first statement, so a read-then-update
+    inside the block cannot race another process on the same DB file.
+    Commits on exit, rolls back on error.
+    """
+    async with _writer("transaction") as db:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
@@ -0,0 +1,85 @@
+"""Persistent SQLite connection pool — one writer, N readers."""
+
+from typing import Optional, List
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_READERS = 4
+
+
+async def open_connection(path: str) -> aiosqlite.Connection:
+    """Open a connection with the PRAGMAs every CCM connection needs."""
+    db = await aiosqlite.connect(path)
+    db.row_factory = aiosqlite.Row
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA foreign_keys=ON")
+    await db.execute("PRAGMA busy_timeout=5000")
+    return db
+
+
+class ConnectionPool:
+    """Long-lived aiosqlite connections shared by the whole process.
+
+    SQLite allows one writer at a time, so all writes go through a single
+    connection guarded by a lock. Reads are spread over a small set of reader
+    connections, which WAL mode lets run alongside the writer.
+    """
+
+    def __init__(self, path: str, readers: int = DEFAULT_READERS):
+        self.path = path
+        self.size = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def open(self):
+        if self.is_open:
+            return
+        self._writer = await open_connection(self.path)
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            conn = await open_connection(self.path)
+            self._readers.append(conn)
+            self._idle.put_nowait(conn)
+        logger.info(f"DB pool open: 1 writer + {self.size} readers on {self.path}")
+
+    async def close(self):
+        if not self.is_open:
+            return
+        async with self._write_lock:
+            await self._writer.close()
+            self._writer = None
+        for conn in self._readers:
+            await conn.close()
+        self._readers = []
+        self._idle = None
+        logger.info("DB pool closed")
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Exclusive use of the writer connection. Caller commits."""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
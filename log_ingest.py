@@ -0,0 +1,216 @@
+"""Batched task_logs ingest — runners enqueue, one writer group-commits."""
+
+from typing import Optional, List
+
+import asyncio
+import logging
+import os
+
+import metrics
+from db import execute, execute_many, execute_returning, transaction
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get("CCM_LOG_BATCH_SIZE", "200"))
+FLUSH_INTERVAL = float(os.environ.get("CCM_LOG_FLUSH_MS", "50")) / 1000
+MAX_PENDING = int(os.environ.get("CCM_LOG_MAX_PENDING", "20000"))
+
+INSERT_SQL = "INSERT INTO task_logs (id, task_id, event_type, payload, encoding) VALUES (?, ?, ?, ?, ?)"
+DIRECT_INSERT_SQL = "INSERT INTO task_logs (task_id, event_type, payload, encoding) VALUES (?, ?, ?, ?)"
+# Ids are reserved from the table's AUTOINCREMENT sequence this many at a
+# time, so other processes on the DB and direct inserts never reuse them
+ID_BLOCK = 1000
+# Highest id ever handed out (AUTOINCREMENT never reuses ids, neither do we)
+LAST_ID_SQL = """
+SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name='task_logs'), 0),
+           COALESCE((SELECT MAX(id) FROM task_logs), 0)) AS last_id
+"""
+
+_STOP = object()
+
+LOG_BATCH_ROWS = metrics.Histogram(
+    "ccm_log_batch_rows", "Rows per task_logs group commit",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500, 1000),
+)
+LOG_ROWS = metrics.Counter("ccm_log_rows_total", "task_logs rows written")
+
+
+class LogWriter:
+    """Single consumer that drains queued log rows into SQLite.
+
+    Rows are written with one executemany per batch, committed when the
+    batch reaches ``batch_size`` rows or ``flush_interval`` seconds after its
+    first row, whichever comes first. ``flush()`` forces everything queued so
+    far to be committed before it returns.
+
+    Row ids are assigned at ``append()`` time, so callers can hand the id to
+    live subscribers before the row is on disk; WebSocket resume relies on
+    live and stored events sharing one id sequence. They come from blocks
+    reserved by advancing sqlite_sequence in a write transaction, which
+    keeps them unique across processes sharing the DB file and increasing
+    within each task.
+    """
+
+    def __init__(self, batch_size: int = BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 max_pending: int = MAX_PENDING):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._next_id = 1
+        self._id_limit = 0  # last id of the reserved block
+        self._reserve_lock = asyncio.Lock()
+        self.rows_written = 0
+        self.batches = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Log writer started (batch={self.batch_size}, interval={self.flush_interval * 1000:.0f}ms)")
+
+    async def stop(self):
+        """Write out everything still queued, then stop the writer."""
+        if not self.running:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        logger.info("Log writer stopped")
+
+    async def append(self, task_id: int, event_type: str, payload, encoding: Optional[str] = None) -> int:
+        """Queue one log row and return its id. Blocks only when the queue is
+        full (backpressure). ``payload`` is stored as given (see log_policy)."""
+        if not self.running:
+            return await execute_returning(DIRECT_INSERT_SQL, (task_id, event_type, payload, encoding))
+        if self._next_id > self._id_limit:
+            await self._reserve_ids()
+        log_id = self._next_id
+        self._next_id += 1
+        await self._queue.put((log_id, task_id, event_type, payload, encoding))
+        return log_id
+
+    async def _reserve_ids(self):
+        async with self._reserve_lock:
+            if self._next_id <= self._id_limit:
+                return  # another append reserved while we waited
+            async with transaction() as db:
+                cursor = await db.execute(LAST_ID_SQL)
+                last_id = (await cursor.fetchone())[0]
+                await cursor.close()
+                limit = last_id + ID_BLOCK
+                cursor = await db.execute("UPDATE sqlite_sequence SET seq=? WHERE name='task_logs'", (limit,))
+                if cursor.rowcount == 0:
+                    await db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('task_logs', ?)", (limit,))
+                await cursor.close()
+            self._next_id, self._id_limit = last_id + 1, limit
+
+    async def flush(self):
+        """Wait until every row queued before this call is committed."""
+        if not self.running:
+            return
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put(done)
+        await done
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch: List[tuple] = []
+            waiters: List[asyncio.Future] = []
+            deadline = loop.time() + self.flush_interval
+
+            while True:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, asyncio.Future):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+
+                if stopping or waiters or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            if stopping:
+                # Drain whatever arrived before the stop marker
+                while not self._queue.empty():
+                    item = self._queue.get_nowait()
+                    if isinstance(item, asyncio.Future):
+                        waiters.append(item)
+                    elif item is not _STOP:
+                        batch.append(item)
+
+            await self._write(batch)
+            for w in waiters:
+                if not w.done():
+                    w.set_result(None)
+
+    async def _write(self, batch: List[tuple]):
+        if not batch:
+            return
+        self.batches += 1
+        self.rows_written += len(batch)
+        LOG_BATCH_ROWS.observe(len(batch))
+        LOG_ROWS.inc(len(batch))
+        try:
+            await execute_many(INSERT_SQL, batch)
+        except Exception:
+            # One bad row (e.g. task deleted) must not drop the whole batch
+            logger.exception(f"Batch insert of {len(batch)} log rows failed, retrying row by row")
+            for row in batch:
+                try:
+                    await execute(INSERT_SQL, row)
+                except Exception as e:
+                    logger.warning(f"Dropped log row {row[0]} for task {row[1]}: {e}")
+
+
+_writer = LogWriter()
+
+metrics.Gauge("ccm_log_queue_pending", "Log rows queued for the writer").set_function(
+    lambda: _writer._queue.qsize() if _writer.running else 0
+)
+
+
+async def start():
+    await _writer.start()
+
+
+async def stop():
+    await _writer.stop()
+
+
+async def append(task_id: int, event_type: str, payload, encoding: Optional[str] = None) -> int:
+    return await _writer.append(task_id, event_type, payload, encoding)
+
+
+async def flush():
+    await _writer.flush()
+
+
+def stats() -> dict:
+    return {
+        "last_id": _writer._next_id - 1,
+        "rows_written": _writer.rows_written,
+        "batches": _writer.batches,
+        "pending": _writer._queue.qsize() if _writer.running else 0,
+    }
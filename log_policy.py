@@ -0,0 +1,251 @@
+"""Task log storage policy — which events are stored, how compactly, and for how long.
+
+The runner streams every event to WebSocket clients unchanged; only what
+reaches ``task_logs`` goes through here:
+
+- stream chatter (message_start/stop, ping, ...) is dropped, and event
+  classes not listed in CCM_LOG_KEEP are skipped;
+- content_block_start/delta/stop fragments are merged into one assistant
+  message per block;
+- payloads of CCM_LOG_COMPRESS_MIN bytes or more are stored compressed
+  (zstd when the ``zstandard`` package is installed, zlib otherwise), with
+  the codec in ``task_logs.encoding``;
+- a retention job deletes logs of tasks finished more than
+  CCM_LOG_RETENTION_DAYS ago, keeping their result and error rows, and
+  their span traces.
+"""
+
+from typing import Optional, List, Tuple
+
+import asyncio
+import json
+import logging
+import os
+import zlib
+
+from db import execute, execute_rowcount
+
+try:
+    import zstandard
+except ImportError:  # optional
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+KEEP_CLASSES = frozenset(
+    c.strip() for c in os.environ.get(
+        "CCM_LOG_KEEP", "assistant,tool_use,tool_result,result,error,system"
+    ).split(",") if c.strip()
+)
+# Raw stream-json types never worth a row of their own
+DROP_TYPES = frozenset(
+    t.strip() for t in os.environ.get(
+        "CCM_LOG_DROP_TYPES", "message_start,message_delta,message_stop,ping"
+    ).split(",") if t.strip()
+)
+COMPRESS_MIN = int(os.environ.get("CCM_LOG_COMPRESS_MIN", "1024"))
+RETENTION_DAYS = float(os.environ.get("CCM_LOG_RETENTION_DAYS", "14"))
+RETENTION_INTERVAL = float(os.environ.get("CCM_LOG_RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH = 5000
+# Always kept by the retention job — plan mode and the UI read these
+RETAINED_TYPES = ("result", "error")
+
+_zstd_c = zstandard.ZstdCompressor(level=3) if zstandard else None
+_zstd_d = zstandard.ZstdDecompressor() if zstandard else None
+
+
+def encode(text: str) -> Tuple[object, Optional[str]]:
+    """Stored value and codec for a payload; small payloads stay plain text."""
+    raw = text.encode("utf-8")
+    if len(raw) < COMPRESS_MIN:
+        return text, None
+    if _zstd_c:
+        packed, codec = _zstd_c.compress(raw), "zstd"
+    else:
+        packed, codec = zlib.compress(raw, 6), "zlib"
+    if len(packed) >= len(raw):
+        return text, None
+    return packed, codec
+
+
+def decode(value, encoding: Optional[str]) -> str:
+    if not encoding:
+        return value
+    if encoding == "zlib":
+        return zlib.decompress(value).decode("utf-8")
+    if encoding == "zstd":
+        if not _zstd_d:
+            raise RuntimeError("task log is zstd-compressed but zstandard is not installed")
+        return _zstd_d.decompress(value).decode("utf-8")
+    raise ValueError(f"Unknown task log encoding: {encoding}")
+
+
+def decode_rows(rows: List[dict]) -> List[dict]:
+    """Replace each row's stored payload with its JSON text, in place."""
+    for r in rows:
+        r["payload"] = decode(r["payload"], r.pop("encoding", None))
+    return rows
+
+
+class TaskLog:
+    """Per-task filter between the event stream and task_logs.
+
+    ``feed()`` returns the rows to store for one event as
+    ``(event_type, stored_payload, encoding)`` — usually one, none for
+    dropped events and fragments, one merged row when a block closes.
+    """
+
+    def __init__(self, task_id: int):
+        self.task_id = task_id
+        self._block: Optional[dict] = None
+        self._parts: List[str] = []
+        self._fragments = 0
+        # JSON of the latest assistant message, decoded only by final_text()
+        self._last_assistant: Optional[str] = None
+
+    def feed(self, event_type: str, etype: str, text: str, data: Optional[dict] = None) -> List[tuple]:
+        """``etype`` is the raw stream-json type and ``text`` the event's JSON.
+        ``data`` (the decoded event) is only needed for content_block_start
+        and content_block_delta; everything else is stored from ``text``."""
+        if etype == "content_block_start":
+            rows = self._close_block()
+            self._block = dict(data.get("content_block") or {"type": "text"})
+            return rows
+        if etype == "content_block_delta":
+            delta = data.get("delta") or {}
+            part = delta.get("text", delta.get("partial_json", ""))
+            if self._block is None:
+                self._block = {"type": "tool_use" if "partial_json" in delta else "text"}
+            self._parts.append(part)
+            self._fragments += 1
+            return []
+        if etype == "content_block_stop":
+            return self._close_block()
+        if etype in DROP_TYPES:
+            return []
+        if etype == "assistant":
+            self._last_assistant = text
+        return self._row(event_type, text)
+
+    def finish(self) -> List[tuple]:
+        """Rows for a block the stream never closed (process killed mid-message)."""
+        return self._close_block()
+
+    def final_text(self) -> str:
+        """Text of the last assistant message seen, e.g. for runs whose
+        result event carries no ``result``."""
+        if not self._last_assistant:
+            return ""
+        try:
+            data = json.loads(self._last_assistant)
+        except json.JSONDecodeError:
+            return ""
+        parts = (data.get("message") or {}).get("content") or data.get("content") or []
+        if isinstance(parts, list):
+            return "".join(p.get("text", "") for p in parts if isinstance(p, dict))
+        return str(parts)
+
+    def _close_block(self) -> List[tuple]:
+        if self._block is None:
+            return []
+        block, joined = self._block, "".join(self._parts)
+        fragments = self._fragments
+        self._block, self._parts, self._fragments = None, [], 0
+        if block.get("type") == "tool_use":
+            try:
+                block["input"] = json.loads(joined) if joined else block.get("input", {})
+            except json.JSONDecodeError:
+                block["input"] = joined
+        else:
+            block["text"] = block.get("text", "") + joined
+        merged = json.dumps(
+            {"type": "assistant", "message": {"content": [block]}, "merged_fragments": fragments},
+            ensure_ascii=False,
+        )
+        if block.get("type") == "text":
+            self._last_assistant = merged
+        return self._row("assistant", merged)
+
+    def _row(self, event_type: str, text: str) -> List[tuple]:
+        if event_type not in KEEP_CLASSES:
+            return []
+        value, encoding = encode(text)
+        return [(event_type, value, encoding)]
+
+
+# --- Retention ---
+
+PURGE_SQL = f"""
+DELETE FROM task_logs WHERE id IN (
+    SELECT l.id FROM tasks t JOIN task_logs l ON l.task_id = t.id
+    WHERE t.status IN ('completed', 'failed', 'cancelled')
+      AND t.finished_at IS NOT NULL
+      AND julianday(t.finished_at) < julianday('now', ?)
+      AND l.event_type NOT IN ({', '.join(f"'{t}'" for t in RETAINED_TYPES)})
+    LIMIT {RETENTION_BATCH}
+)
+"""
+
+# Traces go whole
+TRACE_PURGE_SQL = f"""
+DELETE FROM task_traces WHERE task_id IN (
+    SELECT tr.task_id FROM task_traces tr JOIN tasks t ON t.id = tr.task_id
+    WHERE t.status IN ('completed', 'failed', 'cancelled')
+      AND t.finished_at IS NOT NULL
+      AND julianday(t.finished_at) < julianday('now', ?)
+    LIMIT {RETENTION_BATCH}
+)
+"""
+
+
+async def _purge_batches(sql: str, days: float) -> int:
+    removed = 0
+    while True:
+        count = await execute_rowcount(sql, (f"-{days} days",))
+        removed += count
+        if count < RETENTION_BATCH:
+            return removed
+        await asyncio.sleep(0)  # let queued writes in between batches
+
+
+async def purge_expired(days: float = RETENTION_DAYS) -> int:
+    """Delete raw logs and traces of tasks finished more than ``days`` ago,
+    in small batches so live writers are never blocked for long. Returns
+    rows removed."""
+    removed = await _purge_batches(PURGE_SQL, days)
+    removed += await _purge_batches(TRACE_PURGE_SQL, days)
+    if removed:
+        await execute("PRAGMA wal_checkpoint(PASSIVE)")
+    return removed
+
+
+class RetentionJob:
+    def __init__(self, days: float = RETENTION_DAYS, interval: float = RETENTION_INTERVAL):
+        self.days = days
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.days <= 0:
+            logger.info("Log retention disabled")
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                removed = await purge_expired(self.days)
+                if removed:
+                    logger.info(f"Log retention: removed {removed} rows older than {self.days:g} days")
+            except Exception:
+                logger.exception("Log retention pass failed")
+            await asyncio.sleep(self.interval)
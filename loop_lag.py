@@ -0,0 +1,83 @@
+"""Event-loop lag sampler — how late a periodic timer wakes up.
+
+Anything that blocks the loop (a sync DB call, a large json.dumps, a slow
+callback) delays every task at once; this makes it visible in /api/status.
+"""
+
+from typing import Optional
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = float(os.environ.get("CCM_LOOP_LAG_INTERVAL_MS", "100")) / 1000
+# Samples kept for percentiles (~1 minute at the default interval)
+WINDOW = 600
+# Log a warning when one wake-up is this late
+WARN_LAG = 0.5
+
+LOOP_LAG_SECONDS = metrics.Histogram(
+    "ccm_event_loop_lag_seconds", "How late the event loop ran a timer",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = SAMPLE_INTERVAL, window: int = WINDOW):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=window)
+        self.max_lag = 0.0
+        self.total_samples = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples.append(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            self.total_samples += 1
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= WARN_LAG:
+                logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms")
+
+    def stats(self) -> dict:
+        """Lag in milliseconds: last sample, p50/p99 over the window, max since start."""
+        ordered = sorted(self.samples)
+
+        def pct(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 2)
+
+        return {
+            "last_ms": round(self.samples[-1] * 1000, 2) if self.samples else 0.0,
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "max_ms": round(self.max_lag * 1000, 2),
+            "samples": self.total_samples,
+        }
+
+
+monitor = LoopLagMonitor()
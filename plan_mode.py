@@ -1,14 +1,20 @@
 """Plan Mode workflow — generate plan, review, approve, execute subtasks."""
 
-from typing import Optional, List
+from typing import Optional, Dict, List
 
 import json
 import logging
+import os
 
-from db import execute, execute_returning, fetch_one, fetch_all
+import task_queue
+from db import execute, execute_fetch_one, execute_returning, fetch_one, fetch_all, transaction
+from worktree import create_plan_branch, forget_plan
 
 logger = logging.getLogger(__name__)
 
+# Characters of each step's result_text returned with the plan detail
+RESULT_PREVIEW = int(os.environ.get("CCM_PLAN_RESULT_PREVIEW", "500"))
+
 PLAN_PROMPT_TEMPLATE = """You are a senior software architect. Given the following goal, produce a detailed implementation plan broken into multiple concrete steps. Each step should be a self-contained task that Claude Code can execute independently.
 
 GOAL:
@@ -19,20 +25,21 @@ Rules:
 - Each step should be independently executable
 - Each step's prompt should be detailed enough for Claude Code to execute without asking questions
 - Steps should be ordered by dependency (earlier steps first)
+- Give every step an "id" and list in "depends_on" the ids of the earlier steps whose changes it needs; steps that do not depend on each other run in parallel, each in its own git worktree, so only add a dependency when it is real
 - Include specific file names, function names, and implementation details in each prompt
 
 Output a JSON object with this structure:
 {{
   "summary": "Brief summary of the plan",
   "steps": [
-    {{"title": "Step title", "description": "What this step does", "prompt": "The exact detailed prompt to give to Claude Code to execute this step"}}
+    {{"id": 1, "title": "Step title", "description": "What this step does", "depends_on": [], "prompt": "The exact detailed prompt to give to Claude Code to execute this step"}}
   ]
 }}
 
 Output ONLY valid JSON, no markdown fences or extra text."""
 
 
-async def create_plan_group(goal: str) -> int:
+async def create_plan_group(goal: str, notify_scheduler=None) -> int:
     """Create a new plan group and a planning task."""
     group_id = await execute_returning(
         "INSERT INTO plan_groups (goal, status) VALUES (?, 'planning')",
@@ -45,6 +52,9 @@ async def create_plan_group(goal: str) -> int:
         "INSERT INTO tasks (prompt, status, mode, plan_group_id) VALUES (?, 'queued', 'plan', ?)",
         (prompt, group_id),
     )
+    task_queue.push(task_id)
+    if notify_scheduler:
+        notify_scheduler()
 
     logger.info(f"Plan group {group_id} created, planning task {task_id}")
     return group_id
@@ -63,43 +73,10 @@ async def on_plan_task_complete(task_id: int):
     if not group_id:
         return
 
+    # The runner falls back to the final assistant message when the result
+    # event has no text, so the logs never need to be read here
     result_text = task.get("result_text", "") or ""
 
-    # Also try to extract from task_logs if result_text is empty
-    if not result_text.strip():
-        logs = await fetch_all(
-            "SELECT payload FROM task_logs WHERE task_id=? AND event_type='result' ORDER BY id DESC LIMIT 1",
-            (task_id,),
-        )
-        if logs:
-            try:
-                payload = json.loads(logs[0]["payload"])
-                result_text = payload.get("result", "")
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-    if not result_text.strip():
-        # Last resort: scan assistant messages for JSON
-        logs = await fetch_all(
-            "SELECT payload FROM task_logs WHERE task_id=? AND event_type='assistant' ORDER BY id",
-            (task_id,),
-        )
-        for log in logs:
-            try:
-                payload = json.loads(log["payload"])
-                text = ""
-                if payload.get("message", {}).get("content"):
-                    parts = payload["message"]["content"]
-                    text = "".join(c.get("text", "") for c in parts) if isinstance(parts, list) else str(parts)
-                elif payload.get("content"):
-                    parts = payload["content"]
-                    text = "".join(c.get("text", "") for c in parts) if isinstance(parts, list) else str(parts)
-                if text and "{" in text:
-                    result_text = text
-                    break
-            except (json.JSONDecodeError, TypeError):
-                pass
-
     # Try to extract JSON from result
     plan_data = _extract_json(result_text)
 
@@ -142,11 +119,58 @@ def _extract_json(text):
     return None
 
 
+def step_dependencies(steps: List[dict]) -> List[List[int]]:
+    """Indexes each step depends on.
+
+    ``depends_on`` entries may name a step ``id`` or its 1-based position.
+    Only earlier steps count, which keeps the graph acyclic. Plans with no
+    ``depends_on`` anywhere (older plans, hand-edited ones) run sequentially.
+    """
+    if not any(isinstance(s, dict) and "depends_on" in s for s in steps):
+        return [[i - 1] if i else [] for i in range(len(steps))]
+
+    index: Dict[str, int] = {}
+    for i, step in enumerate(steps):
+        index.setdefault(str(i + 1), i)
+        if isinstance(step, dict) and step.get("id") is not None:
+            index[str(step["id"])] = i
+
+    deps = []
+    for i, step in enumerate(steps):
+        raw = step.get("depends_on") if isinstance(step, dict) else None
+        if raw is None:
+            raw = []
+        elif not isinstance(raw, list):
+            raw = [raw]
+        mine = []
+        for ref in raw:
+            j = index.get(str(ref))
+            if j is None or j >= i:
+                logger.warning(f"Plan step {i + 1}: ignoring dependency {ref!r} (unknown or not an earlier step)")
+            elif j not in mine:
+                mine.append(j)
+        deps.append(mine)
+    return deps
+
+
+def _chain_lengths(deps: List[List[int]]) -> List[int]:
+    """Longest chain of dependents below each step, itself included."""
+    length = [1] * len(deps)
+    for i in reversed(range(len(deps))):
+        for j in deps[i]:
+            length[j] = max(length[j], length[i] + 1)
+    return length
+
+
 async def approve_plan(group_id: int, notify_scheduler=None) -> List[int]:
     """Approve a plan and create subtasks for each step.
 
-    Only the first step is queued immediately. Subsequent steps are created
-    with status='pending' and queued one-by-one as each step completes.
+    Steps form a DAG (see step_dependencies, stored in task_deps). Every
+    step without dependencies is queued at once; the rest stay 'pending'
+    until check_plan_completion releases them. Steps on the longest chain
+    get the highest priority so the critical path starts first. Without a
+    plan branch (no worktree pool) all steps share one checkout, so each
+    step also waits for the one before it.
     """
     group = await fetch_one("SELECT * FROM plan_groups WHERE id=?", (group_id,))
     if not group:
@@ -162,63 +186,120 @@ async def approve_plan(group_id: int, notify_scheduler=None) -> List[int]:
         # Can't parse — create a single task with the raw plan
         steps = [{"title": "Execute plan", "prompt": plan_text}]
 
+    branch = await create_plan_branch(group_id)
+    deps = step_dependencies(steps)
+    if not branch:
+        deps = [d if not i or i - 1 in d else d + [i - 1] for i, d in enumerate(deps)]
+    priorities = _chain_lengths(deps)
+
     task_ids = []
-    for i, step in enumerate(steps):
-        prompt = step.get("prompt", step.get("description", str(step)))
-        title = step.get("title", f"Step {i+1}")
-        full_prompt = f"[Plan Step {i+1}/{len(steps)}: {title}]\n\n{prompt}"
-
-        # Only first step is queued; rest are pending (sequential execution)
-        status = "queued" if i == 0 else "pending"
-        task_id = await execute_returning(
-            "INSERT INTO tasks (prompt, status, mode, plan_group_id, priority) VALUES (?, ?, 'execute', ?, ?)",
-            (full_prompt, status, group_id, len(steps) - i),
+    queued = []
+    async with transaction() as db:
+        for i, step in enumerate(steps):
+            prompt = step.get("prompt", step.get("description", str(step)))
+            title = step.get("title", f"Step {i+1}")
+            full_prompt = f"[Plan Step {i+1}/{len(steps)}: {title}]\n\n{prompt}"
+
+            status = "pending" if deps[i] else "queued"
+            cursor = await db.execute(
+                "INSERT INTO tasks (prompt, status, mode, plan_group_id, priority) VALUES (?, ?, 'execute', ?, ?)",
+                (full_prompt, status, group_id, priorities[i]),
+            )
+            task_id = cursor.lastrowid
+            await cursor.close()
+            task_ids.append(task_id)
+            if status == "queued":
+                queued.append((task_id, priorities[i]))
+
+        edges = [(task_ids[i], task_ids[j]) for i in range(len(steps)) for j in deps[i]]
+        if edges:
+            await db.executemany("INSERT INTO task_deps (task_id, depends_on) VALUES (?, ?)", edges)
+        await db.execute(
+            "UPDATE plan_groups SET status='executing', branch=? WHERE id=?",
+            (branch, group_id),
         )
-        task_ids.append(task_id)
 
-    await execute(
-        "UPDATE plan_groups SET status='executing' WHERE id=?",
-        (group_id,),
-    )
+    for task_id, priority in queued:
+        task_queue.push(task_id, priority)
 
     if notify_scheduler:
         notify_scheduler()
 
-    logger.info(f"Plan group {group_id} approved, created {len(task_ids)} subtasks (first queued, rest pending)")
+    logger.info(f"Plan group {group_id} approved, created {len(task_ids)} subtasks "
+                f"({len(queued)} queued, critical path {max(priorities, default=0)} steps)")
     return task_ids
 
 
-async def check_plan_completion(group_id: int, notify_scheduler=None):
-    """Check plan progress. If a step just completed, queue the next pending step."""
-    tasks = await fetch_all(
-        "SELECT id, status FROM tasks WHERE plan_group_id=? AND mode='execute' ORDER BY id ASC",
-        (group_id,),
-    )
-    if not tasks:
-        return
-
-    # Find first pending step and queue it if all previous steps are done
-    all_active_done = True
-    for t in tasks:
-        if t["status"] in ("queued", "running"):
-            all_active_done = False
-            break
-        if t["status"] == "pending":
-            if all_active_done:
-                # Queue this step — previous steps are all done
-                await execute("UPDATE tasks SET status='queued' WHERE id=?", (t["id"],))
-                logger.info(f"Plan group {group_id}: queued next step task #{t['id']}")
-                if notify_scheduler:
-                    notify_scheduler()
-            return  # Don't check further
-
-    # If we get here, no pending or active steps — check if all done
-    all_done = all(t["status"] in ("completed", "failed", "cancelled") for t in tasks)
-    if all_done:
-        await execute(
-            "UPDATE plan_groups SET status='completed', finished_at=datetime('now') WHERE id=?",
-            (group_id,),
-        )
+# Steps waiting on ``finished`` whose dependencies have all completed
+QUEUE_READY_SQL = """
+UPDATE tasks SET status='queued'
+WHERE id IN (SELECT task_id FROM task_deps WHERE depends_on=?) AND status='pending'
+  AND NOT EXISTS (
+    SELECT 1 FROM task_deps d JOIN tasks dep ON dep.id = d.depends_on
+    WHERE d.task_id = tasks.id AND dep.status != 'completed'
+  )
+RETURNING id, priority
+"""
+
+# Everything downstream of a failed or cancelled step: its changes are not
+# on the plan branch, so those steps can never run
+CANCEL_DEPENDENTS_SQL = """
+WITH RECURSIVE blocked(id) AS (
+    SELECT task_id FROM task_deps WHERE depends_on=?
+    UNION
+    SELECT d.task_id FROM task_deps d JOIN blocked b ON d.depends_on = b.id
+)
+UPDATE tasks SET status='cancelled', finished_at=datetime('now'),
+    result_text='[ccm] skipped: a step it depends on did not complete'
+WHERE id IN (SELECT id FROM blocked) AND status='pending'
+RETURNING id
+"""
+
+# Counters are kept by triggers, so this is a single-row check
+COMPLETE_PLAN_SQL = """
+UPDATE plan_groups SET status='completed', finished_at=datetime('now')
+WHERE id=? AND status='executing' AND steps_total > 0 AND steps_done = steps_total
+RETURNING id
+"""
+
+
+async def check_plan_completion(group_id: int, notify_scheduler=None, task_id: Optional[int] = None):
+    """Check plan progress after ``task_id`` finished.
+
+    Queues the steps that were only waiting on it, or cancels everything
+    downstream if it failed or was cancelled, then completes the group once
+    its step counters say every step is done. Neither part scans the group's
+    tasks or logs.
+    """
+    if task_id is not None:
+        ready, skipped = [], []
+        async with transaction() as db:
+            cursor = await db.execute("SELECT status FROM tasks WHERE id=?", (task_id,))
+            row = await cursor.fetchone()
+            await cursor.close()
+            status = row["status"] if row else None
+            if status == "completed":
+                cursor = await db.execute(QUEUE_READY_SQL, (task_id,))
+                ready = [dict(r) for r in await cursor.fetchall()]
+                await cursor.close()
+            elif status in ("failed", "cancelled"):
+                cursor = await db.execute(CANCEL_DEPENDENTS_SQL, (task_id,))
+                skipped = [r["id"] for r in await cursor.fetchall()]
+                await cursor.close()
+        if skipped:
+            steps = ", ".join(f"#{i}" for i in skipped)
+            logger.info(f"Plan group {group_id}: step #{task_id} {status}, cancelled steps {steps}")
+        for t in ready:
+            task_queue.push(t["id"], t["priority"])
+        if ready:
+            steps = ", ".join(f"#{t['id']}" for t in ready)
+            logger.info(f"Plan group {group_id}: queued steps {steps}")
+            if notify_scheduler:
+                notify_scheduler()
+            return
+
+    if await execute_fetch_one(COMPLETE_PLAN_SQL, (group_id,)):
+        forget_plan(group_id)
         logger.info(f"Plan group {group_id} completed")
 
 
@@ -227,20 +308,33 @@ async def get_plan_detail(group_id: int) -> Optional[dict]:
     if not group:
         return None
 
+    # Only a preview of each result; the full text is on /api/tasks/{id}
     tasks = await fetch_all(
-        "SELECT id, prompt, status, result_text, started_at, finished_at FROM tasks WHERE plan_group_id=? ORDER BY id",
+        "SELECT id, prompt, status, substr(result_text, 1, ?) AS result_text, "
+        "length(result_text) > ? AS result_truncated, started_at, finished_at "
+        "FROM tasks WHERE plan_group_id=? ORDER BY id",
+        (RESULT_PREVIEW, RESULT_PREVIEW, group_id),
+    )
+    edges = await fetch_all(
+        "SELECT d.task_id, d.depends_on FROM task_deps d JOIN tasks t ON t.id = d.task_id "
+        "WHERE t.plan_group_id=? ORDER BY d.depends_on",
         (group_id,),
     )
-
-    plan_steps = []
-    try:
-        plan_data = json.loads(group.get("plan_text", "{}") or "{}")
-        plan_steps = plan_data.get("steps", [])
-    except (json.JSONDecodeError, TypeError):
-        pass
+    depends_on: Dict[int, List[int]] = {}
+    for e in edges:
+        depends_on.setdefault(e["task_id"], []).append(e["depends_on"])
+    for t in tasks:
+        t["depends_on"] = depends_on.get(t["id"], [])
 
     return {
         **dict(group),
         "tasks": tasks,
-        "plan_steps": plan_steps,
+        "plan_steps": parse_plan_steps(group.get("plan_text")),
     }
+
+
+def parse_plan_steps(plan_text: Optional[str]) -> List[dict]:
+    try:
+        return json.loads(plan_text or "{}").get("steps", [])
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return []
@@ -1,16 +1,49 @@
 """PROGRESS.md experience distillation — auto-summarize completed tasks."""
 
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
+import asyncio
 import json
 import logging
 import os
+import re
+import shutil
+from datetime import datetime
 
+import db
 from db import execute_returning, fetch_all, fetch_one
 
 logger = logging.getLogger(__name__)
 
-PROGRESS_FILE = "PROGRESS.md"
+PROGRESS_FILE = os.environ.get("CCM_PROGRESS_FILE", "PROGRESS.md")
+PROGRESS_HEADER = "# Progress Notes\n\n"
+# Entries recorded within this window are written to PROGRESS.md together
+EXPORT_DEBOUNCE = float(os.environ.get("CCM_PROGRESS_DEBOUNCE_MS", "2000")) / 1000
+# "month": keep one month per file, archiving older months as PROGRESS-YYYY-MM.md
+PROGRESS_ROTATE = os.environ.get("CCM_PROGRESS_ROTATE", "")
+# The one marker line, right below the header, rewritten on every export;
+# files without it there (new, or from an older version) are rebuilt once
+_MARKER_RE = re.compile(r"<!-- ccm-progress last_id=(\d+) month=([\d-]*) -->\n")
+
+# Rough token budget for the notes injected into a task prompt (~4 chars/token)
+EXPERIENCE_TOKENS = int(os.environ.get("CCM_EXPERIENCE_TOKENS", "400"))
+# Age at which a note's recency boost has halved
+EXPERIENCE_HALF_LIFE_DAYS = float(os.environ.get("CCM_EXPERIENCE_HALF_LIFE_DAYS", "30"))
+# BM25-ranked candidates re-scored with the recency boost
+EXPERIENCE_CANDIDATES = 50
+# Entries scanned by the keyword fallback when FTS5 is unavailable
+FALLBACK_SCAN = 2000
+# Terms in more than this share of notes are too common to rank on
+COMMON_TERM_RATIO = 0.02
+# Column weights for bm25(): summary, lessons, tags
+BM25_WEIGHTS = (1.0, 0.75, 2.0)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in into is it its
+me my not of on or our please should so that the their then there these this to use
+was we were what when where which will with you your
+""".split())
 
 SUMMARIZE_PROMPT = """Analyze the following task and its result. Write a brief experience note with:
 1. What was done (1 sentence)
@@ -32,7 +65,7 @@ async def record_progress(task_id: int, summary: str, lessons: str = "", tags: s
         "INSERT INTO progress_entries (task_id, summary, lessons, tags) VALUES (?, ?, ?, ?)",
         (task_id, summary, lessons, tags),
     )
-    await _rebuild_progress_file()
+    await _exporter.schedule()
 
 
 async def auto_summarize_task(task_id: int) -> Optional[dict]:
@@ -69,47 +102,290 @@ async def save_summary_result(task_id: int, result_text: str):
         "INSERT INTO progress_entries (task_id, summary, lessons, tags) VALUES (?, ?, ?, ?)",
         (task_id, data.get("summary", ""), data.get("lessons", ""), data.get("tags", "")),
     )
-    await _rebuild_progress_file()
+    await _exporter.schedule()
     logger.info(f"Progress entry saved for task {task_id}")
 
 
-async def get_relevant_experience(prompt: str, limit: int = 3) -> str:
-    """Get recent progress entries to inject into a new task's context."""
-    entries = await fetch_all(
-        "SELECT summary, lessons, tags FROM progress_entries ORDER BY id DESC LIMIT ?",
-        (limit,),
+def _query_terms(prompt: str, max_terms: int = 32) -> List[str]:
+    """Distinct, lower-cased content words of the prompt, in order."""
+    terms = []
+    seen = set()
+    for word in _WORD_RE.findall(prompt.lower()):
+        if word in seen or word in _STOPWORDS or word.isdigit():
+            continue
+        if word.isascii() and len(word) < 3:
+            continue
+        seen.add(word)
+        terms.append(word)
+        if len(terms) >= max_terms:
+            break
+    return terms
+
+
+def _recency_boost(age_days: float) -> float:
+    # 1.0 for a brand-new note, tending to 0.5 — old but relevant notes still rank
+    return 0.5 + 0.5 * 0.5 ** (max(age_days, 0.0) / EXPERIENCE_HALF_LIFE_DAYS)
+
+
+async def _selective_terms(terms: List[str]) -> List[str]:
+    """Drop terms that occur in a large share of notes ("fix", "test"...).
+
+    They add little to the ranking but make the MATCH score tens of
+    thousands of rows. If every term is common, keep the two rarest.
+    """
+    placeholders = ",".join("?" * len(terms))
+    rows = await fetch_all(f"SELECT term, doc FROM progress_fts_vocab WHERE term IN ({placeholders})", terms)
+    df = {r["term"]: r["doc"] for r in rows}
+    present = sorted((t for t in terms if t in df), key=lambda t: df[t])
+    if not present:
+        return []
+    total = (await fetch_one("SELECT MAX(id) AS n FROM progress_entries"))["n"] or 0
+    cutoff = max(50, total * COMMON_TERM_RATIO)
+    return [t for t in present if df[t] <= cutoff] or present[:2]
+
+
+async def _search_fts(terms: List[str]) -> List[dict]:
+    terms = await _selective_terms(terms)
+    if not terms:
+        return []
+    match = " OR ".join(f'"{t}"' for t in terms)
+    rows = await fetch_all(
+        "SELECT e.id, e.summary, e.lessons, e.tags, "
+        "julianday('now') - julianday(e.created_at) AS age_days, "
+        f"bm25(progress_fts, {', '.join(str(w) for w in BM25_WEIGHTS)}) AS rank "
+        "FROM progress_fts JOIN progress_entries e ON e.id = progress_fts.rowid "
+        "WHERE progress_fts MATCH ? ORDER BY rank LIMIT ?",
+        (match, EXPERIENCE_CANDIDATES),
     )
+    for r in rows:
+        r["score"] = -r["rank"] * _recency_boost(r["age_days"] or 0.0)  # bm25: lower is better
+    return rows
+
+
+async def _search_keywords(terms: List[str]) -> List[dict]:
+    """Fallback without FTS5: count term hits over the most recent entries."""
+    rows = await fetch_all(
+        "SELECT id, summary, lessons, tags, julianday('now') - julianday(created_at) AS age_days "
+        "FROM progress_entries ORDER BY id DESC LIMIT ?",
+        (FALLBACK_SCAN,),
+    )
+    hits = []
+    for r in rows:
+        words = set(_WORD_RE.findall(f"{r['summary']} {r['lessons'] or ''} {r['tags'] or ''}".lower()))
+        matched = sum(1 for t in terms if t in words)
+        if matched:
+            r["score"] = matched * _recency_boost(r["age_days"] or 0.0)
+            hits.append(r)
+    return hits
+
+
+async def search_experience(prompt: str) -> List[dict]:
+    """Progress entries relevant to the prompt, best first."""
+    terms = _query_terms(prompt)
+    if not terms:
+        return []
+    rows = await (_search_fts(terms) if db.HAS_FTS5 else _search_keywords(terms))
+    rows.sort(key=lambda r: r["score"], reverse=True)
+    return rows
+
+
+async def get_relevant_experience(prompt: str, limit: int = 3, max_tokens: int = EXPERIENCE_TOKENS) -> str:
+    """Experience notes relevant to the prompt, to inject into a new task's
+    context. Returns "" when nothing matches — unrelated notes only cost tokens."""
+    entries = await search_experience(prompt)
     if not entries:
         return ""
 
-    lines = ["## Recent Experience Notes"]
+    lines = ["## Relevant Experience Notes"]
+    budget = max_tokens * 4  # chars
+    picked = 0
     for e in entries:
-        lines.append(f"- {e['summary']}")
+        note = [f"- {e['summary']}"]
         if e["lessons"]:
-            lines.append(f"  Lessons: {e['lessons']}")
-    return "\n".join(lines)
+            note.append(f"  Lessons: {e['lessons']}")
+        size = sum(len(n) + 1 for n in note)
+        if size > budget:
+            continue  # a shorter, lower-ranked note may still fit
+        lines.extend(note)
+        budget -= size
+        picked += 1
+        if picked >= limit:
+            break
+    return "\n".join(lines) if picked else ""
 
 
-async def _rebuild_progress_file():
-    """Rebuild PROGRESS.md from all entries."""
-    entries = await fetch_all(
-        "SELECT * FROM progress_entries ORDER BY created_at DESC"
-    )
+def _render_entry(e: dict) -> str:
+    lines = [f"### Task #{e.get('task_id', '?')} — {e['created_at']}", f"{e['summary']}"]
+    if e["lessons"]:
+        lines.append(f"\n**Lessons:** {e['lessons']}")
+    if e["tags"]:
+        lines.append(f"\n*Tags: {e['tags']}*")
+    lines.append("")
+    return "\n".join(lines) + "\n"
 
-    lines = ["# Progress Notes\n"]
-    for e in entries:
-        lines.append(f"### Task #{e.get('task_id', '?')} — {e['created_at']}")
-        lines.append(f"{e['summary']}")
-        if e["lessons"]:
-            lines.append(f"\n**Lessons:** {e['lessons']}")
-        if e["tags"]:
-            lines.append(f"\n*Tags: {e['tags']}*")
-        lines.append("")
-
-    content = "\n".join(lines)
-    with open(PROGRESS_FILE, "w", encoding="utf-8") as f:
-        f.write(content)
-    logger.info(f"PROGRESS.md updated ({len(entries)} entries)")
+
+def _marker(last_id: int, month: Optional[str]) -> str:
+    return f"<!-- ccm-progress last_id={last_id} month={month or ''} -->\n\n"
+
+
+def _read_marker(path: str) -> Tuple[Optional[int], Optional[str]]:
+    """(last exported id, month) from the marker below the header, or (None, None)."""
+    try:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            head = f.read(len(PROGRESS_HEADER) + 128)
+    except FileNotFoundError:
+        return None, None
+    if not head.startswith(PROGRESS_HEADER):
+        return None, None
+    m = _MARKER_RE.match(head, len(PROGRESS_HEADER))
+    if not m:
+        return None, None
+    return int(m.group(1)), m.group(2) or None
+
+
+def _write_file(path: str, blocks: List[str], last_id: int, month: Optional[str], keep_old: bool = False):
+    """Write header, marker and ``blocks`` (newest first) to a temp file and
+    rename it over ``path``. With ``keep_old`` the entries already in
+    ``path`` are streamed in below the new ones. Runs in a thread."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as out:
+        out.write(PROGRESS_HEADER)
+        out.write(_marker(last_id, month))
+        out.writelines(blocks)
+        if keep_old:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    f.read(len(PROGRESS_HEADER))
+                    f.readline()  # old marker
+                    f.readline()  # and the blank line after it
+                    shutil.copyfileobj(f, out)
+            except FileNotFoundError:
+                pass
+    os.replace(tmp, path)
+
+
+def _archive_path(month: str) -> str:
+    root, ext = os.path.splitext(PROGRESS_FILE)
+    return f"{root}-{month}{ext}"
+
+
+class ProgressExporter:
+    """Keeps PROGRESS.md in sync with progress_entries off the hot path.
+
+    ``schedule()`` only sets a flag; one background task waits out the
+    debounce window, reads only the entries added since the last export
+    (the id in the marker line below the header) and prepends them, so the
+    file stays newest-first. The DB query is incremental; the file is
+    streamed into a temp file and renamed over, so readers never see a
+    half-written file. All file I/O runs in a worker thread. A file without
+    the marker is rebuilt from the table. With CCM_PROGRESS_ROTATE=month
+    the file holds one month, which bounds that copy; at a month boundary
+    it is renamed to PROGRESS-YYYY-MM.md and a new one is started.
+    """
+
+    def __init__(self, debounce: float = EXPORT_DEBOUNCE, rotate: str = PROGRESS_ROTATE):
+        self.debounce = debounce
+        self.rotate = rotate
+        self._pending = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+        self._pending.set()  # catch up on entries added while we were down
+
+    async def stop(self):
+        """Skip the rest of the debounce wait, write anything pending, stop."""
+        if not self.running:
+            return
+        self._stopping.set()
+        self._pending.set()
+        await self._task
+        self._task = None
+
+    async def schedule(self):
+        if self.running:
+            self._pending.set()
+        else:
+            await self.export()  # scripts / tests: no background task
+
+    async def _run(self):
+        # Not cancelled on stop: an export may be mid-write in a thread
+        while not self._stopping.is_set():
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.debounce)
+            except asyncio.TimeoutError:
+                pass
+            self._pending.clear()
+            try:
+                await self.export()
+            except Exception:
+                logger.exception("PROGRESS.md export failed")
+
+    async def export(self):
+        loop = asyncio.get_running_loop()
+        last_id, month = await loop.run_in_executor(None, _read_marker, PROGRESS_FILE)
+
+        if last_id is None:
+            # No marker (first run or a file from an older version): full rebuild
+            if self.rotate == "month":
+                month = _month_now()
+                entries = await fetch_all(
+                    "SELECT * FROM progress_entries WHERE substr(created_at, 1, 7) >= ? ORDER BY id DESC",
+                    (month,),
+                )
+            else:
+                entries = await fetch_all("SELECT * FROM progress_entries ORDER BY id DESC")
+            top = await fetch_one("SELECT COALESCE(MAX(id), 0) AS id FROM progress_entries")
+            await loop.run_in_executor(
+                None, _write_file, PROGRESS_FILE, [_render_entry(e) for e in entries], top["id"], month,
+            )
+            logger.info(f"PROGRESS.md rebuilt ({len(entries)} entries)")
+            return
+
+        entries = await fetch_all("SELECT * FROM progress_entries WHERE id > ? ORDER BY id", (last_id,))
+        if not entries:
+            return
+
+        keep_old = True
+        if self.rotate == "month":
+            new_month = entries[-1]["created_at"][:7]
+            if month and new_month != month:
+                archive = _archive_path(month)
+                if not os.path.exists(archive):
+                    await loop.run_in_executor(None, os.replace, PROGRESS_FILE, archive)
+                    logger.info(f"PROGRESS.md rotated to {archive}")
+                    keep_old = False
+            month = new_month
+
+        await loop.run_in_executor(
+            None, _write_file, PROGRESS_FILE, [_render_entry(e) for e in reversed(entries)],
+            entries[-1]["id"], month, keep_old,
+        )
+        logger.info(f"PROGRESS.md: {len(entries)} new entries")
+
+
+def _month_now() -> str:
+    return datetime.utcnow().strftime("%Y-%m")
+
+
+_exporter = ProgressExporter()
+
+
+def start_exporter():
+    _exporter.start()
+
+
+async def stop_exporter():
+    await _exporter.stop()
 
 
 async def get_progress_entries() -> List[dict]:
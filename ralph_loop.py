@@ -1,18 +1,35 @@
 """Ralph Loop scheduler — central dispatcher with worker state tracking."""
 
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Set, Tuple
 
 import asyncio
 import logging
+import os
+import time
+from datetime import datetime
 
-from db import fetch_one, fetch_all, execute
+import metrics
+import task_cache
+import task_queue
+import tracing
+from db import fetch_one, execute
 from runner import run_claude_task
-from worktree import acquire, release
+from worktree import (PoolExhausted, capture_diff, claim_task, head_commit, plan_branch, release,
+                      start_plan_step, merge_plan_step)
 from plan_mode import on_plan_task_complete, check_plan_completion
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_MAX_CONCURRENT = 4
+# Dispatch is driven by notify(); this periodic re-seed of the in-memory queue
+# from the DB only catches tasks queued behind our back (other processes, manual SQL).
+SWEEP_INTERVAL = float(os.environ.get("CCM_SWEEP_INTERVAL", "60"))
+# Worker-state changes within this window go out as one scheduler_status event
+STATUS_COALESCE = float(os.environ.get("CCM_STATUS_COALESCE_MS", "250")) / 1000
+
+QUEUE_DEPTH = metrics.Gauge("ccm_queue_depth", "Tasks waiting in the in-memory dispatch queue")
+WORKERS_IDLE = metrics.Gauge("ccm_workers_idle", "Worker slots without a task")
+WORKERS_TOTAL = metrics.Gauge("ccm_workers", "Worker slots")
 
 
 class Worker:
@@ -34,19 +51,47 @@ class Worker:
             "worktree": self.worktree_name,
         }
 
+    def clear(self):
+        self.status = "idle"
+        self.task_id = None
+        self.task_prompt = ""
+        self.worktree_name = ""
+        self.worktree_id = None
+
+
+class RemoteWorker(Worker):
+    """A slot on a worker agent (agents.py). Tasks run on the agent's machine,
+    in its own worktrees; plan steps are left to local workers."""
+    def __init__(self, agent, slot: int):
+        super().__init__(f"{agent.name}/{slot}")
+        self.agent = agent
+
+    def to_dict(self) -> dict:
+        d = super().to_dict()
+        d["agent"] = self.agent.name
+        return d
+
 
 class RalphLoop:
     def __init__(self, max_concurrent: int = DEFAULT_MAX_CONCURRENT, broadcast=None):
         self.max_concurrent = max_concurrent
         self.broadcast = broadcast
         self.workers: List[Worker] = [Worker(i) for i in range(max_concurrent)]
-        self._running: Dict[int, asyncio.Task] = {}  # worker_id -> asyncio.Task
+        self.remote_workers: List[RemoteWorker] = []
+        self._running: Dict[object, asyncio.Task] = {}  # worker id (int, or "agent/slot") -> asyncio.Task
+        self._procs: Dict[int, object] = {}  # task_id -> runner process handle
+        self._cancel_requested: Set[int] = set()
         self._wake = asyncio.Event()
         self._stop = False
         self._loop_task: Optional[asyncio.Task] = None
+        self._published_workers: Optional[List[dict]] = None
+        self._status_task: Optional[asyncio.Task] = None
 
     def start(self):
         self._stop = False
+        QUEUE_DEPTH.set_function(lambda: len(task_queue.queue))
+        WORKERS_IDLE.set_function(self.idle_count)
+        WORKERS_TOTAL.set_function(lambda: self.max_concurrent)
         self._loop_task = asyncio.create_task(self._loop())
         logger.info(f"Ralph Loop started ({self.max_concurrent} workers)")
 
@@ -59,6 +104,8 @@ class RalphLoop:
                 await self._loop_task
             except asyncio.CancelledError:
                 pass
+        if self._status_task:
+            self._status_task.cancel()
         if self._running:
             await asyncio.gather(*self._running.values(), return_exceptions=True)
         logger.info("Ralph Loop stopped")
@@ -67,9 +114,90 @@ class RalphLoop:
         self._wake.set()
 
     def get_workers(self) -> List[dict]:
-        return [w.to_dict() for w in self.workers]
+        return [w.to_dict() for w in self.workers + self.remote_workers]
+
+    def add_agent(self, agent):
+        """Give a connected worker agent one slot per agent.slots."""
+        self.remote_workers += [RemoteWorker(agent, i) for i in range(agent.slots)]
+        self.notify()
+
+    def remove_agent(self, agent):
+        """Drop an agent's idle slots now; busy ones go when their task returns."""
+        self.remote_workers = [w for w in self.remote_workers
+                               if w.agent is not agent or w.id in self._running]
+        self._publish_workers()
+
+    def _publish_workers(self):
+        """Broadcast worker state if it differs from what clients last saw.
+
+        The first change opens a STATUS_COALESCE window; further changes in
+        it ride along, so a burst of dispatches is one event, not one each.
+        """
+        if not self.broadcast or self._status_task:
+            return
+        if self.get_workers() == self._published_workers:
+            return
+        self._status_task = asyncio.create_task(self._flush_workers())
+
+    async def _flush_workers(self):
+        try:
+            await asyncio.sleep(STATUS_COALESCE)
+        finally:
+            self._status_task = None
+        workers = self.get_workers()
+        if workers == self._published_workers:
+            return  # changed and changed back
+        self._published_workers = workers
+        try:
+            await self.broadcast(0, "scheduler", {
+                "type": "scheduler_status",
+                "workers": workers,
+            })
+        except Exception:
+            logger.exception("scheduler_status broadcast failed")
+
+    async def cancel(self, task_id: int) -> bool:
+        """Kill a task running in this scheduler and wait for it to exit.
+
+        Returns False if no worker here owns the task. The runner records the
+        'cancelled' status and the worktree is released as soon as the
+        process is gone.
+        """
+        if not any(w.task_id == task_id for w in self.workers + self.remote_workers):
+            return False
+        self._cancel_requested.add(task_id)
+        proc = self._procs.get(task_id)
+        if proc:
+            await proc.terminate("cancelled")
+        # else: not spawned yet — _on_proc_start kills it on arrival
+        logger.info(f"Task {task_id} cancel requested")
+        return True
+
+    def _on_proc_start(self, task_id: int, proc):
+        self._procs[task_id] = proc
+        if task_id in self._cancel_requested:
+            asyncio.create_task(proc.terminate("cancelled"))
+
+    def idle_count(self) -> int:
+        return sum(1 for w in self.workers[:self.max_concurrent] if w.id not in self._running)
+
+    def resize(self, max_concurrent: int):
+        """Change the number of worker slots. Busy slots above the new size
+        finish their task and are dropped afterwards."""
+        self.max_concurrent = max(1, max_concurrent)
+        while len(self.workers) < self.max_concurrent:
+            self.workers.append(Worker(len(self.workers)))
+        self._trim_workers()
+        self.notify()
+
+    def _trim_workers(self):
+        while len(self.workers) > self.max_concurrent and self.workers[-1].id not in self._running:
+            self.workers.pop()
 
     async def _loop(self):
+        await task_queue.queue.seed()
+        logger.info(f"Task queue seeded with {len(task_queue.queue)} queued tasks")
+
         while not self._stop:
             self._wake.clear()
 
@@ -77,36 +205,38 @@ class RalphLoop:
             for wid, atask in list(self._running.items()):
                 if atask.done():
                     del self._running[wid]
-                    self.workers[wid].status = "idle"
-                    self.workers[wid].task_id = None
-                    self.workers[wid].task_prompt = ""
-                    self.workers[wid].worktree_name = ""
-                    self.workers[wid].worktree_id = None
-
-            # Find idle workers and dispatch
-            for w in self.workers:
+                    if isinstance(wid, int):
+                        self.workers[wid].clear()
+            # Slots of a lost agent go once their task has been handed back
+            self.remote_workers = [w for w in self.remote_workers if w.id in self._running or not w.agent.closed]
+            for w in self.remote_workers:
+                if w.id not in self._running:
+                    w.clear()
+            self._trim_workers()
+
+            # Find idle workers and dispatch; local slots first, then agents
+            pool_exhausted = False
+            for w in self.workers[:self.max_concurrent] + self.remote_workers:
                 if w.status == "busy" or w.id in self._running:
                     continue
+                remote = isinstance(w, RemoteWorker)
+                if (remote and w.agent.closed) or (pool_exhausted and not remote):
+                    continue
 
-                task_row = await fetch_one(
-                    "SELECT * FROM tasks WHERE status='queued' ORDER BY priority DESC, id ASC LIMIT 1"
-                )
+                try:
+                    task_row, wt = await self._claim_next(remote)
+                except PoolExhausted:
+                    # Tasks wait for a worktree; a finished recycle wakes the loop
+                    pool_exhausted = True
+                    continue
                 if not task_row:
                     break
 
                 task_id = task_row["id"]
-
-                # Acquire worktree
-                wt = await acquire()
                 cwd = wt["path"] if wt else task_row.get("cwd")
                 wt_id = wt["id"] if wt else None
                 wt_name = wt["name"] if wt else ""
 
-                if wt_id:
-                    await execute("UPDATE tasks SET worktree_id=? WHERE id=?", (wt_id, task_id))
-
-                await execute("UPDATE tasks SET status='running' WHERE id=?", (task_id,))
-
                 # Update worker state
                 w.status = "busy"
                 w.task_id = task_id
@@ -114,28 +244,120 @@ class RalphLoop:
                 w.worktree_name = wt_name
                 w.worktree_id = wt_id
 
+                # Plan steps work on, and merge back into, their plan's branch
+                plan_id = task_row["plan_group_id"] if task_row["mode"] == "execute" else None
+                tracing.get(task_id).instant("dispatch", worker=w.id, worktree=wt_name)
                 atask = asyncio.create_task(
-                    self._run_and_release(w, task_id, task_row["prompt"], cwd, wt_id)
+                    self._run_and_release(w, task_id, task_row["prompt"], cwd, wt_id, plan_id, task_row["mode"],
+                                          keep_diff=bool(task_row["cache_key"]))
                 )
                 self._running[w.id] = atask
                 logger.info(f"Worker {w.id}: task {task_id} -> {wt_name or 'no-wt'}")
 
-            # Broadcast worker states
-            if self.broadcast:
-                await self.broadcast(0, "scheduler", {
-                    "type": "scheduler_status",
-                    "workers": self.get_workers(),
-                })
+            # Broadcast worker states (only when changed, coalesced)
+            self._publish_workers()
 
             try:
-                await asyncio.wait_for(self._wake.wait(), timeout=5.0)
+                await asyncio.wait_for(self._wake.wait(), timeout=SWEEP_INTERVAL)
             except asyncio.TimeoutError:
-                pass
+                missing = await task_queue.queue.seed()
+                if missing:
+                    logger.warning(f"Consistency sweep: picked up {missing} queued tasks missing from memory")
+
+    async def _claim_next(self, remote: bool = False) -> Tuple[Optional[dict], Optional[dict]]:
+        """Claim the best queued task together with a worktree.
+
+        The claim is conditional on the task still being queued, so ids that
+        were cancelled, or taken by another scheduler process on the same DB,
+        are skipped at the cost of one transaction and no reads. The id only
+        leaves the queue once claimed, so PoolExhausted keeps it in place.
+
+        A remote slot can't take plan steps, so it claims the best queued task
+        that is not one in a single statement instead of walking the queue.
+        """
+        if remote:
+            return await self._claim_remote(), None
+        while True:
+            task_id = task_queue.queue.peek()
+            if task_id is None:
+                return None, None
+            trace = tracing.start(task_id, task_queue.queue.waited(task_id))
+            try:
+                with trace.measure("claim"):
+                    task_row, wt = await claim_task(task_id)
+            except PoolExhausted:
+                tracing.discard(task_id)
+                raise
+            task_queue.queue.discard(task_id)
+            if task_row:
+                return task_row, wt
+            tracing.discard(task_id)
 
-    async def _run_and_release(self, worker: Worker, task_id: int, prompt: str, cwd: Optional[str], worktree_id: Optional[int]):
+    async def _claim_remote(self) -> Optional[dict]:
+        if not len(task_queue.queue):
+            return None
+        claim_start = time.time()
+        task_row, _ = await claim_task(remote=True)
+        if not task_row:
+            return None
+        task_id = task_row["id"]
+        # The id was only known after the claim: end the queue span where it began
+        waited = max(0.0, task_queue.queue.waited(task_id) - (time.time() - claim_start))
+        task_queue.queue.discard(task_id)
+        tracing.start(task_id, waited, now=claim_start).span("claim", claim_start)
+        return task_row
+
+    async def _run_and_release(self, worker: Worker, task_id: int, prompt: str, cwd: Optional[str],
+                               worktree_id: Optional[int], plan_id: Optional[int] = None, mode: str = "execute",
+                               keep_diff: bool = False):
+        trace = tracing.get(task_id)
         try:
-            status = await run_claude_task(task_id, prompt, cwd=cwd, broadcast=self.broadcast)
+            on_plan_branch = False
+            if plan_id and worktree_id:
+                with trace.measure("checkout", plan=plan_id):
+                    on_plan_branch = await start_plan_step(worktree_id, plan_id)
+            if plan_id and worktree_id and not on_plan_branch:
+                # On BASE_REF the step would miss the changes of the steps it depends on
+                status = "failed"
+                await execute(
+                    "UPDATE tasks SET status='failed', finished_at=?, result_text=? WHERE id=?",
+                    (datetime.utcnow().isoformat(), f"[ccm] cannot start from {plan_branch(plan_id)}", task_id),
+                )
+                logger.warning(f"Task {task_id}: checkout of {plan_branch(plan_id)} failed, step not run")
+            elif isinstance(worker, RemoteWorker):
+                status = await worker.agent.run_task(
+                    task_id, prompt, mode, keep_diff=keep_diff, broadcast=self.broadcast,
+                    on_start=lambda proc: self._on_proc_start(task_id, proc),
+                )
+                if status is None:
+                    logger.warning(f"Worker {worker.id}: agent lost, task {task_id} requeued")
+                    return
+            else:
+                # Cacheable tasks keep a diff of their worktree for resubmissions
+                diff_base = await head_commit(cwd) if keep_diff and worktree_id else None
+                status = await run_claude_task(
+                    task_id, prompt, cwd=cwd, broadcast=self.broadcast,
+                    on_start=lambda proc: self._on_proc_start(task_id, proc),
+                )
+                if diff_base and status == "completed":
+                    with trace.measure("diff"):
+                        diff, truncated = await capture_diff(cwd, diff_base)
+                        await task_cache.save_diff(task_id, diff_base, diff, truncated)
+
+            if on_plan_branch and status == "completed":
+                with trace.measure("merge", plan=plan_id):
+                    ok, note = await merge_plan_step(worktree_id, plan_id, task_id, prompt.split("\n", 1)[0])
+                if ok:
+                    logger.info(f"Task {task_id}: {note}")
+                else:
+                    logger.warning(f"Task {task_id}: {note}")
+                    status = "failed"
+                    await execute(
+                        "UPDATE tasks SET status='failed', result_text=COALESCE(result_text, '') || ? WHERE id=?",
+                        (f"\n\n[ccm] {note}", task_id),
+                    )
 
+            hooks_start = time.time()
             task = await fetch_one("SELECT * FROM tasks WHERE id=?", (task_id,))
             if task:
                 # Handle plan mode: parse plan JSON and transition to "reviewing"
@@ -148,12 +370,14 @@ class RalphLoop:
                 # Check if all subtasks in a plan group are done / queue next step
                 if task.get("plan_group_id"):
                     try:
-                        await check_plan_completion(task["plan_group_id"], notify_scheduler=self.notify)
+                        await check_plan_completion(task["plan_group_id"], notify_scheduler=self.notify, task_id=task_id)
                     except Exception:
                         logger.exception(f"Plan group check failed for task {task_id}")
+            trace.span("plan_hooks", hooks_start)
 
             # Auto-progress: summarize completed tasks
             if status == "completed":
+                progress_start = time.time()
                 try:
                     from progress import auto_summarize_task, save_summary_result
                     summary_info = await auto_summarize_task(task_id)
@@ -172,11 +396,16 @@ class RalphLoop:
                             )
                 except Exception:
                     logger.exception(f"Auto-progress failed for task {task_id}")
+                trace.span("auto_progress", progress_start)
 
         except Exception:
             logger.exception(f"Worker {worker.id}: task {task_id} failed")
             await execute("UPDATE tasks SET status='failed' WHERE id=?", (task_id,))
         finally:
+            self._procs.pop(task_id, None)
+            self._cancel_requested.discard(task_id)
             if worktree_id:
-                await release(worktree_id)
+                with trace.measure("release"):
+                    await release(worktree_id, notify=self.notify, task_id=task_id)
+            await tracing.finish(task_id)
             self._wake.set()
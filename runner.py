@@ -1,25 +1,66 @@
 """Claude Code subprocess runner with stream-json parsing."""
 
-from typing import Optional, List
+from typing import Optional, List, AsyncIterator, Tuple
 
 import asyncio
 import json
 import logging
 import os
+import re
+import shlex
+import signal
 import subprocess
+import sys
 import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
 from datetime import datetime
 
-from db import execute, execute_returning
+import log_ingest
+import log_policy
+import metrics
+import tracing
+from db import execute
 
 logger = logging.getLogger(__name__)
 
-CLAUDE_CMD = "claude"
+# Command that starts the CLI, split like a shell would; point it at
+# tools/fake_claude.py for load tests
+CLAUDE_CMD = shlex.split(os.environ.get("CCM_CLAUDE_CMD", "claude"), posix=sys.platform != "win32")
+
+# "asyncio": pipes read on the event loop, no thread per task (POSIX).
+# "thread": Popen + reader thread, needed on Windows where the default
+# event loop may not support subprocess pipes.
+RUNNER_BACKEND = os.environ.get("CCM_RUNNER_BACKEND", "thread" if sys.platform == "win32" else "asyncio")
+# Longest stream-json line we buffer; longer lines are dropped, not fatal
+STREAM_LIMIT = int(os.environ.get("CCM_STREAM_LIMIT", str(16 * 1024 * 1024)))
+# Only the tail of stderr is kept for the failure message
+STDERR_TAIL = 64 * 1024
+# Per-task limits (seconds, 0 = off): total run time, and time without any output
+TASK_TIMEOUT = float(os.environ.get("CCM_TASK_TIMEOUT", "0"))
+IDLE_TIMEOUT = float(os.environ.get("CCM_IDLE_TIMEOUT", "900"))
+# Time between SIGTERM and SIGKILL when stopping a task
+KILL_GRACE = float(os.environ.get("CCM_KILL_GRACE", "5"))
+WATCHDOG_INTERVAL = 1.0
+
+TASK_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+FIRST_EVENT_SECONDS = metrics.Histogram(
+    "ccm_task_first_event_seconds", "Spawn of the claude process to its first stream-json line",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30, 60),
+)
+TASK_SECONDS = metrics.Histogram("ccm_task_duration_seconds", "Task run time, spawn to exit", ["status"],
+                                 buckets=TASK_BUCKETS)
+TASK_LINES = metrics.Counter("ccm_task_lines_total", "stream-json lines read from claude processes")
+TASK_LINE_RATE = metrics.Histogram(
+    "ccm_task_lines_per_second", "Average stream-json lines per second of each finished task",
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+TASKS_RUNNING = metrics.Gauge("ccm_tasks_running", "claude processes currently running")
 
 
 def build_claude_args(prompt: str, cwd: Optional[str] = None, verbose: bool = True) -> List[str]:
-    args = [
-        CLAUDE_CMD,
+    args = CLAUDE_CMD + [
         "-p", prompt,
         "--dangerously-skip-permissions",
         "--output-format", "stream-json",
@@ -33,63 +74,281 @@ def build_claude_args(prompt: str, cwd: Optional[str] = None, verbose: bool = Tr
 
 def classify_event(data: dict) -> str:
     """Classify a stream-json event into a category."""
-    etype = data.get("type", "")
-    if etype == "assistant":
-        return "assistant"
-    if etype == "tool_use":
-        return "tool_use"
-    if etype == "tool_result":
-        return "tool_result"
-    if etype == "result":
-        return "result"
-    if etype == "error":
-        return "error"
+    return classify_type(data.get("type", ""))
+
+
+def classify_type(etype: str) -> str:
+    """Category for a raw stream-json ``type`` value."""
+    if etype in ("assistant", "tool_use", "tool_result", "result", "error"):
+        return etype
     # content_block events
     if etype in ("content_block_start", "content_block_delta", "content_block_stop"):
         return "assistant"
-    if etype == "message_start":
-        return "system"
-    if etype == "message_delta":
-        return "system"
-    if etype == "message_stop":
-        return "system"
+    # message_start / message_delta / message_stop and anything unknown
     return "system"
 
 
-async def run_claude_task(
-    task_id: int,
-    prompt: str,
-    cwd: Optional[str] = None,
-    broadcast=None,
-):
-    """Run a claude CLI subprocess and stream results.
+# Matches lines whose first key is "type" — the shape claude emits
+_TYPE_PREFIX = re.compile(r'\s*\{\s*"type"\s*:\s*"([A-Za-z_]+)"')
+# Events whose contents we read (result/cost, errors, fragments to merge).
+# Everything else is classified from the prefix and passed on as the
+# original line, never decoded or re-encoded.
+DECODE_TYPES = frozenset({"result", "error", "content_block_start", "content_block_delta"})
 
-    Args:
-        task_id: DB task id
-        prompt: The prompt to send
-        cwd: Working directory for the subprocess
-        broadcast: async callable(task_id, event_type, payload_dict) for WebSocket push
+
+def parse_line(line: str) -> Tuple[str, str, Optional[dict]]:
+    """Split one stdout line into (type, json_text, decoded).
+
+    ``decoded`` is None for events taken on the prefix fast path. Lines that
+    are not JSON objects are wrapped as ``{"type": "raw"}`` events. The fast
+    path needs the closing brace, so a line cut short (process killed
+    mid-write, partial last line at EOF) is decoded, fails, and goes out raw
+    rather than as broken JSON spliced into the WebSocket message.
     """
-    args = build_claude_args(prompt, cwd)
-    logger.info(f"[Task {task_id}] Starting: {' '.join(args[:6])}...")
+    m = _TYPE_PREFIX.match(line)
+    if m and m.group(1) not in DECODE_TYPES and line.endswith("}"):
+        return m.group(1), line, None
+    try:
+        data = json.loads(line)
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        data = {"type": "raw", "text": line}
+        return "raw", json.dumps(data, ensure_ascii=False), data
+    return data.get("type", ""), line, data
 
-    await execute(
-        "UPDATE tasks SET status='running', started_at=? WHERE id=?",
-        (datetime.utcnow().isoformat(), task_id),
-    )
 
-    result_text = ""
-    cost_usd = 0.0
-    loop = asyncio.get_event_loop()
+# Tool names in an assistant message, read off the raw line for trace spans
+_TOOL_USE = re.compile(r'"type"\s*:\s*"tool_use"\s*,\s*"id"\s*:\s*"[^"]*"\s*,\s*"name"\s*:\s*"([^"]+)"')
 
-    try:
-        # Use subprocess.Popen in a thread to avoid Windows asyncio issues
-        # Remove CLAUDECODE env var to allow nested sessions
-        env = dict(os.environ)
-        env.pop("CLAUDECODE", None)
-        env.pop("CLAUDE_CODE_ENTRYPOINT", None)
-        env["PYTHONIOENCODING"] = "utf-8"
-        proc = subprocess.Popen(
+
+class StreamTrace:
+    """Turns the stream into trace spans: "boot" until the first line, then
+    alternating "model" (claude generating) and "tool" (tool_use sent, its
+    tool_result not back yet) spans, closed by the result event.
+
+    Works from the event type and cheap substring checks on the raw line;
+    nothing is decoded for it.
+    """
+
+    def __init__(self, trace: tracing.TaskTrace, spawned_at: float):
+        self.trace = trace
+        self.phase = "boot"
+        self.since = spawned_at
+        self.args: dict = {}
+        self.pending = 0  # tool_results still expected
+        self.first_token = False
+
+    def _switch(self, phase: str, now: float, **args):
+        if self.phase:
+            self.trace.span(self.phase, self.since, now, **self.args)
+        self.phase, self.since, self.args = phase, now, args
+
+    def line(self, etype: str, text: str, data: Optional[dict]):
+        if self.phase == "boot":
+            self._switch("model", time.time())
+        if not self.first_token and etype in ("assistant", "content_block_start", "content_block_delta"):
+            self.first_token = True
+            self.trace.instant("first_token")
+
+        names = None
+        if etype == "assistant" and '"tool_use"' in text:
+            names = _TOOL_USE.findall(text) or ["?"]
+        elif etype == "content_block_start" and (data.get("content_block") or {}).get("type") == "tool_use":
+            names = [data["content_block"].get("name") or "?"]
+        if names:
+            if self.phase == "tool":
+                self.args["tools"] += "," + ",".join(names)
+            else:
+                self._switch("tool", time.time(), tools=",".join(names))
+            self.pending += len(names)
+        elif self.phase == "tool" and etype in ("user", "tool_result"):
+            self.pending -= max(1, text.count('"tool_result"'))
+            if self.pending <= 0:
+                self.pending = 0
+                self._switch("model", time.time())
+        elif etype == "result":
+            now = time.time()
+            self._switch("", now)
+            self.trace.instant("result", now)
+
+    def close(self):
+        self._switch("", time.time())
+
+
+def _child_env() -> dict:
+    # Remove CLAUDECODE env var to allow nested sessions
+    env = dict(os.environ)
+    env.pop("CLAUDECODE", None)
+    env.pop("CLAUDE_CODE_ENTRYPOINT", None)
+    env["PYTHONIOENCODING"] = "utf-8"
+    return env
+
+
+class _ChildProcess(ABC):
+    """What both backends share: stop bookkeeping and process-tree kill.
+
+    The child is started as the leader of its own process group (its own
+    console group on Windows), so stopping it also takes down the tools and
+    shells claude spawned. Backends supply the I/O and waiting below.
+    """
+
+    proc = None
+
+    def __init__(self):
+        self.last_output = time.monotonic()
+        self.stop_reason: Optional[str] = None  # "cancelled" or a timeout description
+
+    def _popen_kwargs(self) -> dict:
+        if sys.platform == "win32":
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    def _signal_tree(self, force: bool):
+        pid = self.proc.pid
+        try:
+            if sys.platform == "win32":
+                if force:
+                    subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)], capture_output=True)
+                else:
+                    self.proc.terminate()
+            else:
+                os.killpg(pid, signal.SIGKILL if force else signal.SIGTERM)
+        except (ProcessLookupError, PermissionError, OSError):
+            pass  # already gone
+
+    @abstractmethod
+    async def start(self, args: List[str], cwd: Optional[str], env: dict):
+        ...
+
+    @abstractmethod
+    def lines(self) -> AsyncIterator[str]:
+        """stdout, one stripped line at a time."""
+
+    @abstractmethod
+    async def wait(self) -> int:
+        ...
+
+    @abstractmethod
+    async def _wait_exit(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds; True if the process has exited."""
+
+    @abstractmethod
+    def stderr_text(self) -> str:
+        ...
+
+    def exited(self) -> bool:
+        return self.proc is None or self.proc.returncode is not None
+
+    async def terminate(self, reason: str):
+        """SIGTERM the process group, SIGKILL after KILL_GRACE, wait for exit."""
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        if self.exited():
+            return
+        self._signal_tree(force=False)
+        if not await self._wait_exit(KILL_GRACE):
+            self._signal_tree(force=True)
+            await self._wait_exit(KILL_GRACE)
+
+
+class AsyncioProcess(_ChildProcess):
+    """claude child on asyncio pipes. stdout and stderr are drained
+    concurrently with bounded buffers, so a chatty stderr cannot fill its
+    pipe and stall the child."""
+
+    def __init__(self):
+        super().__init__()
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self._stderr = deque()
+        self._stderr_size = 0
+        self._stderr_task: Optional[asyncio.Task] = None
+
+    async def start(self, args: List[str], cwd: Optional[str], env: dict):
+        self.proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            limit=STREAM_LIMIT,
+            **self._popen_kwargs(),
+        )
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+
+    async def _drain_stderr(self):
+        while True:
+            chunk = await self.proc.stderr.read(65536)
+            if not chunk:
+                return
+            self._stderr.append(chunk)
+            self._stderr_size += len(chunk)
+            while self._stderr_size > STDERR_TAIL and len(self._stderr) > 1:
+                self._stderr_size -= len(self._stderr.popleft())
+
+    async def lines(self) -> AsyncIterator[str]:
+        stdout = self.proc.stdout
+        while True:
+            try:
+                raw = await stdout.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                raw = e.partial  # last line without a newline, or EOF
+                if not raw:
+                    return
+            except asyncio.LimitOverrunError as e:
+                size = await self._skip_line(e.consumed)
+                logger.warning(f"Dropped oversized stream-json line ({size} bytes)")
+                yield json.dumps({"type": "system", "subtype": "oversized_line", "bytes": size})
+                continue
+            line = raw.decode("utf-8", errors="replace").strip()
+            if line:
+                yield line
+
+    async def _skip_line(self, consumed: int) -> int:
+        """Discard the rest of a line longer than STREAM_LIMIT."""
+        stdout = self.proc.stdout
+        skipped = 0
+        while True:
+            await stdout.readexactly(consumed)
+            skipped += consumed
+            try:
+                skipped += len(await stdout.readuntil(b"\n"))
+                return skipped
+            except asyncio.IncompleteReadError as e:
+                return skipped + len(e.partial)
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+
+    async def wait(self) -> int:
+        returncode = await self.proc.wait()
+        if self._stderr_task:
+            await self._stderr_task
+        return returncode
+
+    async def _wait_exit(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stderr_text(self) -> str:
+        return b"".join(self._stderr).decode("utf-8", errors="replace").strip()
+
+
+class ThreadedProcess(_ChildProcess):
+    """Popen + reader thread — fallback for platforms without asyncio pipes."""
+
+    def __init__(self):
+        super().__init__()
+        self.proc: Optional[subprocess.Popen] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._stderr = deque()
+        self._stderr_thread: Optional[threading.Thread] = None
+
+    async def start(self, args: List[str], cwd: Optional[str], env: dict):
+        loop = asyncio.get_event_loop()
+        self.proc = subprocess.Popen(
             args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -97,10 +356,13 @@ async def run_claude_task(
             env=env,
             encoding="utf-8",
             errors="replace",
+            **self._popen_kwargs(),
         )
 
         # Read stdout lines in a thread, push to an asyncio queue
-        queue = asyncio.Queue()
+        self._queue = asyncio.Queue()
+        self._stderr = deque()
+        proc, queue, stderr = self.proc, self._queue, self._stderr
 
         def _reader():
             try:
@@ -111,34 +373,155 @@ async def run_claude_task(
             finally:
                 loop.call_soon_threadsafe(queue.put_nowait, None)  # sentinel
 
+        # Keep stderr flowing too, or a chatty child blocks on a full pipe
+        def _stderr_reader():
+            size = 0
+            for chunk in iter(lambda: proc.stderr.read(8192), ""):
+                stderr.append(chunk)
+                size += len(chunk)
+                while size > STDERR_TAIL and len(stderr) > 1:
+                    size -= len(stderr.popleft())
+
         reader_thread = threading.Thread(target=_reader, daemon=True)
         reader_thread.start()
+        self._stderr_thread = threading.Thread(target=_stderr_reader, daemon=True)
+        self._stderr_thread.start()
 
+    async def lines(self) -> AsyncIterator[str]:
         while True:
-            line = await queue.get()
+            line = await self._queue.get()
             if line is None:
-                break
+                return
+            yield line
+
+    async def wait(self) -> int:
+        loop = asyncio.get_event_loop()
+        returncode = await loop.run_in_executor(None, self.proc.wait)
+        await loop.run_in_executor(None, self._stderr_thread.join)
+        return returncode
+
+    async def _wait_exit(self, timeout: float) -> bool:
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self.proc.wait, timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+
+    def stderr_text(self) -> str:
+        return "".join(self._stderr).strip()
+
+
+def install_child_watcher():
+    """Use a pidfd child watcher where available (Linux, Python < 3.12).
+
+    The default ThreadedChildWatcher parks one thread per child in waitpid,
+    which is exactly the thread-per-task cost the asyncio backend avoids.
+    Python 3.12+ already picks pidfd by default.
+    """
+    if RUNNER_BACKEND != "asyncio" or sys.version_info >= (3, 12) or not hasattr(os, "pidfd_open"):
+        return
+    try:
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(asyncio.get_running_loop())
+        asyncio.set_child_watcher(watcher)
+        logger.info("Using pidfd child watcher")
+    except (AttributeError, OSError, NotImplementedError):
+        logger.info("pidfd child watcher unavailable, using asyncio default")
+
+
+async def _watchdog(task_id: int, proc: _ChildProcess, started: float):
+    """Stop a task that runs too long or goes quiet for too long."""
+    while not proc.exited():
+        await asyncio.sleep(WATCHDOG_INTERVAL)
+        now = time.monotonic()
+        if TASK_TIMEOUT and now - started > TASK_TIMEOUT:
+            reason = f"timed out after {TASK_TIMEOUT:.0f}s"
+        elif IDLE_TIMEOUT and now - proc.last_output > IDLE_TIMEOUT:
+            reason = f"no output for {IDLE_TIMEOUT:.0f}s"
+        else:
+            continue
+        logger.warning(f"[Task {task_id}] Stopping: {reason}")
+        await proc.terminate(reason)
+        return
+
+
+def _new_process():
+    return AsyncioProcess() if RUNNER_BACKEND == "asyncio" else ThreadedProcess()
 
-            try:
-                data = json.loads(line)
-            except json.JSONDecodeError:
-                data = {"type": "raw", "text": line}
 
-            event_type = classify_event(data)
-            payload_str = json.dumps(data, ensure_ascii=False)
+async def run_claude_task(
+    task_id: int,
+    prompt: str,
+    cwd: Optional[str] = None,
+    broadcast=None,
+    on_start=None,
+):
+    """Run a claude CLI subprocess and stream results.
+
+    Args:
+        task_id: DB task id
+        prompt: The prompt to send
+        cwd: Working directory for the subprocess
+        broadcast: async callable(task_id, event_type, payload, log_id=None)
+            for WebSocket push; payload is the event's JSON text, not a dict
+        on_start: callable(process) invoked once the child is spawned, so the
+            caller can cancel it via ``await process.terminate("cancelled")``
+    """
+    args = build_claude_args(prompt, cwd)
+    logger.info(f"[Task {task_id}] Starting: {' '.join(args[:6])}...")
 
-            # Store log
-            await execute_returning(
-                "INSERT INTO task_logs (task_id, event_type, payload) VALUES (?, ?, ?)",
-                (task_id, event_type, payload_str),
-            )
+    await execute(
+        "UPDATE tasks SET status='running', started_at=? WHERE id=?",
+        (datetime.utcnow().isoformat(), task_id),
+    )
 
-            # Broadcast via WebSocket
+    result_text = ""
+    cost_usd = 0.0
+
+    proc = _new_process()
+    task_log = log_policy.TaskLog(task_id)
+    watchdog = None
+    lines = 0
+    lines_counter = TASK_LINES.labels()
+    spawned = time.monotonic()
+    trace = tracing.get(task_id)
+    stream_trace = None
+    TASKS_RUNNING.inc()
+    try:
+        spawn_at = time.time()
+        await proc.start(args, cwd, _child_env())
+        trace.span("spawn", spawn_at)
+        if trace is not tracing.NULL_TRACE:
+            stream_trace = StreamTrace(trace, time.time())
+        if on_start:
+            on_start(proc)
+        if TASK_TIMEOUT or IDLE_TIMEOUT:
+            watchdog = asyncio.create_task(_watchdog(task_id, proc, time.monotonic()))
+
+        async for line in proc.lines():
+            proc.last_output = time.monotonic()
+            if not lines:
+                FIRST_EVENT_SECONDS.observe(proc.last_output - spawned)
+            lines += 1
+            lines_counter.inc()
+            etype, text, data = parse_line(line)
+            event_type = classify_type(etype)
+            if stream_trace:
+                stream_trace.line(etype, text, data)
+
+            # Store log (filtered/merged/compressed by the policy, batched by the writer)
+            log_id = None
+            for row in task_log.feed(event_type, etype, text, data):
+                log_id = await log_ingest.append(task_id, *row)
+
+            # Broadcast via WebSocket — the line goes out as already-encoded JSON
+            # (log_id lets reconnecting clients resume)
             if broadcast:
-                await broadcast(task_id, event_type, data)
+                await broadcast(task_id, event_type, text, log_id=log_id)
 
             # Extract result
-            if data.get("type") == "result":
+            if etype == "result":
                 result_text = data.get("result", "")
                 cost_usd = data.get("cost_usd", 0) or 0
                 usage = data.get("usage", {})
@@ -147,14 +530,27 @@ async def run_claude_task(
                     output_tokens = usage.get("output_tokens", 0)
                     cost_usd = (input_tokens * 0.015 + output_tokens * 0.075) / 1000
 
+        if stream_trace:
+            stream_trace.close()
+            stream_trace = None
+
         # Wait for process to finish
-        returncode = await loop.run_in_executor(None, proc.wait)
+        with trace.measure("exit"):
+            returncode = await proc.wait()
 
-        if returncode == 0:
+        if proc.stop_reason == "cancelled":
+            status = "cancelled"
+            result_text = result_text or "Cancelled"
+        elif proc.stop_reason:
+            status = "failed"
+            result_text = f"Stopped: {proc.stop_reason}"
+        elif returncode == 0:
             status = "completed"
+            # Captured while streaming, so nobody has to rescan task_logs for it
+            result_text = result_text or task_log.final_text()
         else:
             status = "failed"
-            stderr_text = proc.stderr.read().strip()
+            stderr_text = proc.stderr_text()
             if stderr_text and not result_text:
                 result_text = f"Process exited with code {returncode}: {stderr_text}"
 
@@ -162,11 +558,36 @@ async def run_claude_task(
         logger.exception(f"[Task {task_id}] Error")
         status = "failed"
         result_text = str(e)
+        if not proc.exited():
+            await proc.terminate("runner error")
+    finally:
+        if watchdog:
+            watchdog.cancel()
+        if stream_trace:
+            stream_trace.close()
+        TASKS_RUNNING.dec()
+        elapsed = time.monotonic() - spawned
+        if elapsed > 0 and lines:
+            TASK_LINE_RATE.observe(lines / elapsed)
+
+    finalize_at = time.time()
+    rows = task_log.finish()
+    if proc.stop_reason:
+        stopped = {"type": "system", "subtype": "stopped", "reason": proc.stop_reason}
+        rows += task_log.feed("system", "system", json.dumps(stopped), stopped)
+    for row in rows:
+        await log_ingest.append(task_id, *row)
+
+    # Make sure every log row (incl. the result event) is on disk before the
+    # task is marked finished — plan completion reads it right after.
+    await log_ingest.flush()
 
     await execute(
         "UPDATE tasks SET status=?, finished_at=?, result_text=?, cost_usd=? WHERE id=?",
         (status, datetime.utcnow().isoformat(), result_text, cost_usd, task_id),
     )
 
+    trace.span("finalize", finalize_at, status=status)
+    TASK_SECONDS.labels(status).observe(elapsed)
     logger.info(f"[Task {task_id}] Finished with status={status}")
     return status
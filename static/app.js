@@ -1,5 +1,8 @@
 /* CCM — Frontend Logic */
 var currentTab = 'all', selectedTaskId = null, logWs = null, eventsWs = null, tasks = [];
+var lastLogId = 0, firstLogId = 0;
+var changesVersion = 0;  // last change-feed version applied to `tasks`
+var tasksNextBeforeId = null;  // cursor for the next older page of tasks, null = none left
 
 async function api(path, opts) {
     opts = opts || {};
@@ -10,7 +13,7 @@ async function api(path, opts) {
 
 // --- Init ---
 document.addEventListener('DOMContentLoaded', function() {
-    refreshAll(); connectEvents(); setInterval(refreshAll, 8000);
+    bootstrap(); connectEvents();
     document.getElementById('quickInput').addEventListener('keydown', function(e) {
         if (e.key === 'Enter' && !e.shiftKey) { e.preventDefault(); quickSend(); }
     });
@@ -18,6 +21,63 @@ document.addEventListener('DOMContentLoaded', function() {
 
 async function refreshAll() { await Promise.all([refreshStatus(), refreshTasks()]); }
 
+// --- Change feed: full load once, then patch from deltas on /ws/events ---
+async function bootstrap() {
+    // Version first: deltas after it are re-applied over the snapshot (idempotent)
+    try { changesVersion = (await api('/api/changes')).version; } catch(e) { console.error(e); }
+    tasks = [];  // a reset drops older pages too: they may have missed deltas
+    await refreshAll();
+}
+
+async function catchUp() {
+    try {
+        var c = await api('/api/changes?since='+changesVersion);
+        if (c.reset) { await bootstrap(); return; }
+        applyChanges(c);
+    } catch(e) { console.error(e); }
+}
+
+function applyChanges(c) {
+    (c.changes||[]).forEach(function(ch) {
+        if (ch.entity === 'task') patchTask(ch.id, ch.data);
+        else if (ch.entity === 'plan') patchPlan(ch.id, ch.data);
+    });
+    if (c.counts) renderCounts(c.counts);
+    if (c.version > changesVersion) changesVersion = c.version;
+    renderTasks();
+}
+
+function patchTask(id, data) {
+    var i = tasks.findIndex(function(t){ return t.id === id; });
+    if (!data) { if (i >= 0) tasks.splice(i, 1); return; }
+    if (i >= 0) { tasks[i] = data; }
+    else {
+        // Keep newest-first order
+        var at = tasks.findIndex(function(t){ return t.id < id; });
+        if (at < 0) tasks.push(data); else tasks.splice(at, 0, data);
+    }
+    if (id === selectedTaskId) {
+        var st = document.getElementById('logStatus');
+        st.className = 'tag tag-'+data.status; st.textContent = data.status;
+        document.getElementById('logCancelBtn').style.display = (data.status==='queued'||data.status==='running') ? 'inline-block' : 'none';
+    }
+}
+
+function patchPlan(id, data) {
+    var prev = null;
+    tasks.forEach(function(t) {
+        if (t.plan_group_id !== id) return;
+        if (prev === null) prev = t.plan_status || t.status;
+        if (data) { t.plan_status = data.status; t.plan_goal = data.goal; }
+    });
+    // Auto-open plan review only when a plan finishes generating, not on
+    // later edits or refreshes of a plan already in review
+    if (data && data.status === 'reviewing' && prev === 'planning' && !_lastCheckedPlanIds[id]) {
+        _lastCheckedPlanIds[id] = true;
+        viewPlan(id);
+    }
+}
+
 // --- Quick input ---
 function autoGrow(el) {
     el.style.height = 'auto';
@@ -32,7 +92,12 @@ async function quickSend() {
     if (!text) return;
     _sending = true;
     el.value = ''; el.style.height = 'auto';
-    try { await api('/api/tasks', { method:'POST', body: JSON.stringify({prompt:text}) }); refreshAll(); }
+    try {
+        var res = await api('/api/tasks', { method:'POST', body: JSON.stringify({prompt:text}) });
+        refreshAll();
+        // Same prompt already running or recently done: show that task instead
+        if (res && (res.deduplicated || res.cached)) selectTask(res.id);
+    }
     catch(e) { alert('Failed: '+e.message); }
     finally { _sending = false; }
 }
@@ -41,15 +106,18 @@ async function quickSend() {
 async function refreshStatus() {
     try {
         var s = await api('/api/status');
-        var t = s.tasks || {};
-        document.getElementById('statRunning').textContent = t.running || 0;
-        document.getElementById('statQueued').textContent = t.queued || 0;
-        document.getElementById('statDone').textContent = (t.completed||0);
-        document.getElementById('statFailed').textContent = (t.failed||0);
+        renderCounts(s.tasks || {});
         renderWorkers(s.workers || []);
     } catch(e) { console.error(e); }
 }
 
+function renderCounts(t) {
+    document.getElementById('statRunning').textContent = t.running || 0;
+    document.getElementById('statQueued').textContent = t.queued || 0;
+    document.getElementById('statDone').textContent = (t.completed||0);
+    document.getElementById('statFailed').textContent = (t.failed||0);
+}
+
 function renderWorkers(workers) {
     var el = document.getElementById('workersPanel');
     if (!workers.length) { el.innerHTML = '<div style="padding:4px 0;font-size:12px;color:var(--dim)">No workers</div>'; return; }
@@ -59,15 +127,41 @@ function renderWorkers(workers) {
             ? '<span class="wt">' + esc(w.worktree||'') + '</span> #' + w.task_id + ' ' + esc(w.task_prompt)
             : 'idle';
         return '<div class="worker-card' + cls + '" ' + (w.task_id ? 'onclick="selectTask('+w.task_id+')"' : '') + '>' +
-            '<div class="worker-head"><span class="worker-name">W' + w.id + '</span>' +
+            '<div class="worker-head"><span class="worker-name">' + (w.agent ? esc(w.id) : 'W' + w.id) + '</span>' +
             '<span class="worker-status ' + w.status + '">' + w.status + '</span></div>' +
             '<div class="worker-task">' + taskInfo + '</div></div>';
     }).join('');
 }
 
 // --- Tasks ---
+async function fetchTaskPage(beforeId) {
+    var res = await fetch('/api/tasks?limit=200' + (beforeId ? '&before_id='+beforeId : ''));
+    if (!res.ok) throw new Error(res.statusText);
+    return { tasks: await res.json(), next: res.headers.get('X-Next-Before-Id') };
+}
+
 async function refreshTasks() {
-    try { tasks = await api('/api/tasks'); renderTasks(); } catch(e) { console.error(e); }
+    try {
+        var page = await fetchTaskPage();
+        var oldest = page.tasks.length ? page.tasks[page.tasks.length-1].id : 0;
+        // Older pages already loaded stay; the deltas keep them current
+        var older = tasks.filter(function(t){ return t.id < oldest; });
+        tasks = page.tasks.concat(older);
+        if (!older.length) tasksNextBeforeId = page.next;
+        renderTasks();
+    } catch(e) { console.error(e); }
+}
+
+async function loadMoreTasks() {
+    if (!tasksNextBeforeId) return;
+    try {
+        var page = await fetchTaskPage(tasksNextBeforeId);
+        var seen = {};
+        tasks.forEach(function(t){ seen[t.id] = true; });
+        page.tasks.forEach(function(t){ if (!seen[t.id]) tasks.push(t); });
+        tasksNextBeforeId = page.next;
+        renderTasks();
+    } catch(e) { console.error(e); }
 }
 
 function renderTasks() {
@@ -101,7 +195,10 @@ function renderTasks() {
 
     document.getElementById('badgeAll').textContent = visible.length;
 
-    if (!filtered.length) { list.innerHTML = '<div class="empty-state">No tasks here.</div>'; return; }
+    // Only loaded pages are filtered; older tasks come in with "Load older"
+    var more = tasksNextBeforeId
+        ? '<div class="empty-state" style="cursor:pointer" onclick="loadMoreTasks()">Load older tasks...</div>' : '';
+    if (!filtered.length) { list.innerHTML = '<div class="empty-state">No tasks here.</div>' + more; return; }
     list.innerHTML = filtered.map(function(t) {
         var isPlan = !!t.plan_group_id;
         var displayStatus = isPlan ? (t.plan_status || t.status) : t.status;
@@ -126,7 +223,7 @@ function renderTasks() {
             '<div class="task-top"><span class="task-id">'+planBadge+(isPlan?'plan#'+t.plan_group_id:'#'+t.id)+'</span><span class="tag tag-'+displayStatus+'">'+displayStatus+'</span></div>' +
             '<div class="task-prompt">'+p+'</div>' +
             '<div class="task-meta">'+(cost?'<span>'+cost+'</span>':'')+'<span>'+timeAgo(t.created_at)+'</span></div></div>';
-    }).join('');
+    }).join('') + more;
 }
 
 function switchTab(tab) {
@@ -156,21 +253,54 @@ async function selectTask(id) {
     var st = document.getElementById('logStatus');
     if (task) { st.className = 'tag tag-'+task.status; st.textContent = task.status; }
 
+    document.getElementById('tracePanel').style.display = 'none';
+    lastLogId = 0; firstLogId = 0;
     try {
+        // Detail carries only the newest page of logs; older pages load on demand
         var d = await api('/api/tasks/'+id);
         content.innerHTML = '';
         (d.logs||[]).forEach(function(l){appendLog(l);});
+        if (d.logs && d.logs.length) { firstLogId = d.logs[0].id; lastLogId = d.logs[d.logs.length-1].id; }
+        if (d.logs_truncated) showEarlierLink();
         if (!d.logs||!d.logs.length) content.innerHTML = '<div style="color:var(--dim);padding:8px;font-style:italic">Waiting for output...</div>';
     } catch(e) { content.innerHTML = '<div class="log-entry error">'+e.message+'</div>'; }
 
-    connectTaskWs(id);
+    connectTaskWs(id, lastLogId);
     renderTasks();
     scrollLog();
 }
 
+function showEarlierLink() {
+    var c = document.getElementById('logContent');
+    var a = document.createElement('div');
+    a.id = 'logEarlier';
+    a.className = 'log-entry system';
+    a.style.cursor = 'pointer';
+    a.textContent = 'Load earlier output...';
+    a.onclick = loadEarlierLogs;
+    c.insertBefore(a, c.firstChild);
+}
+
+async function loadEarlierLogs() {
+    var c = document.getElementById('logContent');
+    var link = document.getElementById('logEarlier');
+    if (link) link.remove();
+    try {
+        var logs = await api('/api/tasks/'+selectedTaskId+'/logs?before_id='+firstLogId);
+        var first = c.firstChild;
+        logs.forEach(function(l){ c.insertBefore(logElement(l), first); });
+        if (logs.length) firstLogId = logs[0].id;
+        if (logs.length) showEarlierLink();
+    } catch(e) { console.error(e); }
+}
+
 function appendLog(log) {
     var c = document.getElementById('logContent');
     var ph = c.querySelector('[style*="italic"]'); if (ph) ph.remove();
+    c.appendChild(logElement(log));
+}
+
+function logElement(log) {
     var div = document.createElement('div');
     var payload;
     try { payload = typeof log.payload==='string' ? JSON.parse(log.payload) : log.payload; }
@@ -178,7 +308,7 @@ function appendLog(log) {
     var f = fmtLog(log.event_type, payload);
     div.className = 'log-entry ' + f.cls;
     div.innerHTML = f.html;
-    c.appendChild(div);
+    return div;
 }
 
 function fmtLog(et, p) {
@@ -225,7 +355,44 @@ function fmtLog(et, p) {
 }
 
 function scrollLog() { var c=document.getElementById('logContent'); c.scrollTop=c.scrollHeight; }
-function closeLog() { document.getElementById('logOverlay').style.display='none'; if(logWs){logWs.close();logWs=null;} selectedTaskId=null; renderTasks(); }
+function closeLog() { document.getElementById('logOverlay').style.display='none'; document.getElementById('tracePanel').style.display='none'; selectedTaskId=null; if(logWs){logWs.close();logWs=null;} renderTasks(); }
+
+// --- Trace waterfall ---
+async function toggleTrace() {
+    var panel = document.getElementById('tracePanel');
+    if (panel.style.display !== 'none') { panel.style.display = 'none'; return; }
+    panel.style.display = 'block';
+    panel.innerHTML = '<div class="trace-summary">Loading...</div>';
+    try { renderTrace(await api('/api/tasks/'+selectedTaskId+'/trace')); }
+    catch(e) { panel.innerHTML = '<div class="trace-summary">'+esc(e.message)+'</div>'; }
+}
+
+function renderTrace(t) {
+    var spans = t.traceEvents.filter(function(e){return e.ph==='X'||e.ph==='i';});
+    if (!spans.length) { document.getElementById('tracePanel').innerHTML = '<div class="trace-summary">No spans</div>'; return; }
+    var t0 = Math.min.apply(null, spans.map(function(e){return e.ts;}));
+    var t1 = Math.max.apply(null, spans.map(function(e){return e.ts+(e.dur||0);}));
+    var total = Math.max(t1-t0, 1);
+    spans.sort(function(a,b){return a.ts-b.ts;});
+    var html = '<div class="trace-summary">'+fmtDur(total)+' total'+(t.otherData&&t.otherData.live?' (running)':'')+'</div>';
+    spans.forEach(function(e){
+        var left = (e.ts-t0)/total*100;
+        var label = e.name+(e.args&&e.args.tools?' '+e.args.tools:'');
+        var bar = e.ph==='i'
+            ? '<div class="trace-bar instant" style="left:'+left+'%"></div>'
+            : '<div class="trace-bar '+e.cat+' '+e.name+'" style="left:'+left+'%;width:'+(e.dur/total*100)+'%"></div>';
+        html += '<div class="trace-row" title="'+esc(label)+'"><span class="trace-name">'+esc(label)+'</span>'
+            +'<div class="trace-track">'+bar+'</div>'
+            +'<span class="trace-dur">'+(e.ph==='i'?'':fmtDur(e.dur))+'</span></div>';
+    });
+    document.getElementById('tracePanel').innerHTML = html;
+}
+
+function fmtDur(us) {
+    if (us < 1000) return Math.round(us)+'us';
+    if (us < 1e6) return (us/1000).toFixed(1)+'ms';
+    return (us/1e6).toFixed(2)+'s';
+}
 
 async function cancelTask() {
     if (!selectedTaskId) return;
@@ -234,12 +401,25 @@ async function cancelTask() {
 }
 
 // --- WebSocket ---
-function connectTaskWs(id) {
-    if (logWs) logWs.close();
+function connectTaskWs(id, lastId) {
+    if (logWs) { logWs.onclose = null; logWs.close(); }
     var proto = location.protocol==='https:'?'wss:':'ws:';
-    logWs = new WebSocket(proto+'//'+location.host+'/ws/logs/'+id);
-    logWs.onmessage = function(e) { try { var m=JSON.parse(e.data); appendLog({event_type:m.event_type,payload:m.payload}); scrollLog(); } catch(err){} };
-    logWs.onclose = function() { logWs=null; };
+    // last_id: the server replays anything stored after it, then streams live
+    var ws = new WebSocket(proto+'//'+location.host+'/ws/logs/'+id+'?last_id='+(lastId||0));
+    logWs = ws;
+    ws.onmessage = function(e) {
+        try {
+            var m=JSON.parse(e.data);
+            if (m.log_id) { if (m.log_id <= lastLogId) return; lastLogId = m.log_id; }
+            appendLog({event_type:m.event_type,payload:m.payload}); scrollLog();
+        } catch(err){}
+    };
+    ws.onclose = function() {
+        if (logWs !== ws) return;
+        logWs = null;
+        // Dropped while still open on screen: resume from the last event seen
+        if (selectedTaskId === id) setTimeout(function(){ if (selectedTaskId === id && !logWs) connectTaskWs(id, lastLogId); }, 2000);
+    };
 }
 
 function connectEvents() {
@@ -248,17 +428,19 @@ function connectEvents() {
     eventsWs.onopen = function() {
         document.getElementById('connDot').classList.add('on');
         document.getElementById('connText').textContent = 'connected';
+        // Reconnect: fetch whatever changed while we were away
+        if (changesVersion) catchUp();
     };
     eventsWs.onmessage = function(e) {
         try {
             var m = JSON.parse(e.data);
-            if (m.event_type==='scheduler'||(m.payload&&m.payload.type==='scheduler_status')) {
-                refreshStatus();
+            if (m.event_type==='changes') {
+                // A gap means we missed a batch — ask the server for it
+                if (m.payload.from > changesVersion) catchUp();
+                else applyChanges(m.payload);
             }
-            if (m.payload&&m.payload.type==='result') {
-                refreshAll();
-                // Auto-open plan review if a plan task just completed
-                checkPlanReady();
+            else if (m.event_type==='scheduler'||(m.payload&&m.payload.type==='scheduler_status')) {
+                if (m.payload.workers) renderWorkers(m.payload.workers);
             }
         } catch(err){}
     };
@@ -273,23 +455,6 @@ function connectEvents() {
 var _lastCheckedPlanIds = {};
 var _discussGroupId = null;
 
-async function checkPlanReady() {
-    // Look for plan tasks that just completed — check if their plan group is now "reviewing"
-    try {
-        var planTasks = tasks.filter(function(t){ return t.mode === 'plan' && t.plan_group_id && (t.status === 'completed' || t.status === 'failed'); });
-        for (var i = 0; i < planTasks.length; i++) {
-            var gid = planTasks[i].plan_group_id;
-            if (_lastCheckedPlanIds[gid]) continue;
-            var plan = await api('/api/plan/' + gid);
-            if (plan.status === 'reviewing') {
-                _lastCheckedPlanIds[gid] = true;
-                viewPlan(gid);
-                return;
-            }
-        }
-    } catch(e) {}
-}
-
 function openPlanModal() {
     document.getElementById('planGoal').value='';
     document.getElementById('planGoalPhase').style.display='';
@@ -595,7 +760,8 @@ async function openPlanDetail(gid) {
                     logEl.scrollTop = logEl.scrollHeight;
                     // Stream live if running
                     if (runningTask.status === 'running') {
-                        connectPlanLogWs(runningTask.id, logEl);
+                        var tl = td.logs || [];
+                        connectPlanLogWs(runningTask.id, logEl, tl.length ? tl[tl.length - 1].id : 0);
                     }
                 } catch(e) { logEl.textContent = 'Could not load log.'; }
             } else {
@@ -620,10 +786,10 @@ function closePlanDetail() {
     if (_planDetailLogWs) { _planDetailLogWs.close(); _planDetailLogWs = null; }
 }
 
-function connectPlanLogWs(taskId, logEl) {
+function connectPlanLogWs(taskId, logEl, lastId) {
     if (_planDetailLogWs) _planDetailLogWs.close();
     var proto = location.protocol === 'https:' ? 'wss:' : 'ws:';
-    _planDetailLogWs = new WebSocket(proto + '//' + location.host + '/ws/logs/' + taskId);
+    _planDetailLogWs = new WebSocket(proto + '//' + location.host + '/ws/logs/' + taskId + '?last_id=' + (lastId || 0));
     _planDetailLogWs.onmessage = function(e) {
         try {
             var m = JSON.parse(e.data);
@@ -653,7 +819,7 @@ function toggleSection(id) {
     }
 }
 
-// Keep viewPlan as alias for backward compat (checkPlanReady uses it)
+// Keep viewPlan as alias for backward compat (patchPlan uses it)
 function viewPlan(gid) { openPlanDetail(gid); }
 
 function removeStep(idx) {
@@ -0,0 +1,98 @@
+"""Result cache and de-duplication for submitted tasks.
+
+A task's cache key hashes its mode, its cwd, the repo commit it would start
+from and its prompt with whitespace collapsed. Submitting a prompt whose key matches
+a queued or running task returns that task instead of a copy, so double
+submissions (voice input, retries from the phone) share one run and one log
+stream. A match completed within CACHE_TTL returns its result and diff
+without running anything, unless that diff was truncated: a partial patch
+can't stand in for the run. ``force`` skips the lookup; the new task still
+gets the key, so later submissions reuse it.
+"""
+
+from typing import Optional
+
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from db import execute, fetch_one
+from worktree import base_commit
+
+# Seconds a completed result is served for identical submissions (0 = only
+# de-duplicate tasks still queued or running)
+CACHE_TTL = float(os.environ.get("CCM_CACHE_TTL", "3600"))
+
+LOOKUP_SQL = """
+SELECT id, status FROM tasks
+WHERE cache_key=? AND (status IN ('queued', 'running') OR (
+    status='completed' AND finished_at >= ?
+    AND NOT EXISTS (SELECT 1 FROM task_diffs d WHERE d.task_id = tasks.id AND d.truncated)
+))
+ORDER BY id DESC LIMIT 1
+"""
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split())
+
+
+def normalize_cwd(cwd: Optional[str]) -> str:
+    return os.path.normcase(os.path.abspath(cwd)) if cwd else ""
+
+
+async def cache_key(prompt: str, mode: str, cwd: Optional[str] = None) -> Optional[str]:
+    """Key for a new task, or None outside a git repo (no commit to pin it to)."""
+    commit = await base_commit(cwd)
+    if not commit:
+        return None
+    raw = f"{mode}\0{normalize_cwd(cwd)}\0{commit}\0{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _cutoff() -> str:
+    # finished_at is written as datetime.utcnow().isoformat(), so this compares as text
+    if CACHE_TTL <= 0:
+        return "~"  # sorts after every timestamp
+    return (datetime.utcnow() - timedelta(seconds=CACHE_TTL)).isoformat()
+
+
+async def lookup(key: str, db=None) -> Optional[dict]:
+    """Newest queued/running task with this key, or one completed within the TTL.
+
+    Pass ``db`` to look up inside an open transaction.
+    """
+    if db is None:
+        return await fetch_one(LOOKUP_SQL, (key, _cutoff()))
+    cursor = await db.execute(LOOKUP_SQL, (key, _cutoff()))
+    row = await cursor.fetchone()
+    await cursor.close()
+    return dict(row) if row else None
+
+
+async def hit_response(hit: dict) -> dict:
+    """What POST /api/tasks returns instead of queueing a duplicate."""
+    if hit["status"] != "completed":
+        # Still in flight: the caller follows the existing task's stream
+        return {"id": hit["id"], "status": hit["status"], "deduplicated": True}
+    task = await fetch_one(
+        "SELECT t.id, t.status, t.result_text, t.cost_usd, t.finished_at, d.diff, d.truncated "
+        "FROM tasks t LEFT JOIN task_diffs d ON d.task_id = t.id WHERE t.id=?",
+        (hit["id"],),
+    )
+    return {
+        "id": task["id"],
+        "status": task["status"],
+        "cached": True,
+        "result_text": task["result_text"],
+        "diff": task["diff"],
+        "diff_truncated": bool(task["truncated"]),
+        "finished_at": task["finished_at"],
+    }
+
+
+async def save_diff(task_id: int, base: str, diff: str, truncated: bool = False):
+    await execute(
+        "INSERT OR REPLACE INTO task_diffs (task_id, base, diff, truncated) VALUES (?, ?, ?, ?)",
+        (task_id, base, diff, int(truncated)),
+    )
@@ -0,0 +1,103 @@
+"""In-memory priority queue of queued task ids, mirrored from the tasks table."""
+
+from typing import Optional, Dict, List, Tuple
+
+import heapq
+import logging
+import time
+
+from db import fetch_all
+
+logger = logging.getLogger(__name__)
+
+
+class TaskQueue:
+    """Max-priority queue of task ids, FIFO within a priority.
+
+    Ordering matches ``ORDER BY priority DESC, id ASC``. Removal is lazy: a
+    discarded or re-prioritised id stays in the heap until it surfaces, and
+    is skipped then, so push/discard/pop are all O(log n).
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int]] = []  # (-priority, task_id)
+        self._entries: Dict[int, int] = {}     # task_id -> priority
+        self._since: Dict[int, float] = {}     # task_id -> monotonic enqueue time
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, task_id: int) -> bool:
+        return task_id in self._entries
+
+    def push(self, task_id: int, priority: int = 0):
+        if self._entries.get(task_id) == priority:
+            return
+        self._entries[task_id] = priority
+        self._since.setdefault(task_id, time.monotonic())
+        heapq.heappush(self._heap, (-priority, task_id))
+
+    def discard(self, task_id: int):
+        self._entries.pop(task_id, None)
+        self._since.pop(task_id, None)
+
+    def pop(self) -> Optional[int]:
+        entry = self.pop_waited()
+        return entry[0] if entry else None
+
+    def peek(self) -> Optional[int]:
+        """Best id without removing it; stale heap heads are dropped on the way."""
+        while self._heap:
+            neg_prio, task_id = self._heap[0]
+            if self._entries.get(task_id) == -neg_prio:
+                return task_id
+            heapq.heappop(self._heap)
+        return None
+
+    def waited(self, task_id: int) -> float:
+        """Seconds the id has been queued."""
+        since = self._since.get(task_id)
+        return time.monotonic() - since if since is not None else 0.0
+
+    def pop_waited(self) -> Optional[Tuple[int, float]]:
+        """Like pop, but also return how many seconds the id was queued."""
+        while self._heap:
+            neg_prio, task_id = heapq.heappop(self._heap)
+            if self._entries.get(task_id) == -neg_prio:
+                del self._entries[task_id]
+                since = self._since.pop(task_id, None)
+                return task_id, (time.monotonic() - since if since is not None else 0.0)
+        return None
+
+    def oldest_wait(self) -> float:
+        """Seconds the longest-waiting queued task has been in memory. O(n)."""
+        if not self._since:
+            return 0.0
+        return time.monotonic() - min(self._since.values())
+
+    async def seed(self) -> int:
+        """Merge in every queued task from the DB. Used at startup and by the
+        consistency sweep; returns how many ids were missing from memory.
+
+        Merging (rather than replacing) keeps ids pushed while the SELECT was
+        in flight. Ids that are no longer queued are weeded out on claim.
+        """
+        rows = await fetch_all("SELECT id, priority FROM tasks WHERE status='queued'")
+        missing = 0
+        for r in rows:
+            if r["id"] not in self._entries:
+                missing += 1
+            self.push(r["id"], r["priority"])
+        return missing
+
+
+# Process-wide queue shared by the API routes, plan mode and the scheduler
+queue = TaskQueue()
+
+
+def push(task_id: int, priority: int = 0):
+    queue.push(task_id, priority)
+
+
+def discard(task_id: int):
+    queue.discard(task_id)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the claude CLI — emits stream-json without calling a model.
+
+Usage:
+    CCM_CLAUDE_CMD="python /abs/path/tools/fake_claude.py" python app.py
+
+Accepts (and ignores) the flags runner.build_claude_args passes, reads the
+prompt from ``-p`` and writes claude-shaped events to stdout: system init,
+assistant turns with tool_use / tool_result, then a result. Planning prompts
+(PLAN_PROMPT_TEMPLATE) get a valid plan with step dependencies as the
+result, so plan mode runs end to end.
+
+Tuned with environment variables (inherited from the server):
+
+    CCM_FAKE_TURNS       assistant turns per run                      (5)
+    CCM_FAKE_RATE        events per second, 0 = as fast as possible   (50)
+    CCM_FAKE_DURATION    seconds per run; overrides CCM_FAKE_RATE     (unset)
+    CCM_FAKE_SIZE        bytes of file content per tool_result        (2000)
+    CCM_FAKE_FAIL        fraction of runs that exit 1 half-way        (0)
+    CCM_FAKE_PLAN_STEPS  steps in generated plans                     (4)
+    CCM_FAKE_REPLAY      stream-json transcript to replay instead     (unset)
+    CCM_FAKE_SEED        random seed; default varies per run
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+TURNS = int(os.environ.get("CCM_FAKE_TURNS", "5"))
+RATE = float(os.environ.get("CCM_FAKE_RATE", "50"))
+DURATION = os.environ.get("CCM_FAKE_DURATION", "")
+SIZE = int(os.environ.get("CCM_FAKE_SIZE", "2000"))
+FAIL = float(os.environ.get("CCM_FAKE_FAIL", "0"))
+PLAN_STEPS = int(os.environ.get("CCM_FAKE_PLAN_STEPS", "4"))
+REPLAY = os.environ.get("CCM_FAKE_REPLAY", "")
+SEED = os.environ.get("CCM_FAKE_SEED", "")
+
+WORDS = "the handler returns early when the cache is cold so we add a guard and a test".split()
+
+
+def prompt_arg(argv):
+    for i, arg in enumerate(argv):
+        if arg in ("-p", "--print") and i + 1 < len(argv):
+            return argv[i + 1]
+    return ""
+
+
+def plan_result(rng):
+    """A plan shaped like PLAN_PROMPT_TEMPLATE asks for: a first step, a
+    fan-out of independent steps, and a final step joining them."""
+    n = max(1, PLAN_STEPS)
+    steps = []
+    for i in range(1, n + 1):
+        if i == 1:
+            deps = []
+        elif i == n and n > 2:
+            deps = list(range(2, n))
+        else:
+            deps = [1]
+        steps.append({
+            "id": i,
+            "title": f"Step {i}",
+            "description": " ".join(rng.sample(WORDS, 6)),
+            "depends_on": deps,
+            "prompt": f"Fake step {i}: " + " ".join(rng.sample(WORDS, 10)),
+        })
+    return json.dumps({"summary": "Fake plan", "steps": steps})
+
+
+def synthetic(prompt, rng, session):
+    yield {"type": "system", "subtype": "init", "cwd": os.getcwd(), "session_id": session,
+           "tools": ["Bash", "Read", "Edit", "Write"], "model": "fake"}
+    source = "".join(rng.choice(WORDS) + (" " if rng.random() < 0.9 else "\n") for _ in range(SIZE // 4))[:SIZE]
+    for turn in range(TURNS):
+        yield {"type": "assistant", "message": {
+            "id": f"msg_{turn}", "role": "assistant", "model": "fake",
+            "content": [{"type": "text", "text": " ".join(rng.sample(WORDS, 8))},
+                        {"type": "tool_use", "id": f"toolu_{turn}", "name": "Read",
+                         "input": {"file_path": f"src/module_{turn}.py"}}],
+            "usage": {"input_tokens": 1000 + 100 * turn, "output_tokens": 80}}, "session_id": session}
+        yield {"type": "user", "message": {"role": "user", "content": [
+            {"tool_use_id": f"toolu_{turn}", "type": "tool_result", "content": source}]}, "session_id": session}
+    text = plan_result(rng) if '"steps"' in prompt and "GOAL:" in prompt else "Done."
+    yield {"type": "assistant", "message": {"role": "assistant", "content": [{"type": "text", "text": text}]},
+           "session_id": session}
+    yield {"type": "result", "subtype": "success", "is_error": False, "num_turns": TURNS, "result": text,
+           "session_id": session, "total_cost_usd": 0.0, "usage": {"input_tokens": 0, "output_tokens": 0}}
+
+
+def replayed():
+    with open(REPLAY, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line.strip()
+
+
+def main():
+    rng = random.Random(SEED or None)
+    prompt = prompt_arg(sys.argv[1:])
+    session = f"fake-{os.getpid()}-{rng.randrange(1 << 30):x}"
+    events = list(replayed()) if REPLAY else [json.dumps(e) for e in synthetic(prompt, rng, session)]
+
+    delay = 0.0
+    if DURATION:
+        delay = float(DURATION) / max(1, len(events))
+    elif RATE > 0:
+        delay = 1.0 / RATE
+    fail_at = len(events) // 2 if rng.random() < FAIL else None
+
+    out = sys.stdout
+    for i, line in enumerate(events):
+        if fail_at is not None and i == fail_at:
+            out.flush()
+            print("fake claude: simulated failure", file=sys.stderr)
+            sys.exit(1)
+        out.write(line + "\n")
+        out.flush()
+        if delay:
+            time.sleep(delay)
+
+
+if __name__ == "__main__":
+    main()
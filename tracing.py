@@ -0,0 +1,187 @@
+"""Per-task span tracing — where a task's wall time went.
+
+A trace opens when the scheduler pops a task from the queue (with a "queue"
+span back to when it was enqueued) and is written to ``task_traces`` once the
+worker is done with it. Spans recorded after that — the worktree recycle runs
+in the background — are appended to the stored row.
+
+Spans are kept as compact lists ``[name, start_us, dur_us, args]`` relative
+to the trace's t0 (``dur_us`` is None for instants, ``args`` is omitted when
+empty) and exported as Chrome trace-event JSON by ``to_chrome`` for
+chrome://tracing / Perfetto and the UI waterfall.
+"""
+
+from typing import Optional, Dict, List
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from db import execute, fetch_one
+
+logger = logging.getLogger(__name__)
+
+# Spans kept per task (tool calls are one span each); 0 turns tracing off
+MAX_SPANS = int(os.environ.get("CCM_TRACE_MAX_SPANS", "2000"))
+
+# Which row (Chrome "thread") each span is drawn on
+LANES = {
+    "queue": "scheduler", "claim": "scheduler", "dispatch": "scheduler",
+    "checkout": "worktree", "merge": "worktree", "diff": "worktree", "release": "worktree", "recycle": "worktree",
+    "spawn": "claude", "boot": "claude", "first_token": "claude", "model": "claude",
+    "tool": "claude", "result": "claude", "exit": "claude", "finalize": "claude",
+    "plan_hooks": "post", "auto_progress": "post",
+}
+LANE_ORDER = ["scheduler", "worktree", "claude", "post"]
+
+UPSERT_SQL = """
+INSERT INTO task_traces (task_id, t0, spans) VALUES (?, ?, ?)
+ON CONFLICT(task_id) DO UPDATE SET t0=excluded.t0, spans=excluded.spans
+"""
+# Late span for a trace that is already on disk
+APPEND_SQL = "UPDATE task_traces SET spans=json_insert(spans, '$[#]', json(?)) WHERE task_id=?"
+
+
+class TaskTrace:
+    """Spans of one task. Times are ``time.time()`` seconds."""
+
+    def __init__(self, task_id: int, t0: Optional[float] = None):
+        self.task_id = task_id
+        self.t0 = time.time() if t0 is None else t0
+        self.spans: List[list] = []
+        self.dropped = 0
+
+    def _add(self, span: list):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append(span)
+
+    def span(self, name: str, start: float, end: Optional[float] = None, **args):
+        end = time.time() if end is None else end
+        self._add(_encode(name, start - self.t0, max(0.0, end - start), args))
+
+    def instant(self, name: str, at: Optional[float] = None, **args):
+        self._add(_encode(name, (time.time() if at is None else at) - self.t0, None, args))
+
+    @contextmanager
+    def measure(self, name: str, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(name, start, **args)
+
+
+class _NullTrace(TaskTrace):
+    """Stand-in for tasks that are not being traced; records nothing."""
+
+    def __init__(self):
+        super().__init__(0, 0.0)
+
+    def _add(self, span: list):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+# Traces of tasks a worker currently holds, by task id
+_active: Dict[int, TaskTrace] = {}
+
+
+def _encode(name: str, start: float, dur: Optional[float], args: dict) -> list:
+    span = [name, int(start * 1e6), None if dur is None else int(dur * 1e6)]
+    if args:
+        span.append(args)
+    return span
+
+
+def start(task_id: int, queued_for: float = 0.0, now: Optional[float] = None) -> TaskTrace:
+    """Open the trace of a task leaving the queue at ``now`` after ``queued_for`` seconds."""
+    if MAX_SPANS <= 0:
+        return NULL_TRACE
+    now = time.time() if now is None else now
+    trace = _active[task_id] = TaskTrace(task_id, now - queued_for)
+    trace.span("queue", trace.t0, now)
+    return trace
+
+
+def get(task_id: int) -> TaskTrace:
+    return _active.get(task_id, NULL_TRACE)
+
+
+def discard(task_id: int):
+    _active.pop(task_id, None)
+
+
+async def finish(task_id: int):
+    """Write the trace to the DB and stop tracking it in memory."""
+    trace = _active.get(task_id)
+    if trace is None:
+        return
+    try:
+        # Spans added while the write was in flight are picked up by another pass
+        written = -1
+        while written != len(trace.spans):
+            written = len(trace.spans)
+            await execute(UPSERT_SQL, (task_id, trace.t0, json.dumps(trace.spans, separators=(",", ":"))))
+    except Exception:
+        logger.exception(f"Saving trace of task {task_id} failed")
+    finally:
+        _active.pop(task_id, None)
+    if trace.dropped:
+        logger.warning(f"Trace of task {task_id}: {trace.dropped} spans over CCM_TRACE_MAX_SPANS dropped")
+
+
+async def record(task_id: Optional[int], name: str, start: float, end: Optional[float] = None, **args):
+    """Add a span to a task's trace, whether it is still open or already saved."""
+    if not task_id or MAX_SPANS <= 0:
+        return
+    trace = _active.get(task_id)
+    if trace is not None:
+        trace.span(name, start, end, **args)
+        return
+    row = await fetch_one("SELECT t0 FROM task_traces WHERE task_id=?", (task_id,))
+    if not row:
+        return
+    end = time.time() if end is None else end
+    span = _encode(name, start - row["t0"], max(0.0, end - start), args)
+    await execute(APPEND_SQL, (json.dumps(span, separators=(",", ":")), task_id))
+
+
+async def load(task_id: int) -> Optional[TaskTrace]:
+    """The live trace of a running task, else the stored one."""
+    trace = _active.get(task_id)
+    if trace is not None:
+        return trace
+    row = await fetch_one("SELECT t0, spans FROM task_traces WHERE task_id=?", (task_id,))
+    if not row:
+        return None
+    trace = TaskTrace(task_id, row["t0"])
+    trace.spans = json.loads(row["spans"])
+    return trace
+
+
+def to_chrome(trace: TaskTrace) -> dict:
+    """Chrome trace-event JSON: one process per task, one thread per lane."""
+    base = trace.t0 * 1e6
+    events = [{"name": "process_name", "ph": "M", "pid": trace.task_id, "tid": 0,
+               "args": {"name": f"task #{trace.task_id}"}}]
+    for tid, lane in enumerate(LANE_ORDER):
+        events.append({"name": "thread_name", "ph": "M", "pid": trace.task_id, "tid": tid, "args": {"name": lane}})
+        events.append({"name": "thread_sort_index", "ph": "M", "pid": trace.task_id, "tid": tid,
+                       "args": {"sort_index": tid}})
+    for span in list(trace.spans):
+        name, start, dur = span[0], span[1], span[2]
+        lane = LANES.get(name, "post")
+        event = {"name": name, "cat": lane, "ts": base + start, "pid": trace.task_id,
+                 "tid": LANE_ORDER.index(lane), "args": span[3] if len(span) > 3 else {}}
+        if dur is None:
+            event.update(ph="i", s="t")
+        else:
+            event.update(ph="X", dur=dur)
+        events.append(event)
+    return {"traceEvents": events, "displayTimeUnit": "ms",
+            "otherData": {"task_id": trace.task_id, "t0": trace.t0, "live": trace.task_id in _active}}
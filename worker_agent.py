@@ -0,0 +1,246 @@
+"""
+Worker agent — runs claude sessions for a manager on another machine.
+
+Usage:
+    python worker_agent.py --manager ws://manager-host:9050/ws/agent --name box2 --slots 2 --repo /path/to/clone
+
+Connects to the manager's /ws/agent, takes the tasks it is sent and runs
+each with run_claude_task in a worktree of its own pool, streaming every
+stdout line and the final result back. The manager stores the logs and
+results; the agent's SQLite file is scratch space for the runner and is
+emptied as tasks finish.
+
+Several agents can share one machine (and one repo): each gets its own
+worktree names (<name>-00, ...) and database file. A task waits for an idle
+worktree rather than running in the clone itself. Heartbeats go out as the
+manager asks; if the connection drops, running tasks are killed (the
+manager has already queued them again) and the agent reconnects with
+backoff once they have wound down.
+
+Settings (flags override the environment):
+    CCM_MANAGER_URL    manager websocket URL   (ws://localhost:9050/ws/agent)
+    CCM_AGENT_NAME     agent name              (host name)
+    CCM_AGENT_SLOTS    concurrent tasks        (2)
+    CCM_AGENT_TOKEN    shared secret, must match the manager's (unset)
+    CCM_REPO_DIR       repo for the worktree pool (current dir)
+    CCM_DB_PATH        scratch database        (ccm-agent-<name>.db)
+"""
+
+from typing import Optional, Dict, Set
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import sys
+
+try:
+    import websockets
+except ImportError:  # ships with uvicorn[standard]
+    sys.exit("worker_agent.py needs the websockets package: pip install websockets")
+
+import db
+import log_ingest
+import worktree
+from runner import install_child_watcher, run_claude_task
+
+logger = logging.getLogger("worker_agent")
+
+RECONNECT_MAX = 30.0
+
+
+class Agent:
+    def __init__(self, url: str, name: str, slots: int, token: str = "", repo: Optional[str] = None,
+                 pooled: bool = False):
+        self.url = url
+        self.name = name
+        self.slots = slots
+        self.token = token
+        self.repo = repo
+        self.pooled = pooled
+        self.heartbeat = 5.0
+        self._ws = None
+        self._send_lock = asyncio.Lock()
+        self._runs: Dict[int, asyncio.Task] = {}
+        self._procs: Dict[int, object] = {}
+        self._cancel_requested: Set[int] = set()
+        self._worktree_freed = asyncio.Event()
+
+    async def run_forever(self):
+        delay = 1.0
+        while True:
+            try:
+                async with websockets.connect(self.url, max_size=None) as ws:
+                    self._ws = ws
+                    await self._send({"type": "hello", "name": self.name, "slots": self.slots,
+                                      "host": socket.gethostname(), "token": self.token})
+                    delay = 1.0
+                    await self._session(ws)
+            except (OSError, websockets.exceptions.WebSocketException) as e:
+                logger.warning(f"Connection to {self.url} lost: {e}")
+            finally:
+                self._ws = None
+                await self._abort_all("manager connection lost")
+                # The manager re-dispatches these ids; old runs must be gone first
+                await self._drain()
+            logger.info(f"Reconnecting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    async def _session(self, ws):
+        beat = None
+        try:
+            async for raw in ws:
+                msg = json.loads(raw)
+                mtype = msg.get("type")
+                if mtype == "welcome":
+                    self.heartbeat = float(msg.get("heartbeat") or self.heartbeat)
+                    beat = asyncio.create_task(self._beat())
+                    logger.info(f"Registered with {self.url} as {self.name} ({self.slots} slots)")
+                elif mtype == "rejected":
+                    raise SystemExit(f"Manager rejected agent: {msg.get('reason')}")
+                elif mtype == "task":
+                    task_id = msg["task_id"]
+                    self._runs[task_id] = asyncio.create_task(
+                        self._run(task_id, msg["prompt"], msg.get("mode") or "execute", bool(msg.get("diff"))))
+                elif mtype == "cancel":
+                    await self._cancel(msg["task_id"])
+        finally:
+            if beat:
+                beat.cancel()
+
+    async def _send(self, msg: dict):
+        ws = self._ws
+        if ws is None:
+            return
+        try:
+            async with self._send_lock:
+                await ws.send(json.dumps(msg, ensure_ascii=False))
+        except websockets.exceptions.ConnectionClosed:
+            pass  # the session loop notices and reconnects
+
+    async def _beat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await self._send({"type": "heartbeat", "running": sorted(self._runs)})
+
+    async def _forward(self, task_id: int, event_type: str, payload, log_id: Optional[int] = None):
+        # payload is the stdout line (JSON text); the manager re-parses and stores it
+        await self._send({"type": "event", "task_id": task_id, "line": payload})
+
+    def _on_proc_start(self, task_id: int, proc):
+        self._procs[task_id] = proc
+        if task_id in self._cancel_requested:
+            asyncio.create_task(proc.terminate("cancelled"))
+
+    async def _cancel(self, task_id: int):
+        self._cancel_requested.add(task_id)
+        proc = self._procs.get(task_id)
+        if proc:
+            await proc.terminate("cancelled")
+
+    async def _abort_all(self, reason: str):
+        for task_id, proc in list(self._procs.items()):
+            if not proc.exited():
+                await proc.terminate(reason)
+
+    async def _drain(self):
+        """Wait for every run to end; ones still waiting for a worktree are cancelled."""
+        for task_id, run in list(self._runs.items()):
+            if task_id not in self._procs:
+                run.cancel()
+        if self._runs:
+            await asyncio.gather(*self._runs.values(), return_exceptions=True)
+
+    async def _acquire_worktree(self) -> Optional[dict]:
+        """An idle worktree of the pool, waiting for a recycle if none is free."""
+        if not self.pooled:
+            return None
+        while True:
+            self._worktree_freed.clear()
+            wt = await worktree.acquire()
+            if wt:
+                return wt
+            await self._worktree_freed.wait()
+
+    async def _run(self, task_id: int, prompt: str, mode: str, keep_diff: bool = False):
+        result = {"type": "result", "task_id": task_id, "status": "failed", "result_text": ""}
+        wt = None
+        try:
+            wt = await self._acquire_worktree()
+            cwd = wt["path"] if wt else self.repo
+            diff_base = await worktree.head_commit(cwd) if keep_diff and wt else None
+            # The runner records status and logs against a local tasks row
+            await db.execute(
+                "INSERT OR REPLACE INTO tasks (id, prompt, mode, status) VALUES (?, ?, ?, 'running')",
+                (task_id, prompt, mode),
+            )
+            logger.info(f"Task {task_id} -> {wt['name'] if wt else 'no-wt'}")
+            status = await run_claude_task(
+                task_id, prompt, cwd=cwd, broadcast=self._forward,
+                on_start=lambda proc: self._on_proc_start(task_id, proc),
+            )
+            row = await db.fetch_one("SELECT result_text, cost_usd FROM tasks WHERE id=?", (task_id,)) or {}
+            result.update(status=status, result_text=row.get("result_text") or "", cost_usd=row.get("cost_usd") or 0)
+            if diff_base and status == "completed":
+                diff, truncated = await worktree.capture_diff(cwd, diff_base)
+                result.update(diff_base=diff_base, diff=diff, diff_truncated=truncated)
+        except Exception as e:
+            logger.exception(f"Task {task_id} failed")
+            result.update(status="failed", result_text=str(e))
+        finally:
+            self._procs.pop(task_id, None)
+            self._cancel_requested.discard(task_id)
+            if wt:
+                await worktree.release(wt["id"], notify=self._worktree_freed.set)
+            await log_ingest.flush()
+            await db.execute("DELETE FROM task_logs WHERE task_id=?", (task_id,))
+            await db.execute("DELETE FROM tasks WHERE id=?", (task_id,))
+            await db.execute("DELETE FROM changes")
+            self._runs.pop(task_id, None)
+        # Only now: the manager may send the next task as soon as it sees this
+        await self._send(result)
+
+
+async def main(args):
+    install_child_watcher()
+    db.DB_PATH = args.db
+    await db.init_db()
+    await db.open_pool()
+    await log_ingest.start()
+
+    repo_root = worktree.get_repo_root_sync(args.repo)
+    if repo_root:
+        worktree.POOL_PREFIX = args.name
+        await worktree.init_pool(repo_root, args.slots)
+    else:
+        logger.warning(f"{args.repo} is not a git repo — tasks run there without worktrees")
+
+    agent = Agent(args.manager, args.name, args.slots, os.environ.get("CCM_AGENT_TOKEN", ""), repo_root or args.repo,
+                  pooled=bool(repo_root))
+    try:
+        await agent.run_forever()
+    finally:
+        await agent._abort_all("agent stopping")
+        await agent._drain()
+        await worktree.wait_recycling()
+        await log_ingest.stop()
+        await db.close_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Run claude tasks for a remote Claude Code Manager.")
+    parser.add_argument("--manager", default=os.environ.get("CCM_MANAGER_URL", "ws://localhost:9050/ws/agent"))
+    parser.add_argument("--name", default=os.environ.get("CCM_AGENT_NAME", socket.gethostname()))
+    parser.add_argument("--slots", type=int, default=int(os.environ.get("CCM_AGENT_SLOTS", "2")))
+    parser.add_argument("--repo", default=os.environ.get("CCM_REPO_DIR") or os.getcwd())
+    parser.add_argument("--db", default=os.environ.get("CCM_DB_PATH", ""))
+    args = parser.parse_args()
+    args.db = args.db or f"ccm-agent-{args.name}.db"
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -1,26 +1,63 @@
 """Git worktree pool management."""
 
-from typing import Optional, List, Tuple
+from typing import Optional, Dict, List, Set, Tuple
 
 import asyncio
 import logging
 import os
+import shutil
 import subprocess
+import time
 
-from db import execute, execute_returning, fetch_all, fetch_one
+import metrics
+import tracing
+from db import execute, execute_fetch_one, fetch_all, fetch_one, transaction
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_POOL_SIZE = 4
 BASE_DIR = os.environ.get("CCM_WORKTREE_BASE", "")
-
-
-def _run_git_sync(args: List[str], cwd: Optional[str] = None) -> Tuple[int, str, str]:
+# Ref (resolved in the main repo) that released worktrees are reset to
+BASE_REF = os.environ.get("CCM_BASE_REF", "HEAD")
+# Ignored paths kept across recycles so caches don't have to be rebuilt
+RECYCLE_KEEP = [p for p in os.environ.get("CCM_RECYCLE_KEEP", "node_modules,.venv,venv").split(",") if p]
+# How many worktrees may be provisioned at once
+PROVISION_PARALLEL = int(os.environ.get("CCM_PROVISION_PARALLEL", "4"))
+# Sparse checkout: directories to materialize (comma-separated). Falls back to
+# a .ccm-sparse file (one path per line) in the repo root; empty = full checkout.
+SPARSE_PATHS = os.environ.get("CCM_SPARSE_PATHS", "")
+SPARSE_FILE = ".ccm-sparse"
+# Pool worktrees are named <prefix>-00, -01, ...; agents sharing one repo
+# (worker_agent.py) each need their own prefix
+POOL_PREFIX = os.environ.get("CCM_WORKTREE_PREFIX", "wt")
+# Checkouts of big repos can take far longer than ordinary git calls
+GIT_TIMEOUT = 30
+PROVISION_TIMEOUT = int(os.environ.get("CCM_PROVISION_TIMEOUT", "600"))
+# Largest task diff stored; longer ones are cut, flagged truncated and not cached
+DIFF_MAX = int(os.environ.get("CCM_DIFF_MAX", str(1024 * 1024)))
+
+WORKTREE_SECONDS = metrics.Histogram(
+    "ccm_worktree_seconds", "Worktree pool operations: claim/acquire (DB), release (hand-back), recycle (git reset + clean)",
+    ["op"], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+_recycling: Set[asyncio.Task] = set()
+_stats = {
+    "recycles": 0,
+    "recycle_seconds_total": 0.0,
+    "recycle_seconds_max": 0.0,
+    "recycle_seconds_last": 0.0,
+    "pool_empty_seconds_total": 0.0,
+    "pool_empty_since": None,  # monotonic timestamp while no worktree is idle
+}
+
+
+def _run_git_sync(args: List[str], cwd: Optional[str] = None, timeout: int = GIT_TIMEOUT) -> Tuple[int, str, str]:
     """Synchronous git call — safe on Windows regardless of event loop."""
     try:
         r = subprocess.run(
             ["git"] + args,
-            capture_output=True, text=True, cwd=cwd, timeout=30,
+            capture_output=True, text=True, errors="replace", cwd=cwd, timeout=timeout,
         )
         return r.returncode, r.stdout.strip(), r.stderr.strip()
     except FileNotFoundError:
@@ -29,10 +66,26 @@ def _run_git_sync(args: List[str], cwd: Optional[str] = None) -> Tuple[int, str,
         return 1, "", "git timeout"
 
 
-async def _run_git(args: List[str], cwd: Optional[str] = None) -> Tuple[int, str, str]:
+def _run_git_bytes_sync(args: List[str], cwd: Optional[str] = None, timeout: int = GIT_TIMEOUT) -> Tuple[int, bytes, str]:
+    """Like _run_git_sync, but stdout is returned as is: undecoded, unstripped."""
+    try:
+        r = subprocess.run(["git"] + args, capture_output=True, cwd=cwd, timeout=timeout)
+        return r.returncode, r.stdout, r.stderr.decode("utf-8", "replace").strip()
+    except FileNotFoundError:
+        return 1, b"", "git not found"
+    except subprocess.TimeoutExpired:
+        return 1, b"", "git timeout"
+
+
+async def _run_git(args: List[str], cwd: Optional[str] = None, timeout: int = GIT_TIMEOUT) -> Tuple[int, str, str]:
     """Async wrapper — runs git in a thread to avoid blocking the event loop."""
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _run_git_sync, args, cwd)
+    return await loop.run_in_executor(None, _run_git_sync, args, cwd, timeout)
+
+
+async def _run_git_bytes(args: List[str], cwd: Optional[str] = None, timeout: int = GIT_TIMEOUT) -> Tuple[int, bytes, str]:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, _run_git_bytes_sync, args, cwd, timeout)
 
 
 def get_repo_root_sync(cwd: Optional[str] = None) -> Optional[str]:
@@ -54,62 +107,526 @@ async def init_pool(repo_dir: str, pool_size: int = DEFAULT_POOL_SIZE):
     existing = await fetch_all("SELECT * FROM worktrees WHERE status != 'removed'")
     existing_names = {w["name"] for w in existing}
 
-    for i in range(pool_size):
-        name = f"wt-{i:02d}"
-        if name in existing_names:
-            continue
-
-        branch = f"ccm/{name}"
-        wt_path = os.path.join(repo_dir, ".worktrees", name)
+    # A previous run may have stopped mid-recycle; broken ones get another try
+    for w in existing:
+        if w["status"] == "broken":
+            await execute("UPDATE worktrees SET status='recycling' WHERE id=? AND status='broken'", (w["id"],))
+            w["status"] = "recycling"
+        if w["status"] == "recycling":
+            _start_recycle(w)
+
+    names = [f"{POOL_PREFIX}-{i:02d}" for i in range(pool_size)]
+    missing = [n for n in names if n not in existing_names]
+    if missing:
+        start = time.monotonic()
+        created = await _provision(repo_dir, missing)
+        logger.info(f"Provisioned {len(created)}/{len(missing)} worktrees in {time.monotonic() - start:.1f}s "
+                    f"(parallel={PROVISION_PARALLEL})")
+
+
+def _sparse_paths(repo_dir: str) -> List[str]:
+    raw = SPARSE_PATHS
+    if not raw:
+        path = os.path.join(repo_dir, SPARSE_FILE)
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                raw = ",".join(l.strip() for l in f if l.strip() and not l.lstrip().startswith("#"))
+    return [p.strip() for p in raw.split(",") if p.strip()]
+
+
+async def _provision(repo_dir: str, names: List[str]) -> List[dict]:
+    """Create worktrees concurrently, at most PROVISION_PARALLEL at a time.
+
+    All worktrees share the main repo's object store, so each one only costs
+    a checkout — and with sparse paths configured, only part of one.
+    """
+    slots = asyncio.Semaphore(max(1, PROVISION_PARALLEL))
+    sparse = _sparse_paths(repo_dir)
+
+    async def one(name: str) -> Optional[dict]:
+        async with slots:
+            return await _create_worktree(repo_dir, name, sparse)
+
+    created = await asyncio.gather(*(one(n) for n in names))
+    return [wt for wt in created if wt]
+
+
+async def _create_worktree(repo_dir: str, name: str, sparse: Optional[List[str]] = None) -> Optional[dict]:
+    """Create one worktree on its own ccm/<name> branch and register it idle.
+
+    The branch is (re)set to BASE_REF, like a recycle does, even when a
+    retired slot left it behind at an older commit.
+    """
+    start = time.monotonic()
+    branch = f"ccm/{name}"
+    wt_path = os.path.join(repo_dir, ".worktrees", name)
+
+    code, base, err = await _run_git(["rev-parse", "--verify", BASE_REF + "^{commit}"], cwd=repo_dir)
+    if code != 0:
+        logger.warning(f"Cannot resolve base ref {BASE_REF!r} ({err}); using HEAD")
+        base = "HEAD"
+
+    # Create worktree; with sparse paths, populate it only after the
+    # sparse patterns are in place
+    add = ["worktree", "add"] + (["--no-checkout"] if sparse else []) + ["-B", branch, wt_path, base]
+    code, out, err = await _run_git(add, cwd=repo_dir, timeout=PROVISION_TIMEOUT)
+
+    if code == 0 and sparse:
+        code, out, err = await _run_git(["sparse-checkout", "set", "--cone"] + sparse, cwd=wt_path)
+        if code == 0:
+            code, out, err = await _run_git(["checkout", "-f", branch], cwd=wt_path, timeout=PROVISION_TIMEOUT)
+    elif code != 0 and os.path.exists(os.path.join(wt_path, ".git")) and (
+            "already exists" in err.lower() or "already checked out" in err.lower()):
+        # Left over from an earlier run: bring it to BASE_REF as well
+        ok, err = await _reset_worktree({"path": wt_path, "branch": branch})
+        code = 0 if ok else 1
+
+    if code == 0:
+        # A removed slot keeps its row (name is UNIQUE) — bring it back
+        wt = await execute_fetch_one(
+            "INSERT INTO worktrees (name, path, branch, status, idle_since) VALUES (?, ?, ?, 'idle', datetime('now')) "
+            "ON CONFLICT(name) DO UPDATE SET path=excluded.path, branch=excluded.branch, "
+            "status='idle', idle_since=excluded.idle_since WHERE worktrees.status='removed' "
+            "RETURNING *",
+            (name, wt_path, branch),
+        )
+        mode = f"sparse {len(sparse)} paths" if sparse else "full"
+        logger.info(f"Worktree {name} ready at {wt_path} in {time.monotonic() - start:.2f}s ({mode})")
+        return wt
+    logger.warning(f"Failed to create worktree {name}: {err}")
+    return None
 
-        # Create branch from HEAD if it doesn't exist
-        await _run_git(["branch", branch], cwd=repo_dir)
 
-        # Create worktree
-        code, out, err = await _run_git(
-            ["worktree", "add", wt_path, branch],
-            cwd=repo_dir,
+async def add_worktrees(count: int) -> List[dict]:
+    """Grow the pool by ``count`` worktrees, created concurrently."""
+    if not BASE_DIR or count <= 0:
+        return []
+    active = await fetch_all("SELECT name FROM worktrees WHERE status != 'removed'")
+    taken = {w["name"] for w in active}
+    names = []
+    i = 0
+    while len(names) < count:
+        name = f"{POOL_PREFIX}-{i:02d}"
+        if name not in taken:
+            names.append(name)
+        i += 1
+    return await _provision(BASE_DIR, names)
+
+
+async def retire_idle(max_remove: int, idle_seconds: float) -> List[str]:
+    """Remove up to ``max_remove`` worktrees idle for longer than ``idle_seconds``.
+
+    Highest-numbered slots go first so the pool stays dense at the bottom.
+    """
+    if max_remove <= 0:
+        return []
+    candidates = await fetch_all(
+        # idle_since is NULL on rows from before the column existed
+        "SELECT id FROM worktrees WHERE status='idle' "
+        "AND (idle_since IS NULL OR idle_since <= datetime('now', ?)) "
+        "ORDER BY id DESC LIMIT ?",
+        (f"-{int(idle_seconds)} seconds", max_remove),
+    )
+    removed = []
+    for c in candidates:
+        # Conditional so a worktree claimed in the meantime is left alone
+        wt = await execute_fetch_one(
+            "UPDATE worktrees SET status='removed' WHERE id=? AND status='idle' RETURNING *",
+            (c["id"],),
         )
+        if wt:
+            await _run_git(["worktree", "remove", wt["path"], "--force"], cwd=BASE_DIR)
+            removed.append(wt["name"])
+            logger.info(f"Worktree {wt['name']} retired (idle > {int(idle_seconds)}s)")
+    return removed
 
-        if code == 0 or "already exists" in err.lower():
-            # Ensure path exists even if worktree was already there
-            if not os.path.isdir(wt_path):
-                os.makedirs(wt_path, exist_ok=True)
 
-            await execute_returning(
-                "INSERT OR IGNORE INTO worktrees (name, path, branch, status) VALUES (?, ?, ?, 'idle')",
-                (name, wt_path, branch),
-            )
-            logger.info(f"Worktree {name} ready at {wt_path}")
-        else:
-            logger.warning(f"Failed to create worktree {name}: {err}")
+async def count_worktrees() -> int:
+    row = await fetch_one("SELECT COUNT(*) AS n FROM worktrees WHERE status NOT IN ('removed', 'broken')")
+    return row["n"] if row else 0
+
+
+class PoolExhausted(Exception):
+    """No idle worktree right now, but some are busy or recycling."""
+
+
+CLAIM_WORKTREE_SQL = """
+UPDATE worktrees SET status='busy'
+WHERE id = (SELECT id FROM worktrees WHERE status='idle' ORDER BY id LIMIT 1)
+RETURNING *
+"""
 
 
 async def acquire() -> Optional[dict]:
     """Get an idle worktree and mark it busy. Returns worktree dict or None."""
-    wt = await fetch_one(
-        "SELECT * FROM worktrees WHERE status='idle' ORDER BY id LIMIT 1"
-    )
-    if wt:
-        await execute("UPDATE worktrees SET status='busy' WHERE id=?", (wt["id"],))
-        return dict(wt)
-    return None
+    start = time.perf_counter()
+    wt = await execute_fetch_one(CLAIM_WORKTREE_SQL)
+    WORKTREE_SECONDS.labels("acquire").observe(time.perf_counter() - start)
+    return wt
 
 
-async def release(worktree_id: int):
-    """Mark a worktree as idle and reset its state."""
-    wt = await fetch_one("SELECT * FROM worktrees WHERE id=?", (worktree_id,))
+async def claim_task(task_id: Optional[int] = None, remote: bool = False) -> Tuple[Optional[dict], Optional[dict]]:
+    """Atomically mark a queued task running and take an idle worktree for it.
+
+    Claims ``task_id`` if given (and still queued), otherwise the next queued
+    task by priority. Both updates run in one BEGIN IMMEDIATE transaction, so
+    two schedulers sharing the DB file can never get the same task or
+    worktree. Returns (task, worktree); task is None if nothing was claimed,
+    worktree is None if there is no pool.
+
+    Raises PoolExhausted, with the task left queued, while every worktree is
+    busy or recycling; the recycle's ``notify`` is the cue to claim again.
+
+    ``remote`` claims for a worker agent: no local worktree, and plan steps
+    are refused since they must merge into the plan branch in this repo.
+    """
+    start = time.perf_counter()
+    try:
+        return await _claim_task(task_id, remote)
+    finally:
+        WORKTREE_SECONDS.labels("claim").observe(time.perf_counter() - start)
+
+
+async def _claim_task(task_id: Optional[int], remote: bool = False) -> Tuple[Optional[dict], Optional[dict]]:
+    local_only = " AND (mode != 'execute' OR plan_group_id IS NULL)" if remote else ""
+    if task_id is None:
+        target = f"(SELECT id FROM tasks WHERE status='queued'{local_only} ORDER BY priority DESC, id ASC LIMIT 1)"
+        params = ()
+    else:
+        target = "?"
+        params = (task_id,)
+
+    async with transaction() as db:
+        cursor = await db.execute(
+            f"UPDATE tasks SET status='running' WHERE id={target} AND status='queued'{local_only} "
+            "RETURNING id, prompt, cwd, mode, plan_group_id, cache_key",
+            params,
+        )
+        rows = await cursor.fetchall()
+        await cursor.close()
+        if not rows:
+            return None, None
+        task = dict(rows[0])
+        if remote:
+            return task, None
+
+        cursor = await db.execute(CLAIM_WORKTREE_SQL)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        wt = dict(rows[0]) if rows else None
+        if not wt and BASE_DIR:
+            cursor = await db.execute("SELECT 1 FROM worktrees WHERE status IN ('busy', 'recycling') LIMIT 1")
+            in_use = await cursor.fetchone()
+            await cursor.close()
+            if in_use:
+                _mark_pool_empty()
+                raise PoolExhausted()  # rolls back the task update
+        if wt:
+            await db.execute("UPDATE tasks SET worktree_id=? WHERE id=?", (wt["id"], task["id"]))
+            cursor = await db.execute("SELECT 1 FROM worktrees WHERE status='idle' LIMIT 1")
+            idle_left = await cursor.fetchone()
+            await cursor.close()
+            if not idle_left:
+                _mark_pool_empty()
+    return task, wt
+
+
+def _mark_pool_empty():
+    if _stats["pool_empty_since"] is None:
+        _stats["pool_empty_since"] = time.monotonic()
+
+
+def _mark_pool_refilled():
+    since = _stats["pool_empty_since"]
+    if since is not None:
+        _stats["pool_empty_seconds_total"] += time.monotonic() - since
+        _stats["pool_empty_since"] = None
+
+
+def get_pool_stats() -> dict:
+    """Recycle timings and how long the idle pool has been empty."""
+    stats = dict(_stats)
+    since = stats.pop("pool_empty_since")
+    stats["pool_empty_now"] = since is not None
+    if since is not None:
+        stats["pool_empty_seconds_total"] += time.monotonic() - since
+    stats["recycling"] = len(_recycling)
+    for key in ("recycle_seconds_total", "recycle_seconds_max", "recycle_seconds_last", "pool_empty_seconds_total"):
+        stats[key] = round(stats[key], 3)
+    return stats
+
+
+async def release(worktree_id: int, notify=None, task_id: Optional[int] = None):
+    """Hand a worktree back. It is recycled in the background and only
+    rejoins the idle pool once clean; ``notify`` is called at that point.
+    The recycle is added to ``task_id``'s trace."""
+    start = time.perf_counter()
+    wt = await execute_fetch_one(
+        "UPDATE worktrees SET status='recycling' WHERE id=? AND status='busy' RETURNING *",
+        (worktree_id,),
+    )
     if not wt:
         return
+    _start_recycle(wt, notify, task_id)
+    WORKTREE_SECONDS.labels("release").observe(time.perf_counter() - start)
+    logger.info(f"Worktree {wt['name']} released, recycling")
+
+
+def _start_recycle(wt: dict, notify=None, task_id: Optional[int] = None):
+    task = asyncio.create_task(_recycle(wt, notify, task_id))
+    _recycling.add(task)
+    task.add_done_callback(_recycling.discard)
+
 
-    # Reset the worktree to clean state
+async def _reset_worktree(wt: dict) -> Tuple[bool, str]:
+    """Reset a worktree to BASE_REF and wipe untracked/ignored files."""
     wt_path = wt["path"]
-    if os.path.isdir(wt_path):
-        await _run_git(["checkout", "--", "."], cwd=wt_path)
-        await _run_git(["clean", "-fd"], cwd=wt_path)
+    if not os.path.isdir(wt_path):
+        return False, "directory missing"
+    code, base, err = await _run_git(["rev-parse", "--verify", BASE_REF + "^{commit}"], cwd=BASE_DIR or None)
+    if code == 0:
+        # checkout -B == reset --hard onto base, and also moves the
+        # worktree back to its own branch if a task switched away
+        code, _, err = await _run_git(["checkout", "-f", "-B", wt["branch"], base], cwd=wt_path,
+                                      timeout=PROVISION_TIMEOUT)
+    else:
+        logger.warning(f"Cannot resolve base ref {BASE_REF!r} ({err}); discarding local changes only")
+        code, _, err = await _run_git(["checkout", "-f", "--", "."], cwd=wt_path, timeout=PROVISION_TIMEOUT)
+    if code != 0:
+        return False, f"checkout failed: {err}"
+    clean = ["clean", "-fdx"]
+    for keep in RECYCLE_KEEP:
+        clean += ["-e", keep]
+    code, _, err = await _run_git(clean, cwd=wt_path, timeout=PROVISION_TIMEOUT)
+    if code != 0:
+        return False, f"clean failed: {err}"
+    return True, ""
+
+
+async def _drop_index_lock(wt_path: str):
+    """Remove the index.lock a killed (timed out) git left behind."""
+    if not os.path.isdir(wt_path):
+        return
+    code, out, _ = await _run_git(["rev-parse", "--git-path", "index.lock"], cwd=wt_path)
+    if code == 0 and out:
+        try:
+            os.remove(os.path.join(wt_path, out))
+        except FileNotFoundError:
+            pass
+
+
+async def _recreate_worktree(wt: dict) -> bool:
+    """Replace a worktree that cannot be reset with a fresh one of the same name."""
+    if not BASE_DIR:
+        return False
+    await _run_git(["worktree", "remove", wt["path"], "--force"], cwd=BASE_DIR, timeout=PROVISION_TIMEOUT)
+    if os.path.isdir(wt["path"]):
+        shutil.rmtree(wt["path"], ignore_errors=True)
+    await _run_git(["worktree", "prune"], cwd=BASE_DIR)
+    row = await execute_fetch_one(
+        "UPDATE worktrees SET status='removed' WHERE id=? AND status='recycling' RETURNING id", (wt["id"],),
+    )
+    if not row:
+        return False
+    # Brings the removed row back as idle
+    if await _create_worktree(BASE_DIR, wt["name"], _sparse_paths(BASE_DIR)):
+        return True
+    await execute("UPDATE worktrees SET status='broken' WHERE id=? AND status='removed'", (wt["id"],))
+    return False
+
+
+async def _recycle(wt: dict, notify=None, task_id: Optional[int] = None):
+    """Reset a worktree to BASE_REF, wipe untracked/ignored files, mark idle.
+
+    A failed reset is retried once; after that the worktree is re-created,
+    or marked broken so it is never handed out dirty.
+    """
+    start = time.monotonic()
+    started_at = time.time()
+    ok = recreated = False
+    try:
+        for attempt in (1, 2):
+            ok, err = await _reset_worktree(wt)
+            if ok:
+                break
+            logger.warning(f"Recycling worktree {wt['name']} failed (attempt {attempt}): {err}")
+            await _drop_index_lock(wt["path"])
+        if not ok:
+            recreated = await _recreate_worktree(wt)
+    except Exception:
+        logger.exception(f"Recycling worktree {wt['name']} failed")
+    finally:
+        if ok:
+            await execute(
+                "UPDATE worktrees SET status='idle', idle_since=datetime('now') WHERE id=? AND status='recycling'",
+                (wt["id"],),
+            )
+        elif not recreated:
+            await execute("UPDATE worktrees SET status='broken' WHERE id=? AND status='recycling'", (wt["id"],))
+            logger.error(f"Worktree {wt['name']} marked broken; it is retried on the next start")
+
+    elapsed = time.monotonic() - start
+    _stats["recycles"] += 1
+    _stats["recycle_seconds_total"] += elapsed
+    _stats["recycle_seconds_last"] = elapsed
+    _stats["recycle_seconds_max"] = max(_stats["recycle_seconds_max"], elapsed)
+    WORKTREE_SECONDS.labels("recycle").observe(elapsed)
+    if ok or recreated:
+        _mark_pool_refilled()
+        logger.info(f"Worktree {wt['name']} recycled in {elapsed:.2f}s")
+    # Dispatch first: the trace write is a DB round trip nobody waits on
+    if notify:
+        notify()
+    try:
+        await tracing.record(task_id, "recycle", started_at, time.time(), worktree=wt["name"])
+    except Exception:
+        logger.exception(f"Tracing recycle of {wt['name']} failed")
+
+
+# --- Task diffs ---
+
+
+async def head_commit(path: Optional[str] = None) -> Optional[str]:
+    code, out, _ = await _run_git(["rev-parse", "--verify", "HEAD^{commit}"], cwd=path or None)
+    return out if code == 0 else None
+
+
+async def base_commit(cwd: Optional[str] = None) -> Optional[str]:
+    """Commit a new task would start from: BASE_REF of the pool's repo, or
+    HEAD of ``cwd`` when there is no pool. None outside a git repo."""
+    if not BASE_DIR:
+        return await head_commit(cwd)
+    code, out, _ = await _run_git(["rev-parse", "--verify", BASE_REF + "^{commit}"], cwd=BASE_DIR)
+    return out if code == 0 else None
+
+
+async def capture_diff(path: str, base: str) -> Tuple[str, bool]:
+    """Everything a task changed in its worktree — commits, staged, unstaged
+    and new files — as one patch against ``base``. Returns (diff, truncated).
+
+    ``truncated`` means the diff is not the whole patch: cut at DIFF_MAX,
+    not UTF-8, or not captured at all. It is kept for display, but the task
+    is never served from the cache. Never raises.
+
+    Stages the tree to include untracked files; the recycle resets it anyway.
+    """
+    try:
+        code, _, err = await _run_git(["add", "-A", "--sparse"], cwd=path)
+        if code == 0:
+            code, out, err = await _run_git_bytes(["diff", "--cached", "--no-color", "--binary", base], cwd=path)
+        if code != 0:
+            logger.warning(f"git diff in {path} failed: {err}")
+            return "", True
+        try:
+            diff = out.decode("utf-8")
+        except UnicodeDecodeError:
+            logger.warning(f"Diff in {path} is not UTF-8, not cached")
+            return out.decode("utf-8", "replace")[:DIFF_MAX], True
+    except Exception:
+        logger.exception(f"Capturing the diff in {path} failed")
+        return "", True
+    if len(diff) > DIFF_MAX:
+        return diff[:DIFF_MAX], True
+    return diff, False
+
+
+# --- Plan branches ---
+#
+# An approved plan gets its own branch, ccm/plan-<id>, cut from BASE_REF.
+# Each step runs on its worktree's branch reset to the plan branch, so it
+# sees the work of every step it depends on. When the step completes, its
+# changes are committed there and merged into the plan branch, one merge per
+# plan at a time; independent steps can therefore run in parallel worktrees.
+
+_plan_locks: Dict[int, asyncio.Lock] = {}
+
+
+def plan_branch(group_id: int) -> str:
+    return f"ccm/plan-{group_id}"
+
+
+async def create_plan_branch(group_id: int) -> Optional[str]:
+    """Cut the plan branch from BASE_REF. Returns its name, or None without a repo."""
+    if not BASE_DIR:
+        return None
+    branch = plan_branch(group_id)
+    code, _, err = await _run_git(["branch", branch, BASE_REF], cwd=BASE_DIR)
+    if code != 0 and "already exists" not in err.lower():
+        logger.warning(f"Cannot create plan branch {branch}: {err}")
+        return None
+    return branch
+
+
+async def start_plan_step(worktree_id: int, group_id: int) -> bool:
+    """Point a freshly claimed worktree at the current tip of the plan branch."""
+    wt = await fetch_one("SELECT * FROM worktrees WHERE id=?", (worktree_id,))
+    if not wt:
+        return False
+    code, _, err = await _run_git(["checkout", "-f", "-B", wt["branch"], plan_branch(group_id)], cwd=wt["path"])
+    if code != 0:
+        logger.warning(f"Worktree {wt['name']}: cannot start from {plan_branch(group_id)}: {err}")
+        return False
+    return True
+
+
+async def _identity(cwd: str) -> List[str]:
+    """Fallback committer for repos without a configured user."""
+    code, out, _ = await _run_git(["config", "user.email"], cwd=cwd)
+    if code == 0 and out:
+        return []
+    return ["-c", "user.name=claude-manager", "-c", "user.email=claude-manager@localhost"]
+
+
+async def merge_plan_step(worktree_id: int, group_id: int, task_id: int, title: str = "") -> Tuple[bool, str]:
+    """Commit a finished step and merge it into the plan branch.
+
+    The plan branch is never checked out: under the plan's lock the current
+    plan tip is merged into the step branch, and the plan ref is then moved
+    to the result (compare-and-swap on the old tip). Returns (ok, message).
+    """
+    wt = await fetch_one("SELECT * FROM worktrees WHERE id=?", (worktree_id,))
+    if not wt:
+        return False, "worktree gone"
+    cwd = wt["path"]
+    branch = plan_branch(group_id)
+    ident = await _identity(cwd)
+
+    # --sparse: in a sparse worktree, files created outside the cone are staged too
+    code, _, err = await _run_git(["add", "-A", "--sparse"], cwd=cwd)
+    if code != 0:
+        return False, f"git add failed: {err}"
+    code, out, _ = await _run_git(["status", "--porcelain"], cwd=cwd)
+    if code == 0 and out:
+        message = f"Plan {group_id} step #{task_id}" + (f": {title}" if title else "")
+        code, _, err = await _run_git(ident + ["commit", "-q", "-m", message], cwd=cwd)
+        if code != 0:
+            return False, f"commit failed: {err}"
+
+    lock = _plan_locks.setdefault(group_id, asyncio.Lock())
+    async with lock:
+        code, tip, err = await _run_git(["rev-parse", "--verify", branch], cwd=cwd)
+        if code != 0:
+            return False, f"plan branch missing: {err}"
+        code, _, err = await _run_git(
+            ident + ["merge", "--no-edit", "-m", f"Merge {branch} into step #{task_id}", tip], cwd=cwd,
+        )
+        if code != 0:
+            await _run_git(["merge", "--abort"], cwd=cwd)
+            return False, f"merge conflict with {branch}: {err}"
+        code, _, err = await _run_git(["update-ref", f"refs/heads/{branch}", "HEAD", tip], cwd=cwd)
+        if code != 0:
+            return False, f"cannot advance {branch}: {err}"
+    return True, f"merged into {branch}"
+
+
+def forget_plan(group_id: int):
+    _plan_locks.pop(group_id, None)
+
 
-    await execute("UPDATE worktrees SET status='idle' WHERE id=?", (worktree_id,))
-    logger.info(f"Worktree {wt['name']} released")
+async def wait_recycling(timeout: float = 30.0):
+    """Let in-flight recycles finish (used at shutdown)."""
+    if _recycling:
+        await asyncio.wait(list(_recycling), timeout=timeout)
 
 
 async def remove_worktree(worktree_id: int):
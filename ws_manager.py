@@ -0,0 +1,184 @@
+"""WebSocket fan-out — per-client bounded send queues, one writer task per client."""
+
+from typing import Optional, List, Dict
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+
+from fastapi import WebSocket
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Messages a client may have pending before it is considered too slow
+SEND_QUEUE_SIZE = int(os.environ.get("CCM_WS_QUEUE", "512"))
+# A single send taking longer than this marks the client dead
+SEND_TIMEOUT = float(os.environ.get("CCM_WS_SEND_TIMEOUT", "10"))
+
+BROADCAST_SECONDS = metrics.Histogram(
+    "ccm_broadcast_seconds", "Encode + fan-out of one event to all subscribed clients (queueing only, not sending)",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.05),
+)
+BROADCAST_DELIVERIES = metrics.Counter("ccm_broadcast_deliveries_total", "Messages queued to WebSocket clients")
+WS_DISCONNECTS = metrics.Counter("ccm_ws_slow_disconnects_total", "Clients dropped for falling too far behind")
+
+
+def encode_event(task_id: int, event_type: str, payload, log_id: Optional[int] = None) -> str:
+    """The WebSocket message for one event. A str payload must already be JSON."""
+    if not isinstance(payload, str):
+        payload = json.dumps(payload, ensure_ascii=False)
+    tail = f', "log_id": {log_id}}}' if log_id is not None else "}"
+    return f'{{"task_id": {task_id}, "event_type": {json.dumps(event_type)}, "payload": {payload}{tail}'
+
+
+class Client:
+    """One WebSocket plus its outbound queue.
+
+    Producers call offer(), which never blocks. Messages with a coalesce
+    key replace any still-pending message with the same key (only the
+    latest state matters). If the queue still overflows, the client is
+    disconnected rather than slowing the producer; it can reconnect and
+    catch up.
+
+    A client created ``paused`` holds messages until resume(), so a replay
+    can be sent first; held log events the replay already covered are
+    dropped by log_id, along with the unnumbered stream fragments held
+    before them (the replayed rows already contain their text).
+    """
+
+    def __init__(self, ws: WebSocket, max_pending: int = SEND_QUEUE_SIZE, paused: bool = False):
+        self.ws = ws
+        self.max_pending = max_pending
+        self.closed = False
+        self.coalesced = 0
+        self._pending = deque()  # [key, msg, log_id] entries
+        self._by_key: Dict[str, list] = {}
+        self._ready = asyncio.Event()
+        self._resumed = asyncio.Event()
+        if not paused:
+            self._resumed.set()
+        self._writer = asyncio.create_task(self._run())
+
+    def offer(self, msg: str, key: Optional[str] = None, log_id: Optional[int] = None) -> bool:
+        if self.closed:
+            return False
+        if key is not None and key in self._by_key:
+            self._by_key[key][1] = msg
+            self.coalesced += 1
+            return True
+        if len(self._pending) >= self.max_pending:
+            logger.warning(f"WebSocket client fell {len(self._pending)} messages behind, disconnecting")
+            WS_DISCONNECTS.inc()
+            self.close()
+            return False
+        entry = [key, msg, log_id]
+        self._pending.append(entry)
+        if key is not None:
+            self._by_key[key] = entry
+        self._ready.set()
+        return True
+
+    def resume(self, after_id: int = 0):
+        """Start sending held messages, skipping what the replay up to after_id sent."""
+        if after_id:
+            # Fragments carry no log_id; those before the last covered event
+            # were merged into rows the replay sent. Keyed state messages stay.
+            covered = -1
+            for i, e in enumerate(self._pending):
+                if e[2] is not None and e[2] <= after_id:
+                    covered = i
+            self._pending = deque(e for i, e in enumerate(self._pending) if i > covered or e[0] is not None)
+        self._resumed.set()
+
+    async def _run(self):
+        try:
+            await self._resumed.wait()
+            while True:
+                await self._ready.wait()
+                while self._pending:
+                    key, msg, _ = entry = self._pending.popleft()
+                    if key is not None and self._by_key.get(key) is entry:
+                        del self._by_key[key]
+                    await asyncio.wait_for(self.ws.send_text(msg), SEND_TIMEOUT)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._pending.clear()
+        self._by_key.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        asyncio.create_task(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await self.ws.close(code=1013)  # "try again later"
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    def __init__(self):
+        self.task_connections: Dict[int, List[Client]] = {}
+        self.event_connections: List[Client] = []
+
+    async def connect_task(self, ws: WebSocket, task_id: int, paused: bool = False) -> Client:
+        await ws.accept()
+        client = Client(ws, paused=paused)
+        self.task_connections.setdefault(task_id, []).append(client)
+        return client
+
+    async def connect_events(self, ws: WebSocket) -> Client:
+        await ws.accept()
+        client = Client(ws)
+        self.event_connections.append(client)
+        return client
+
+    def disconnect_task(self, ws: WebSocket, task_id: int):
+        conns = self.task_connections.get(task_id, [])
+        for c in [c for c in conns if c.ws is ws]:
+            c.close()
+            conns.remove(c)
+        if not conns:
+            self.task_connections.pop(task_id, None)
+
+    def disconnect_events(self, ws: WebSocket):
+        for c in [c for c in self.event_connections if c.ws is ws]:
+            c.close()
+            self.event_connections.remove(c)
+
+    async def broadcast(self, task_id: int, event_type: str, payload, log_id: Optional[int] = None):
+        """Send an event to the task's and the global subscribers.
+
+        ``payload`` is a dict, or a str holding already-encoded JSON (a
+        stream-json line from the runner), which is spliced in unparsed.
+        """
+        start = time.perf_counter()
+        # Serialized once, shared by every subscriber
+        msg = encode_event(task_id, event_type, payload, log_id)
+        # Scheduler snapshots supersede each other — keep only the newest per client
+        key = "scheduler" if event_type == "scheduler" else None
+        delivered = self._fan_out(task_id, msg, key, log_id)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+        if delivered:
+            BROADCAST_DELIVERIES.inc(delivered)
+
+    def _fan_out(self, task_id: int, msg: str, key: Optional[str] = None, log_id: Optional[int] = None) -> int:
+        delivered = 0
+        conns = self.task_connections.get(task_id)
+        if conns:
+            self.task_connections[task_id] = conns = [c for c in conns if c.offer(msg, key, log_id)]
+            delivered += len(conns)
+        self.event_connections = [c for c in self.event_connections if c.offer(msg, key, log_id)]
+        return delivered + len(self.event_connections)